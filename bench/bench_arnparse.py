@@ -0,0 +1,99 @@
+#
+# Purpose: Micro-benchmark of the vendored arnparse package
+# NOTE:
+# - Compares the original character-walking parser with the slotted/memoized parser
+# - Usage: python bench/bench_arnparse.py [arn_count] [member_count]
+#
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'lambda', 'package'))
+
+from arnparse.arnparse import ARNPARSE_CACHE_SIZE, _arnparse, arnparse, arnparse_many
+from arnparse.str_utils import empty_str_to_none
+
+resource_templates = [
+    'arn:aws:ec2:{region}:{account}:instance/i-{suffix:017x}',
+    'arn:aws:ec2:{region}:{account}:security-group/sg-{suffix:017x}',
+    'arn:aws:iam::{account}:role/service-role/role-{suffix}',
+    'arn:aws:lambda:{region}:{account}:function:function-{suffix}',
+    'arn:aws:s3:::bucket-{suffix}'
+]
+regions = [ 'us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-2' ]
+
+
+class LegacyArn(object):
+    def __init__(self, partition, service, region, account_id, resource_type, resource):
+        self.partition = partition
+        self.service = service
+        self.region = region
+        self.account_id = account_id
+        self.resource_type = resource_type
+        self.resource = resource
+
+
+def legacy_arnparse(arn_str):
+    # arnparse 0.0.2 as originally vendored
+    if not arn_str.startswith('arn:'):
+        raise ValueError(arn_str)
+    elements = arn_str.split(':', 5)
+    service = elements[2]
+    resource = elements[5]
+    if service in ['s3', 'sns', 'apigateway', 'execute-api']:
+        resource_type = None
+    else:
+        first_separator_index = -1
+        for idx, c in enumerate(resource):
+            if c in (':', '/'):
+                first_separator_index = idx
+                break
+        if first_separator_index != -1:
+            resource_type = resource[:first_separator_index]
+            resource = resource[first_separator_index + 1:]
+        else:
+            resource_type = None
+    return LegacyArn(elements[1], service, empty_str_to_none(elements[3]), empty_str_to_none(elements[4]), resource_type, resource)
+
+
+def generate_arns(arn_count, account_count):
+    rnd = random.Random(42)
+    accounts = [ '%012d' % rnd.randrange(10 ** 12) for idx in range(account_count) ]
+    return [
+        rnd.choice(resource_templates).format(region=rnd.choice(regions), account=rnd.choice(accounts), suffix=idx)
+        for idx in range(arn_count)
+    ], accounts
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print('{:<48} {:>8.3f} s'.format(label, elapsed))
+    return elapsed
+
+
+def main():
+    arn_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    member_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    arns, accounts = generate_arns(arn_count, 400)
+    print('ARNs: {}, members re-parsing insight results: {}'.format(arn_count, member_count))
+
+    legacy = timed('legacy parse (single pass)', lambda: [ legacy_arnparse(arn) for arn in arns ])
+    fast = timed('fast parse, uncached (single pass)', lambda: [ _arnparse(arn) for arn in arns ])
+    timed('arnparse_many grouping (single pass)', lambda: arnparse_many(arns))
+
+    # The insight collector used to parse every insight result once per member
+    sample = arns[:min(len(arns), ARNPARSE_CACHE_SIZE)]
+    legacy_members = timed('legacy parse x members ({} ARNs)'.format(len(sample)),
+                           lambda: [ legacy_arnparse(arn) for member in range(member_count) for arn in sample ])
+    arnparse.cache_clear()
+    cached_members = timed('memoized parse x members ({} ARNs)'.format(len(sample)),
+                           lambda: [ arnparse(arn) for member in range(member_count) for arn in sample ])
+    print('speedup single pass: {:.2f}x, repeated per member: {:.2f}x'.format(legacy / fast, legacy_members / cached_members))
+
+
+if __name__ == '__main__':
+    main()
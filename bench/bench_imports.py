@@ -0,0 +1,165 @@
+#
+# Purpose: Cold start (init phase) budget of the Lambda handlers
+# NOTE:
+# - Each handler module is loaded in a fresh interpreter (python -X importtime) --runs times;
+#   the median load time of its module level code is compared with --budget-ms
+# - Reports the imports that cost the most, so regressions point at the module that caused them
+# - boto3 is used when installed; otherwise (or with --fake) bench/fake_aws.py stands in and the
+#   report only covers the handlers' own modules
+# - --output / --baseline work as in bench_lambdas.py; exits with status 1 over budget or on regression
+# - Usage: python bench/bench_imports.py --runs 7 --budget-ms 300
+#
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+lambda_dir = os.path.join(bench_dir, '..', 'src', 'lambda')
+
+handlers = [
+    'get-sh-members',
+    'sh-summary-collector',
+    'sh-insights-collector',
+    'sh-resource-findings',
+    'sh-email-notify',
+    'add-ses-identity',
+    'sh-org-report',
+    'sh-findings-stream'
+]
+
+marker = '-- handler init --'
+
+# Runs in the child interpreter: install the fake AWS modules when asked, then time the
+# handler module load (imports and module level code) after a marker line on stderr
+bootstrap = '''
+import os, sys, time, json, importlib.util
+sys.path[0:0] = [ {lambda_dir!r}, os.path.join({lambda_dir!r}, 'package'), {bench_dir!r} ]
+if {fake!r}:
+    import fake_aws
+    fake_aws.install(fake_aws.SyntheticOrg(accounts=1, findings=1))
+sys.stderr.write({marker!r} + '\\n')
+sys.stderr.flush()
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location({module_name!r}, os.path.join({lambda_dir!r}, {name!r} + '.py'))
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(json.dumps({{ 'init_ms': (time.perf_counter() - started) * 1000.0 }}))
+'''
+
+def boto3_installed():
+    result = subprocess.run([ sys.executable, '-c', 'import boto3' ], capture_output=True)
+    return result.returncode == 0
+
+def parse_importtime(stderr):
+    # Top level imports after the marker: {module: cumulative microseconds}
+    imports = {}
+    started = False
+    for line in stderr.splitlines():
+        if line.strip() == marker:
+            started = True
+            continue
+        if not started or not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        # nested imports are indented below their parent
+        if name.startswith('  '):
+            continue
+        imports[name.strip()] = imports.get(name.strip(), 0) + int(cumulative_us)
+    return imports
+
+def measure(name, runs, fake):
+    # Median init time of runs cold loads and the median cost of each top level import
+    code = bootstrap.format(lambda_dir=lambda_dir, bench_dir=bench_dir, fake=fake, marker=marker,
+                            module_name=name.replace('-', '_'), name=name)
+    environment = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    init_ms = []
+    imports = {}
+    error = None
+    for run in range(runs):
+        result = subprocess.run([ sys.executable, '-X', 'importtime', '-c', code ], capture_output=True, text=True, env=environment)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1]
+            break
+        init_ms.append(json.loads(result.stdout.strip().splitlines()[-1])['init_ms'])
+        for module_name, cumulative_us in parse_importtime(result.stderr).items():
+            imports.setdefault(module_name, []).append(cumulative_us / 1000.0)
+    top_imports = sorted([ (module_name, statistics.median(times)) for module_name, times in imports.items() ], key=lambda item: -item[1])[:5]
+    return {
+        'lambda': name,
+        'runs': len(init_ms),
+        'boto3': 'fake' if fake else 'boto3',
+        'init_ms': round(statistics.median(init_ms), 3) if init_ms else None,
+        'init_ms_max': round(max(init_ms), 3) if init_ms else None,
+        'top_imports': [ [ module_name, round(ms, 3) ] for module_name, ms in top_imports ],
+        'error': error
+    }
+
+def find_regressions(results, baseline, tolerance):
+    # init time may grow by tolerance (and 5 ms of noise)
+    baseline_results = { result['lambda']: result for result in baseline }
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result['lambda'])
+        if previous is None or previous['init_ms'] is None or result['init_ms'] is None or previous['boto3'] != result['boto3']:
+            continue
+        if result['init_ms'] > previous['init_ms'] * (1 + tolerance) + 5:
+            regressions.append((result, previous['init_ms'], result['init_ms']))
+    return regressions
+
+def format_report(results, budget_ms, regressions=None):
+    lines = [
+        '| Lambda | boto3 | Init median (ms) | Init max (ms) | Budget | Top imports (ms) | Error |',
+        '|---|---|---:|---:|---|---|---|'
+    ]
+    for result in results:
+        within = result['init_ms'] is not None and result['init_ms'] <= budget_ms
+        lines.append('| {} | {} | {} | {} | {} | {} | {} |'.format(
+            result['lambda'], result['boto3'],
+            '{:.1f}'.format(result['init_ms']) if result['init_ms'] is not None else '-',
+            '{:.1f}'.format(result['init_ms_max']) if result['init_ms_max'] is not None else '-',
+            'ok' if within else 'over {:.0f} ms'.format(budget_ms),
+            ', '.join([ '{} {:.1f}'.format(module_name, ms) for module_name, ms in result['top_imports'] ]),
+            result['error'] or ''
+        ))
+    if regressions:
+        lines.append('')
+        lines.append('Regressions:')
+        for result, previous, current in regressions:
+            lines.append('- {}: init_ms {} -> {}'.format(result['lambda'], previous, current))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold start init time of the Lambda handlers')
+    parser.add_argument('--lambdas', default=','.join(handlers), help='Lambdas to measure, comma separated')
+    parser.add_argument('--runs', type=int, default=5, help='Cold loads per Lambda')
+    parser.add_argument('--budget-ms', type=float, default=300.0, help='Allowed median init time per Lambda')
+    parser.add_argument('--fake', action='store_true', help='Use bench/fake_aws.py even when boto3 is installed')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed growth of init time')
+    args = parser.parse_args()
+
+    fake = args.fake or not boto3_installed()
+    results = []
+    for name in args.lambdas.split(','):
+        result = measure(name, args.runs, fake)
+        results.append(result)
+        print('{}: {} ms'.format(name, result['init_ms']), file=sys.stderr)
+    regressions = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file)['results'], args.tolerance)
+    print(format_report(results, args.budget_ms, regressions))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({ 'args': vars(args), 'results': results }, output_file, indent=2)
+    over_budget = [ result for result in results if result['init_ms'] is None or result['init_ms'] > args.budget_ms ]
+    if regressions or over_budget:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
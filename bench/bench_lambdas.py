@@ -0,0 +1,288 @@
+#
+# Purpose: Load simulation of the Lambda handlers against a synthetic organization
+# NOTE:
+# - Each handler runs cold (freshly loaded modules) against bench/fake_aws.py for every org size
+# - Records API calls by operation, throttled calls, wall time and peak traced memory
+# - --output writes the results as JSON; --baseline compares with an earlier JSON result and
+#   exits with status 1 when calls, wall time or memory regress beyond --tolerance
+# - Usage: python bench/bench_lambdas.py --sizes 10:1000,1000:100000,5000:1000000 --latency-ms 5
+#
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import importlib.util
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+lambda_dir = os.path.join(bench_dir, '..', 'src', 'lambda')
+sys.path.insert(0, bench_dir)
+sys.path.insert(0, os.path.join(lambda_dir, 'package'))
+sys.path.insert(0, lambda_dir)
+
+import fake_aws
+
+# Shared modules keep process wide state (clients, sessions, executors); they are
+# reloaded for every run so that each handler starts cold
+shared_modules = [ 'sts_session_cache', 'payload_store', 'sh_async', 'template_renderer', 'digest_store', 'sh_metrics', 'sh_retry', 'findings_snapshot', 'run_ledger', 'shard_planner', 'work_queue', 'sh_logging' ]
+
+org_id = 'o-bench000000'
+assume_role = 'AWSControlTowerExecution'
+audit_account = '000000000000'
+
+def load_lambda(name):
+    executor = getattr(sys.modules.get('sh_async'), '_executor', None)
+    if executor is not None:
+        executor.shutdown(wait=False)
+    for module_name in shared_modules:
+        sys.modules.pop(module_name, None)
+    path = os.path.join(lambda_dir, name + '.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_members(org):
+    members = []
+    for idx, account_id in enumerate(org.account_ids):
+        member = {
+            'account_id': account_id,
+            'account_email': org.account_email(account_id),
+            'sh_status': 'Enabled'
+        }
+        if idx < len(org.account_ids) * org.tech_owner_ratio:
+            member['tech_owner_email'] = org.tech_owner_email(account_id)
+        members.append(member)
+    return members
+
+def get_member_summaries(org):
+    summaries = []
+    for idx, member in enumerate(get_members(org)):
+        summary = dict(member)
+        summary.update({
+            'severity_count': [
+                {
+                    'standard_type': standard_type,
+                    'result': [ { 'Value': label, 'Count': (idx + offset) % 50 } for offset, label in enumerate(fake_aws.severity_labels) ]
+                } for standard_type in fake_aws.standard_types
+            ],
+            'SecurityHub': [ { 'Value': finding_type, 'Count': idx % 20 } for finding_type in fake_aws.other_types ]
+        })
+        summaries.append(summary)
+    return summaries
+
+def get_member_insight_results(org):
+    account_id = org.account_ids[0]
+    return [
+        {
+            'AccountId': account_id,
+            'ResourceId': org.resource_id(account_id, org.finding_region(resource_idx), resource_idx),
+            'ResourceRegion': org.finding_region(resource_idx)
+        } for resource_idx in range(min(org.resources_per_account, org.account_findings(0)))
+    ]
+
+# Lambda name -> event built from the synthetic org
+scenarios = {
+    'get-sh-members': lambda org: {},
+    'sh-summary-collector': lambda org: { 'member_list': get_members(org) },
+    'sh-insights-collector': lambda org: {
+        'ResourceProperties': {
+            'org_id': org_id,
+            'assume_role': assume_role,
+            'audit_account': audit_account,
+            'insight_arn_suffix': '21'
+        }
+    },
+    'sh-resource-findings': lambda org: {
+        'ResourceProperties': {
+            'org_id': org_id,
+            'assume_role': assume_role,
+            'audit_account': audit_account,
+            'insight_arn': 'arn:aws:securityhub:::insight/securityhub/default/21',
+            'insight_name': 'Failed resources',
+            'member_account': org.account_ids[0],
+            'member_insight_results': get_member_insight_results(org)
+        }
+    },
+    'sh-email-notify': lambda org: { 'member_list': get_member_summaries(org) },
+    'add-ses-identity': lambda org: { 'member_list': get_members(org) }
+}
+
+def get_environment(work_dir, overrides):
+    environment = {
+        'table_name': 'sh-members',
+        'sender_email': 'sh-report@example.com',
+        'template_name': 'SHSummaryReport',
+        'payload_dir': os.path.join(work_dir, 'payloads'),
+        'verified_cache_path': os.path.join(work_dir, 'verified-identities.json'),
+        'summary_store_path': os.path.join(work_dir, 'summary-store.json'),
+        'digest_store_path': os.path.join(work_dir, 'report-digests.json'),
+        'ledger_path': os.path.join(work_dir, 'run-ledger.json'),
+        'cost_store_path': os.path.join(work_dir, 'account-costs.json'),
+        'work_queue_dir': os.path.join(work_dir, 'work-queue'),
+        'result_dir': os.path.join(work_dir, 'resource-findings'),
+        'snapshot_dir': os.path.join(work_dir, 'snapshots')
+    }
+    environment.update(overrides)
+    return environment
+
+def run_handler(name, org, overrides, trace_memory):
+    # Run one handler cold in a fresh work directory: (wall seconds, peak bytes, error)
+    saved_environment = dict(os.environ)
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.environ.update(get_environment(work_dir, overrides))
+        try:
+            module = load_lambda(name)
+            event = scenarios[name](org)
+            org.reset_counters()
+            error = None
+            if trace_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+            try:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    module.lambda_handler(event, None)
+            except Exception as e:
+                error = '{}: {}'.format(type(e).__name__, e)
+            wall_seconds = time.perf_counter() - started
+            peak_memory = None
+            if trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_environment)
+    return wall_seconds, peak_memory, error
+
+def run_scenario(name, org, overrides, trace_memory=True):
+    # Wall time and calls come from an untraced run; tracemalloc slows the handlers
+    # several times, so peak memory is measured by a second, traced run
+    wall_seconds, peak_memory, error = run_handler(name, org, overrides, False)
+    calls = dict(sorted(org.calls.items()))
+    throttled_calls = sum(org.throttled.values())
+    if trace_memory:
+        peak_memory = run_handler(name, org, overrides, True)[1]
+    return {
+        'lambda': name,
+        'accounts': len(org.account_ids),
+        'findings': org.findings,
+        'regions': len(org.regions),
+        'latency_ms': org.latency_ms,
+        'throttle_rate': org.throttle_rate,
+        'api_rate_limit': org.api_rate_limit,
+        'wall_seconds': round(wall_seconds, 4),
+        'peak_memory_mb': round(peak_memory / (1024 * 1024), 3) if peak_memory is not None else None,
+        'api_calls': sum(calls.values()),
+        'throttled_calls': throttled_calls,
+        'calls': calls,
+        'error': error
+    }
+
+def result_key(result):
+    return (result['lambda'], result['accounts'], result['findings'])
+
+def find_regressions(results, baseline, tolerance):
+    # Calls must not grow; wall time and memory may grow by tolerance (and 50 ms of noise)
+    baseline_results = { result_key(result): result for result in baseline }
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result_key(result))
+        if previous is None:
+            continue
+        if result['api_calls'] > previous['api_calls'] * (1 + (tolerance if result['throttle_rate'] > 0 or result['api_rate_limit'] > 0 else 0)):
+            regressions.append((result, 'api_calls', previous['api_calls'], result['api_calls']))
+        if result['wall_seconds'] > previous['wall_seconds'] * (1 + tolerance) + 0.05:
+            regressions.append((result, 'wall_seconds', previous['wall_seconds'], result['wall_seconds']))
+        if result['peak_memory_mb'] is not None and previous.get('peak_memory_mb') is not None and \
+                result['peak_memory_mb'] > previous['peak_memory_mb'] * (1 + tolerance) + 1:
+            regressions.append((result, 'peak_memory_mb', previous['peak_memory_mb'], result['peak_memory_mb']))
+    return regressions
+
+def format_report(results, regressions=None):
+    lines = [
+        '| Lambda | Accounts | Findings | Wall (s) | Peak memory (MB) | API calls | Throttled | Top calls | Error |',
+        '|---|---:|---:|---:|---:|---:|---:|---|---|'
+    ]
+    for result in results:
+        top_calls = sorted(result['calls'].items(), key=lambda item: -item[1])[:3]
+        lines.append('| {} | {} | {} | {:.3f} | {} | {} | {} | {} | {} |'.format(
+            result['lambda'], result['accounts'], result['findings'], result['wall_seconds'],
+            result['peak_memory_mb'] if result['peak_memory_mb'] is not None else '-',
+            result['api_calls'], result['throttled_calls'],
+            ', '.join([ '{} {}'.format(operation, count) for operation, count in top_calls ]),
+            result['error'] or ''
+        ))
+    if regressions:
+        lines.append('')
+        lines.append('Regressions:')
+        for result, metric, previous, current in regressions:
+            lines.append('- {} ({} accounts, {} findings): {} {} -> {}'.format(
+                result['lambda'], result['accounts'], result['findings'], metric, previous, current))
+    return '\n'.join(lines)
+
+def parse_sizes(sizes):
+    # '10:1000,100:20000' -> [(10, 1000), (100, 20000)]
+    parsed = []
+    for size in sizes.split(','):
+        accounts, _, findings = size.partition(':')
+        parsed.append((int(accounts), int(findings) if findings else int(accounts) * 100))
+    return parsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Lambda handlers against a synthetic organization')
+    parser.add_argument('--sizes', default='10:1000,100:20000', help='accounts:findings, comma separated')
+    parser.add_argument('--lambdas', default=','.join(scenarios), help='Lambdas to run, comma separated')
+    parser.add_argument('--regions', type=int, default=1, help='Security Hub enabled regions')
+    parser.add_argument('--resources-per-account', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='Latency added to every API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of API calls throttled')
+    parser.add_argument('--api-rate-limit', type=float, default=0.0, help='Calls per second per API before throttling')
+    parser.add_argument('--send-rate', type=float, default=1000.0, help='SES MaxSendRate')
+    parser.add_argument('--env', action='append', default=[], help='KEY=VALUE Lambda environment override')
+    parser.add_argument('--no-memory', action='store_true', help='Do not trace memory (tracemalloc slows the handlers)')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed growth of wall time and memory')
+    parser.add_argument('--verbose', action='store_true', help='Show Lambda logs')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().addHandler(logging.NullHandler())
+        logging.lastResort = None
+    overrides = dict([ env.split('=', 1) for env in args.env ])
+    results = []
+    for accounts, findings in parse_sizes(args.sizes):
+        org = fake_aws.SyntheticOrg(
+            accounts=accounts,
+            findings=findings,
+            regions=args.regions,
+            resources_per_account=args.resources_per_account,
+            latency_ms=args.latency_ms,
+            throttle_rate=args.throttle_rate,
+            api_rate_limit=args.api_rate_limit,
+            send_rate=args.send_rate
+        )
+        fake_aws.install(org)
+        for name in args.lambdas.split(','):
+            result = run_scenario(name, org, overrides, not args.no_memory)
+            results.append(result)
+            print('{} accounts={} findings={}: {:.3f}s, {} calls'.format(
+                name, accounts, findings, result['wall_seconds'], result['api_calls']), file=sys.stderr)
+    regressions = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file)['results'], args.tolerance)
+    print(format_report(results, regressions))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({ 'args': vars(args), 'results': results }, output_file, indent=2)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,638 @@
+#
+# Purpose: Synthetic Security Hub / SES / DynamoDB / STS / Lambda stand-in for the Lambda benchmarks
+# NOTE:
+# - SyntheticOrg describes an organization (accounts, findings, regions); findings are
+#   generated on demand from their index, so 1M findings do not have to be held in memory
+# - install(org) replaces boto3/botocore in sys.modules with fakes backed by the org
+# - Every API call is counted, delayed by latency_ms (+ jitter) and throttled at throttle_rate
+#   (random) or when an API is called more than api_rate_limit times per second (load dependent):
+#   batch DynamoDB calls return unprocessed keys/items, other calls raise ThrottlingException
+# - Server side filtering covers the fields the Lambdas filter on; other filters are ignored
+# - DynamoDB tables are keyed by account_id; put_item / update_item evaluate the simple condition
+#   expressions the Lambdas use and raise ConditionalCheckFailedException
+# - The fake clients do not retry: throttled calls reach the Lambda code as botocore would
+#   after exhausting its retries
+# - Lambda invocations are not run; they are kept in org.invocations
+#
+
+import sys
+import json
+import time
+import types
+import random
+import itertools
+import collections
+import uuid
+import threading
+from datetime import datetime, timedelta, timezone
+
+standard_types = [
+    'Software and Configuration Checks/Industry and Regulatory Standards/AWS-Foundational-Security-Best-Practices',
+    'Effects/Data Exposure/AWS-Foundational-Security-Best-Practices',
+    'Software and Configuration Checks/Industry and Regulatory Standards/CIS AWS Foundations Benchmark'
+]
+other_types = [
+    'Software and Configuration Checks/Vulnerabilities/CVE',
+    'TTPs/Discovery/Recon:EC2-PortProbeUnprotectedPort',
+    'Sensitive Data Identifications/PII'
+]
+severity_labels = [ 'CRITICAL', 'HIGH', 'MEDIUM', 'LOW', 'INFORMATIONAL' ]
+workflow_statuses = [ 'NEW', 'NEW', 'NOTIFIED', 'RESOLVED' ]
+base_time = datetime(2022, 9, 1, tzinfo=timezone.utc)
+
+class ClientError(Exception):
+    # Same shape as botocore.exceptions.ClientError
+    def __init__(self, error_response, operation_name):
+        self.response = error_response
+        self.operation_name = operation_name
+        error = error_response.get('Error', {})
+        super(ClientError, self).__init__('An error occurred ({}) when calling the {} operation: {}'.format(
+            error.get('Code'), operation_name, error.get('Message')))
+
+class FakeEvents(object):
+    # Minimal botocore event emitter: handlers registered for a prefix of the event name
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, event_name, handler, unique_id=None):
+        self.handlers[unique_id or id(handler)] = (event_name, handler)
+
+    def emit(self, event_name, **kwargs):
+        for registered_name, handler in list(self.handlers.values()):
+            if event_name == registered_name or event_name.startswith(registered_name + '.'):
+                handler(event_name=event_name, **kwargs)
+
+class FakeHttpResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+class SyntheticOrg(object):
+    def __init__(self, accounts=10, findings=1000, regions=1, resources_per_account=50,
+                 tech_owner_ratio=0.5, verified_ratio=0.8, latency_ms=0.0, throttle_rate=0.0,
+                 api_rate_limit=0.0, send_rate=1000.0, seed=1):
+        self.account_ids = [ '{:012d}'.format(100000000000 + idx) for idx in range(accounts) ]
+        self.account_index = { account_id: idx for idx, account_id in enumerate(self.account_ids) }
+        self.findings = findings
+        self.regions = [ 'us-east-1', 'us-west-2', 'eu-west-1', 'eu-central-1', 'ap-southeast-2' ][:max(1, regions)]
+        self.available_regions = self.regions + [ 'sa-east-1', 'ca-central-1' ]
+        self.home_region = self.regions[0]
+        self.resources_per_account = resources_per_account
+        self.tech_owner_ratio = tech_owner_ratio
+        self.verified_ratio = verified_ratio
+        self.latency_ms = latency_ms
+        self.throttle_rate = throttle_rate
+        self.api_rate_limit = api_rate_limit
+        self.recent_calls = {}
+        self.send_rate = send_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.calls = {}
+        self.throttled = {}
+        self.calls_lock = threading.Lock()
+        self.events = FakeEvents()
+        self.cursors = {}
+        self.tables = {}
+        self.tables_lock = threading.Lock()
+        self.identities = {}
+        self.invocations = []
+        # (aggregation region, RegionLinkingMode, Regions) of a finding aggregator, or None
+        self.finding_aggregator = None
+        # Latest version of findings updated after generation (update_findings), by Id
+        self.updated_findings = {}
+        for idx, account_id in enumerate(self.account_ids):
+            if idx < accounts * tech_owner_ratio:
+                self.put_item('sh-members', { 'account_id': { 'S': account_id }, 'tech_owner_email': { 'S': self.tech_owner_email(account_id) } })
+            if idx < accounts * verified_ratio:
+                self.identities[self.account_email(account_id)] = 'Success'
+
+    # organization model
+
+    def account_email(self, account_id):
+        return 'owner+{}@example.com'.format(account_id)
+
+    def tech_owner_email(self, account_id):
+        return 'tech+{}@example.com'.format(account_id)
+
+    def account_findings(self, account_idx):
+        # findings are spread evenly; the first accounts take the remainder
+        count, remainder = divmod(self.findings, max(len(self.account_ids), 1))
+        return count + (1 if account_idx < remainder else 0)
+
+    def resource_id(self, account_id, region, resource_idx):
+        return 'arn:aws:ec2:{}:{}:instance/i-{:017x}'.format(region, account_id, resource_idx)
+
+    def finding_region(self, finding_idx):
+        return self.regions[finding_idx % len(self.regions)]
+
+    def finding(self, account_idx, finding_idx):
+        finding = self.generated_finding(account_idx, finding_idx)
+        return self.updated_findings.get(finding['Id'], finding)
+
+    def update_findings(self, findings):
+        # Findings as Security Hub holds them after these updates (newest UpdatedAt wins)
+        for finding in findings:
+            current = self.updated_findings.get(finding['Id'])
+            if current is None or finding['UpdatedAt'] >= current['UpdatedAt']:
+                self.updated_findings[finding['Id']] = finding
+
+    def generated_finding(self, account_idx, finding_idx):
+        account_id = self.account_ids[account_idx]
+        region = self.finding_region(finding_idx)
+        seed = account_idx * 7919 + finding_idx
+        types_ = [ standard_types[seed % len(standard_types)] ]
+        if seed % 5 == 0:
+            types_.append(other_types[seed % len(other_types)])
+        observed_at = base_time - timedelta(minutes=finding_idx)
+        return {
+            'Id': 'arn:aws:securityhub:{}:{}:finding/{:08d}-{:08d}'.format(region, account_id, account_idx, finding_idx),
+            'AwsAccountId': account_id,
+            'Region': region,
+            'ProductName': 'Security Hub' if seed % 3 else 'GuardDuty',
+            'Types': types_,
+            'Severity': { 'Label': severity_labels[seed % len(severity_labels)] },
+            'Compliance': { 'Status': 'FAILED' if seed % 4 else 'PASSED' },
+            'RecordState': 'ACTIVE' if seed % 11 else 'ARCHIVED',
+            'Workflow': { 'Status': workflow_statuses[seed % len(workflow_statuses)] },
+            'Resources': [ { 'Id': self.resource_id(account_id, region, finding_idx % self.resources_per_account), 'Region': region } ],
+            'UpdatedAt': observed_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'LastObservedAt': observed_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        }
+
+    def iter_findings(self, region, filters):
+        # Findings of a region matching filters, newest first per resource
+        account_ids = filter_values(filters, 'AwsAccountId')
+        resource_ids = filter_values(filters, 'ResourceId')
+        if resource_ids is not None:
+            for finding_idx, account_idx in self.iter_resource_findings(resource_ids):
+                finding = self.finding(account_idx, finding_idx)
+                if finding['Region'] == region and matches(finding, filters):
+                    yield finding
+            return
+        account_idxs = range(len(self.account_ids))
+        if account_ids is not None:
+            account_idxs = sorted([ self.account_index[account_id] for account_id in account_ids if account_id in self.account_index ])
+        step = len(self.regions)
+        offset = self.regions.index(region) if region in self.regions else None
+        if offset is None:
+            return
+        for account_idx in account_idxs:
+            for finding_idx in range(offset, self.account_findings(account_idx), step):
+                finding = self.finding(account_idx, finding_idx)
+                if matches(finding, filters):
+                    yield finding
+
+    def iter_resource_findings(self, resource_ids):
+        # (finding_idx, account_idx) of the findings of resource_ids, interleaved so
+        # that LastObservedAt is descending across all the resources
+        positions = []
+        for resource_id in resource_ids:
+            parts = resource_id.split(':')
+            account_idx = self.account_index.get(parts[4]) if len(parts) > 5 else None
+            if account_idx is None:
+                continue
+            resource_idx = int(parts[5].rsplit('-', 1)[-1], 16)
+            positions.append((account_idx, resource_idx))
+        finding_idx = 0
+        while positions:
+            remaining = []
+            for account_idx, resource_idx in positions:
+                idx = finding_idx + resource_idx
+                if idx < self.account_findings(account_idx):
+                    yield idx, account_idx
+                    remaining.append((account_idx, resource_idx))
+            positions = remaining
+            finding_idx += self.resources_per_account
+
+    def insight_results(self):
+        # GetInsightResults returns at most 100 group by values
+        results = []
+        for account_idx, account_id in enumerate(self.account_ids):
+            for resource_idx in range(min(self.resources_per_account, self.account_findings(account_idx))):
+                region = self.finding_region(resource_idx)
+                results.append({
+                    'GroupByAttributeValue': self.resource_id(account_id, region, resource_idx),
+                    'Count': max(1, self.account_findings(account_idx) // self.resources_per_account)
+                })
+                if len(results) == 100:
+                    return results
+        return results
+
+    def put_item(self, table_name, item):
+        with self.tables_lock:
+            self.tables.setdefault(table_name, {})[item['account_id']['S']] = item
+
+    # call accounting
+
+    def record_call(self, service, operation, batch=False):
+        # Count the call, wait for its latency and decide whether it is throttled
+        with self.calls_lock:
+            key = '{}.{}'.format(service, operation)
+            self.calls[key] = self.calls.get(key, 0) + 1
+        event_suffix = '{}.{}'.format(service, ''.join([ part.title() for part in operation.split('_') ]))
+        context = {}
+        self.events.emit('before-call.' + event_suffix, context=context)
+        if self.latency_ms > 0:
+            with self.random_lock:
+                jitter = self.random.uniform(0, self.latency_ms / 2)
+            time.sleep((self.latency_ms + jitter) / 1000.0)
+        throttled = False
+        if self.throttle_rate > 0:
+            with self.random_lock:
+                throttled = self.random.random() < self.throttle_rate
+        if self.api_rate_limit > 0 and not throttled:
+            with self.calls_lock:
+                now = time.monotonic()
+                recent = self.recent_calls.setdefault(key, collections.deque())
+                while recent and now - recent[0] > 1.0:
+                    recent.popleft()
+                throttled = len(recent) >= self.api_rate_limit
+                if not throttled:
+                    recent.append(now)
+        if throttled:
+            with self.calls_lock:
+                self.throttled[key] = self.throttled.get(key, 0) + 1
+            if not batch:
+                error_response = { 'Error': { 'Code': 'ThrottlingException', 'Message': 'Rate exceeded' }, 'ResponseMetadata': { 'RetryAttempts': 0 } }
+                self.events.emit('needs-retry.' + event_suffix, response=(FakeHttpResponse(400), error_response), attempts=1)
+                self.events.emit('after-call.' + event_suffix, http_response=FakeHttpResponse(400), parsed=error_response, context=context)
+                raise ClientError(error_response, operation)
+            self.events.emit('after-call.' + event_suffix, http_response=FakeHttpResponse(200), parsed={ 'ResponseMetadata': { 'RetryAttempts': 0 } }, context=context)
+            return True
+        self.events.emit('after-call.' + event_suffix, http_response=FakeHttpResponse(200), parsed={ 'ResponseMetadata': { 'RetryAttempts': 0 } }, context=context)
+        return False
+
+    def reset_counters(self):
+        with self.calls_lock:
+            self.calls = {}
+            self.throttled = {}
+
+def filter_values(filters, field):
+    if field not in filters:
+        return None
+    return [ condition['Value'] for condition in filters[field] if condition.get('Comparison', 'EQUALS') == 'EQUALS' ]
+
+finding_fields = {
+    'AwsAccountId': lambda finding: [ finding['AwsAccountId'] ],
+    'ResourceId': lambda finding: [ resource['Id'] for resource in finding['Resources'] ],
+    'ComplianceStatus': lambda finding: [ finding['Compliance']['Status'] ],
+    'RecordState': lambda finding: [ finding['RecordState'] ],
+    'WorkflowStatus': lambda finding: [ finding['Workflow']['Status'] ],
+    'SeverityLabel': lambda finding: [ finding['Severity']['Label'] ],
+    'ProductName': lambda finding: [ finding['ProductName'] ],
+    'Type': lambda finding: finding['Types']
+}
+
+def matches(finding, filters):
+    for field, conditions in filters.items():
+        if field == 'UpdatedAt':
+            for condition in conditions:
+                if 'Start' in condition and finding['UpdatedAt'] < condition['Start']:
+                    return False
+                if 'End' in condition and finding['UpdatedAt'] > condition['End']:
+                    return False
+            continue
+        if field not in finding_fields:
+            continue
+        values = finding_fields[field](finding)
+        equals = [ condition['Value'] for condition in conditions if condition.get('Comparison', 'EQUALS') == 'EQUALS' ]
+        prefixes = [ condition['Value'] for condition in conditions if condition.get('Comparison') == 'PREFIX' ]
+        if (equals or prefixes) and not any([ value in equals or any([ value.startswith(prefix) for prefix in prefixes ]) for value in values ]):
+            return False
+    return True
+
+def attribute_value(value):
+    # Plain value of an S or N DynamoDB attribute
+    if 'N' in value:
+        return float(value['N'])
+    return value.get('S')
+
+def condition_matches(item, expression, values):
+    # DynamoDB ConditionExpression: terms joined by OR / AND (AND binds first, no parentheses),
+    # each attribute_exists(name), attribute_not_exists(name) or name <op> :value
+    if not expression:
+        return True
+    return any([ all([ term_matches(item, term.strip(), values) for term in clause.split(' AND ') ]) for clause in expression.split(' OR ') ])
+
+def term_matches(item, term, values):
+    for function, exists in (('attribute_exists(', True), ('attribute_not_exists(', False)):
+        if term.startswith(function):
+            return (term[len(function):-1].strip() in item) == exists
+    name, operator, placeholder = term.split()
+    if name not in item:
+        return False
+    left = attribute_value(item[name])
+    right = attribute_value(values[placeholder])
+    return {
+        '=': lambda: left == right,
+        '<>': lambda: left != right,
+        '<': lambda: left < right,
+        '<=': lambda: left <= right,
+        '>': lambda: left > right,
+        '>=': lambda: left >= right
+    }[operator]()
+
+def check_condition(item, expression, values, operation_name):
+    if not condition_matches(item, expression, values):
+        raise ClientError({
+            'Error': { 'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed' },
+            'ResponseMetadata': { 'HTTPStatusCode': 400 }
+        }, operation_name)
+
+class FakePaginator(object):
+    # Same loop as a botocore paginator: one call per page, following NextToken
+    limit_keys = { 'list_identities': 'MaxItems' }
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        pagination = kwargs.pop('PaginationConfig', {})
+        if 'PageSize' in pagination:
+            kwargs[self.limit_keys.get(self.operation, 'MaxResults')] = pagination['PageSize']
+        method = getattr(self.client, self.operation)
+        while True:
+            page = method(**kwargs)
+            yield page
+            if 'NextToken' not in page:
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+class FakeServiceModel(object):
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+class FakeMeta(object):
+    def __init__(self, region_name, service_name):
+        self.region_name = region_name
+        self.service_model = FakeServiceModel(service_name)
+
+class FakeClient(object):
+    page_sizes = { 'list_members': 50, 'list_identities': 1000, 'get_findings': 100, 'get_insights': 100 }
+
+    def __init__(self, org, service, region_name=None):
+        self.org = org
+        self.service = service
+        self.meta = FakeMeta(region_name or org.home_region, service)
+        self.meta.events = org.events
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+    def paginate_items(self, operation, kwargs):
+        if operation == 'list_members':
+            return 'Members', (
+                { 'AccountId': account_id, 'Email': self.org.account_email(account_id), 'MemberStatus': 'Enabled' }
+                for account_id in self.org.account_ids
+            )
+        if operation == 'get_findings':
+            return 'Findings', self.org.iter_findings(self.meta.region_name, kwargs.get('Filters', {}))
+        if operation == 'get_insights':
+            return 'Insights', iter([ { 'InsightArn': arn, 'Name': 'Failed resources', 'GroupByAttribute': 'ResourceId' } for arn in kwargs.get('InsightArns', []) ])
+        if operation == 'list_identities':
+            return 'Identities', iter(list(self.org.identities))
+        raise NotImplementedError(operation)
+
+    # Security Hub
+
+    def get_page(self, operation, kwargs, limit_key='MaxResults'):
+        # One page of a list operation; NextToken is a server side cursor into the results
+        self.org.record_call(self.service, operation)
+        token = kwargs.pop('NextToken', None)
+        limit = kwargs.pop(limit_key, None) or self.page_sizes[operation]
+        if token is not None:
+            items_key, items = self.org.cursors.pop(token)
+        else:
+            items_key, items = self.paginate_items(operation, kwargs)
+        page = list(itertools.islice(items, limit))
+        response = { items_key: page }
+        lookahead = list(itertools.islice(items, 1))
+        if lookahead:
+            token = uuid.uuid4().hex
+            self.org.cursors[token] = (items_key, itertools.chain(lookahead, items))
+            response['NextToken'] = token
+        return response
+
+    def list_members(self, **kwargs):
+        return self.get_page('list_members', kwargs)
+
+    def get_insights(self, **kwargs):
+        return self.get_page('get_insights', kwargs)
+
+    def list_identities(self, **kwargs):
+        return self.get_page('list_identities', kwargs, 'MaxItems')
+
+    def get_findings(self, **kwargs):
+        return self.get_page('get_findings', kwargs)
+
+    def get_insight_results(self, InsightArn):
+        self.org.record_call(self.service, 'get_insight_results')
+        return { 'InsightResults': { 'InsightArn': InsightArn, 'GroupByAttribute': 'ResourceId', 'ResultValues': self.org.insight_results() } }
+
+    def describe_hub(self, **kwargs):
+        self.org.record_call(self.service, 'describe_hub')
+        if self.meta.region_name not in self.org.regions:
+            raise ClientError({ 'Error': { 'Code': 'InvalidAccessException', 'Message': 'Not subscribed' } }, 'DescribeHub')
+        return { 'HubArn': 'arn:aws:securityhub:{}:000000000000:hub/default'.format(self.meta.region_name) }
+
+    def list_finding_aggregators(self, **kwargs):
+        self.org.record_call(self.service, 'list_finding_aggregators')
+        if self.org.finding_aggregator is None:
+            return { 'FindingAggregators': [] }
+        return { 'FindingAggregators': [ { 'FindingAggregatorArn': self.finding_aggregator_arn() } ] }
+
+    def get_finding_aggregator(self, FindingAggregatorArn):
+        self.org.record_call(self.service, 'get_finding_aggregator')
+        aggregation_region, linking_mode, regions = self.org.finding_aggregator
+        if self.meta.region_name != aggregation_region:
+            raise ClientError({ 'Error': { 'Code': 'InvalidInputException', 'Message': 'Not the aggregation Region' } }, 'GetFindingAggregator')
+        return {
+            'FindingAggregatorArn': FindingAggregatorArn,
+            'FindingAggregationRegion': aggregation_region,
+            'RegionLinkingMode': linking_mode,
+            'Regions': list(regions)
+        }
+
+    def finding_aggregator_arn(self):
+        return 'arn:aws:securityhub:{}:000000000000:finding-aggregator/00000000-0000-0000-0000-000000000000'.format(self.org.finding_aggregator[0])
+
+    def get_members(self, AccountIds):
+        self.org.record_call(self.service, 'get_members')
+        return {
+            'Members': [
+                { 'AccountId': account_id, 'Email': self.org.account_email(account_id), 'MemberStatus': 'Enabled' }
+                for account_id in AccountIds if account_id in self.org.account_index
+            ],
+            'UnprocessedAccounts': [
+                { 'AccountId': account_id, 'ProcessingResult': 'Not a member' }
+                for account_id in AccountIds if account_id not in self.org.account_index
+            ]
+        }
+
+    # DynamoDB
+
+    def batch_get_item(self, RequestItems):
+        throttled = self.org.record_call(self.service, 'batch_get_item', batch=True)
+        responses = {}
+        unprocessed = {}
+        for table_name, request in RequestItems.items():
+            keys = request['Keys']
+            if throttled:
+                unprocessed[table_name] = dict(request, Keys=keys[len(keys) // 2:])
+                keys = keys[:len(keys) // 2]
+            table = self.org.tables.get(table_name, {})
+            items = [ table[key['account_id']['S']] for key in keys if key['account_id']['S'] in table ]
+            if 'ProjectionExpression' in request:
+                names = [ name.strip() for name in request['ProjectionExpression'].split(',') ]
+                items = [ { name: item[name] for name in names if name in item } for item in items ]
+            responses[table_name] = items
+        return { 'Responses': responses, 'UnprocessedKeys': unprocessed }
+
+    def batch_write_item(self, RequestItems):
+        throttled = self.org.record_call(self.service, 'batch_write_item', batch=True)
+        unprocessed = {}
+        for table_name, requests in RequestItems.items():
+            if throttled:
+                unprocessed[table_name] = requests[len(requests) // 2:]
+                requests = requests[:len(requests) // 2]
+            for request in requests:
+                self.org.put_item(table_name, request['PutRequest']['Item'])
+        return { 'UnprocessedItems': unprocessed }
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        self.org.record_call(self.service, 'put_item')
+        with self.org.tables_lock:
+            table = self.org.tables.setdefault(TableName, {})
+            check_condition(table.get(Item['account_id']['S'], {}), ConditionExpression, ExpressionAttributeValues or {}, 'PutItem')
+            table[Item['account_id']['S']] = Item
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeValues=None):
+        # UpdateExpression: a single SET name = :value, .. or REMOVE name, .. clause
+        self.org.record_call(self.service, 'update_item')
+        values = ExpressionAttributeValues or {}
+        with self.org.tables_lock:
+            table = self.org.tables.setdefault(TableName, {})
+            item = dict(table.get(Key['account_id']['S'], Key))
+            check_condition(table.get(Key['account_id']['S'], {}), ConditionExpression, values, 'UpdateItem')
+            action, assignments = UpdateExpression.split(' ', 1)
+            for assignment in assignments.split(','):
+                if action == 'SET':
+                    name, placeholder = [ part.strip() for part in assignment.split('=') ]
+                    item[name] = values[placeholder]
+                else:
+                    item.pop(assignment.strip(), None)
+            table[Key['account_id']['S']] = item
+        return {}
+
+    # SES
+
+    def get_send_quota(self):
+        self.org.record_call(self.service, 'get_send_quota')
+        return { 'Max24HourSend': 200000.0, 'MaxSendRate': self.org.send_rate, 'SentLast24Hours': 0.0 }
+
+    def get_identity_verification_attributes(self, Identities):
+        self.org.record_call(self.service, 'get_identity_verification_attributes')
+        return { 'VerificationAttributes': {
+            identity: { 'VerificationStatus': self.org.identities[identity] }
+            for identity in Identities if identity in self.org.identities
+        } }
+
+    def verify_email_identity(self, EmailAddress):
+        self.org.record_call(self.service, 'verify_email_identity')
+        self.org.identities[EmailAddress] = 'Pending'
+        return {}
+
+    def get_template(self, TemplateName):
+        self.org.record_call(self.service, 'get_template')
+        return { 'Template': {
+            'TemplateName': TemplateName,
+            'SubjectPart': 'Security Hub Summary for {{member_account}}',
+            'HtmlPart': '<h1>{{member_account}}</h1>{{#each severity_count}}<p>{{standard_type}}</p>{{/each}}',
+            'TextPart': '{{member_account}}'
+        } }
+
+    def send_templated_email(self, **kwargs):
+        self.org.record_call(self.service, 'send_templated_email')
+        return { 'MessageId': 'message-id' }
+
+    def send_email(self, **kwargs):
+        self.org.record_call(self.service, 'send_email')
+        return { 'MessageId': 'message-id' }
+
+    def send_bulk_templated_email(self, Destinations, **kwargs):
+        self.org.record_call(self.service, 'send_bulk_templated_email')
+        return { 'Status': [ { 'Status': 'Success', 'MessageId': 'message-id' } for destination in Destinations ] }
+
+    # Lambda
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b'{}', **kwargs):
+        self.org.record_call(self.service, 'invoke')
+        with self.org.calls_lock:
+            self.org.invocations.append({ 'FunctionName': FunctionName, 'InvocationType': InvocationType, 'Payload': json.loads(Payload) })
+        return { 'StatusCode': 202 if InvocationType == 'Event' else 200 }
+
+    # STS
+
+    def get_caller_identity(self):
+        self.org.record_call(self.service, 'get_caller_identity')
+        return { 'Account': '000000000000', 'Arn': 'arn:aws:iam::000000000000:user/bench' }
+
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self.org.record_call(self.service, 'assume_role')
+        return { 'Credentials': {
+            'AccessKeyId': 'AKIA', 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+            'Expiration': datetime.now(timezone.utc) + timedelta(hours=1)
+        } }
+
+    def __getattr__(self, operation):
+        raise AttributeError('{}.{} is not simulated'.format(self.service, operation))
+
+def install(org):
+    # Replace boto3 and botocore with fakes backed by org; returns the previous modules
+    def client(service_name, region_name=None, **kwargs):
+        return FakeClient(org, service_name, region_name)
+
+    class Session(object):
+        def __init__(self, **kwargs):
+            self.region_name = kwargs.get('region_name', org.home_region)
+            self.events = org.events
+
+        def client(self, service_name, region_name=None, **kwargs):
+            return FakeClient(org, service_name, region_name or self.region_name)
+
+        def get_available_regions(self, service_name):
+            return list(org.available_regions)
+
+    class Config(object):
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+
+        def merge(self, other):
+            return Config(**dict(self.kwargs, **other.kwargs))
+
+    boto3 = types.ModuleType('boto3')
+    boto3.Session = Session
+    boto3.client = client
+    botocore = types.ModuleType('botocore')
+    botocore_config = types.ModuleType('botocore.config')
+    botocore_config.Config = Config
+    botocore_exceptions = types.ModuleType('botocore.exceptions')
+    botocore_exceptions.ClientError = ClientError
+    botocore.config = botocore_config
+    botocore.exceptions = botocore_exceptions
+    modules = {
+        'boto3': boto3,
+        'botocore': botocore,
+        'botocore.config': botocore_config,
+        'botocore.exceptions': botocore_exceptions
+    }
+    # urllib3 ships with botocore; the collectors import it without using it
+    try:
+        import urllib3
+    except ImportError:
+        modules['urllib3'] = types.ModuleType('urllib3')
+    previous = { name: sys.modules.get(name) for name in modules }
+    sys.modules.update(modules)
+    return previous
@@ -0,0 +1,222 @@
+#
+# Purpose: Replay Security Hub "Findings - Imported" events through sh-findings-stream
+# NOTE:
+# - Events are read from JSON files (one event, a list of events, an SQS event or NDJSON) or
+#   generated from a synthetic organization (--generate; --record writes them for later replays)
+# - Events are grouped into micro-batches of --window-seconds by their time, as the SQS event
+#   source batching window does, and each batch is one invocation of the handler
+# - --redeliver N adds up to N events of earlier batches to every batch: older finding versions
+#   delivered late, as an SQS queue may, which must not replace the newer ones already counted
+# - By default bench/fake_aws.py stands in for AWS, with local summary state in a temporary
+#   directory seeded by an incremental summary of every account (--no-seed starts empty);
+#   the fake organization takes each batch's finding updates before the batch is replayed.
+#   --aws uses boto3 and the environment as is
+# - With the fake (unless --no-verify) every batch is replayed a second time, which must leave
+#   the stored counts unchanged and raise no alerts, and the stored counts of every account are
+#   compared with a recount (count_findings); the exit status is 1 when a check fails
+# - Reports per batch: events, findings, accounts updated, threshold alerts, notifications,
+#   API calls, accounts differing from the recount and the result of the replay
+# - Usage: python bench/replay_findings_events.py --generate 500 --window-seconds 60 --redeliver 5 --notify
+#
+
+import os
+import sys
+import json
+import uuid
+import random
+import logging
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timedelta
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, bench_dir)
+
+import fake_aws
+import bench_lambdas
+
+def read_events(path):
+    with open(path) as events_file:
+        text = events_file.read()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return [ json.loads(line) for line in text.splitlines() if line.strip() ]
+    if isinstance(data, list):
+        return data
+    if 'Records' in data:
+        return [ json.loads(record['body']) for record in data['Records'] ]
+    return [ data ]
+
+def generate_events(org, count, duration_seconds, seed):
+    # Findings of random accounts escalated to HIGH/CRITICAL (or resolved), one per event
+    rng = random.Random(seed)
+    events = []
+    for idx in range(count):
+        account_idx = rng.randrange(len(org.account_ids))
+        finding = org.finding(account_idx, rng.randrange(max(1, org.account_findings(account_idx))))
+        at = fake_aws.base_time + timedelta(seconds=duration_seconds * idx / max(1, count))
+        if rng.random() < 0.8:
+            finding.update({
+                'Severity': { 'Label': rng.choice([ 'CRITICAL', 'HIGH' ]) },
+                'Compliance': { 'Status': 'FAILED' },
+                'RecordState': 'ACTIVE',
+                'Workflow': { 'Status': 'NEW' },
+                'Types': [ fake_aws.standard_types[idx % len(fake_aws.standard_types)] ]
+            })
+        else:
+            finding.update({ 'Workflow': { 'Status': 'RESOLVED' } })
+        finding['UpdatedAt'] = at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        events.append({
+            'version': '0',
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'detail-type': 'Security Hub Findings - Imported',
+            'source': 'aws.securityhub',
+            'account': '000000000000',
+            'time': at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'region': finding['Region'],
+            'resources': [ finding['Id'] ],
+            'detail': { 'findings': [ finding ] }
+        })
+    return events
+
+def event_time(event):
+    return datetime.strptime(event['time'], '%Y-%m-%dT%H:%M:%SZ')
+
+def micro_batches(events, window_seconds):
+    # Consecutive events within window_seconds of the first event of their batch
+    batches = []
+    for event in sorted(events, key=event_time):
+        if len(batches) == 0 or (event_time(event) - event_time(batches[-1][0])).total_seconds() >= window_seconds:
+            batches.append([])
+        batches[-1].append(event)
+    return batches
+
+def redeliver(batches, count, seed):
+    # Up to count events of earlier batches appended to every batch
+    rng = random.Random(seed)
+    delivered = []
+    redelivered = []
+    for batch in batches:
+        redelivered.append(batch + rng.sample(delivered, min(count, len(delivered))))
+        delivered.extend(batch)
+    return redelivered
+
+def stored_counts(collector, accounts):
+    account_states = collector.get_summary_store().get_account_states(accounts)
+    return { member_account: account_state['counts'] for member_account, account_state in account_states.items() }
+
+def recount_mismatches(collector, accounts_counts):
+    # Accounts whose stored counts differ from a full count of their findings
+    if len(accounts_counts) == 0:
+        return []
+    sh_admin_client = collector.sh_retry.get_client(collector.session, 'securityhub')
+    recounts = collector.count_findings(sh_admin_client, sorted(accounts_counts))
+    return [ member_account for member_account in sorted(accounts_counts) if accounts_counts[member_account] != recounts.get(member_account, {}) ]
+
+def to_sqs_event(events):
+    return {
+        'Records': [
+            {
+                'messageId': event.get('id', str(uuid.uuid4())),
+                'body': json.dumps(event),
+                'eventSource': 'aws:sqs'
+            } for event in events
+        ]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Security Hub finding events through sh-findings-stream')
+    parser.add_argument('events', nargs='*', help='Event JSON files')
+    parser.add_argument('--generate', type=int, default=0, help='Generate this many events')
+    parser.add_argument('--duration-seconds', type=float, default=600.0, help='Time span of generated events')
+    parser.add_argument('--record', help='Write the events replayed to this file (NDJSON)')
+    parser.add_argument('--window-seconds', type=float, default=60.0, help='Micro-batch window')
+    parser.add_argument('--redeliver', type=int, default=0, help='Events of earlier batches added to every batch')
+    parser.add_argument('--no-verify', action='store_true', help='Skip the replay and recount checks')
+    parser.add_argument('--accounts', type=int, default=20)
+    parser.add_argument('--findings', type=int, default=2000)
+    parser.add_argument('--regions', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-seed', action='store_true', help='Start without stored summaries')
+    parser.add_argument('--notify', action='store_true', help='Set notify_function_name (fake invocations)')
+    parser.add_argument('--aws', action='store_true', help='Use boto3 and the current environment')
+    parser.add_argument('--env', action='append', default=[], help='KEY=VALUE Lambda environment override')
+    parser.add_argument('--verbose', action='store_true', help='Show Lambda logs')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().addHandler(logging.NullHandler())
+        logging.lastResort = None
+    org = fake_aws.SyntheticOrg(accounts=args.accounts, findings=args.findings, regions=args.regions, seed=args.seed)
+    events = []
+    for path in args.events:
+        events.extend(read_events(path))
+    if args.generate > 0:
+        events.extend(generate_events(org, args.generate, args.duration_seconds, args.seed))
+    if args.record:
+        with open(args.record, 'w') as record_file:
+            for event in events:
+                record_file.write(json.dumps(event) + '\n')
+    with tempfile.TemporaryDirectory() as work_dir:
+        if not args.aws:
+            fake_aws.install(org)
+            os.environ.update(bench_lambdas.get_environment(work_dir, {}))
+        if args.notify:
+            os.environ['notify_function_name'] = 'SHEmailNotify'
+        os.environ.update(dict([ env.split('=', 1) for env in args.env ]))
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            if not args.aws and not args.no_seed:
+                collector = bench_lambdas.load_lambda('sh-summary-collector')
+                collector.incremental_aggregate(collector.sh_retry.get_client(collector.session, 'securityhub'), collector.get_summary_store(), org.account_ids)
+            module = bench_lambdas.load_lambda('sh-findings-stream')
+        verify = not args.aws and not args.no_verify
+        collector = module.sh_summary_collector
+        lines = [
+            '| Batch | Events | Findings | Accounts | Alerts | Notified | API calls | Recount mismatches | Replay |',
+            '|---:|---:|---:|---:|---:|---:|---:|---:|---|'
+        ]
+        totals = { 'events': 0, 'findings': 0, 'alerts': 0, 'notified': 0, 'mismatches': 0, 'replays_changed': 0 }
+        batches = micro_batches(events, args.window_seconds)
+        if args.redeliver > 0:
+            batches = redeliver(batches, args.redeliver, args.seed)
+        for idx, batch in enumerate(batches):
+            if not args.aws:
+                # Security Hub holds the updated findings by the time their events arrive
+                org.update_findings([ finding for finding_event in batch for finding in finding_event['detail'].get('findings', []) ])
+            org.reset_counters()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                result = module.lambda_handler(to_sqs_event(batch), None)
+            api_calls = sum(org.calls.values())
+            mismatches = []
+            replay = '-'
+            if verify:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    counts = stored_counts(collector, org.account_ids)
+                    replay_result = module.lambda_handler(to_sqs_event(batch), None)
+                    replayed_counts = stored_counts(collector, org.account_ids)
+                    mismatches = recount_mismatches(collector, replayed_counts)
+                replay = 'ok' if replayed_counts == counts and len(replay_result['alerts']) == 0 else 'changed'
+                totals['mismatches'] += len(mismatches)
+                totals['replays_changed'] += 1 if replay == 'changed' else 0
+            lines.append('| {} | {} | {} | {} | {} | {} | {} | {} | {} |'.format(
+                idx + 1, result['event_count'], result['finding_count'], result['account_count'],
+                len(result['alerts']), result['notified_count'], api_calls,
+                len(mismatches) if verify else '-', replay
+            ))
+            totals['events'] += result['event_count']
+            totals['findings'] += result['finding_count']
+            totals['alerts'] += len(result['alerts'])
+            totals['notified'] += result['notified_count']
+    print('\n'.join(lines))
+    print('')
+    print('{} events, {} findings, {} alerts, {} notified, {} invocations'.format(
+        totals['events'], totals['findings'], totals['alerts'], totals['notified'], len(org.invocations)))
+    if verify:
+        print('{} account recount mismatches, {} replayed batches changed the counts'.format(totals['mismatches'], totals['replays_changed']))
+        if totals['mismatches'] > 0 or totals['replays_changed'] > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
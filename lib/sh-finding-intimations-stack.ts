@@ -3,7 +3,9 @@ import { Construct } from 'constructs';
 import * as cdk from 'aws-cdk-lib';
 import * as iam from 'aws-cdk-lib/aws-iam';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
+import * as lambdaes from 'aws-cdk-lib/aws-lambda-event-sources';
 import * as ses from 'aws-cdk-lib/aws-ses';
+import * as s3 from 'aws-cdk-lib/aws-s3';
 import * as sqs from 'aws-cdk-lib/aws-sqs';
 import * as sf from 'aws-cdk-lib/aws-stepfunctions';
 import * as tasks from 'aws-cdk-lib/aws-stepfunctions-tasks';
@@ -20,6 +22,12 @@ export class ShFindingIntimationsStack extends Stack {
     const region = cdk.Stack.of(this).region;
     // Context Keys
     // SenderEmail
+    // ShardSize (Member Accounts per org batch report invocation, default 50)
+    // ShardConcurrency (org batch report invocations in parallel, default 4)
+    // StreamBatchWindow (seconds finding events are collected per sh-findings-stream invocation, default 60)
+    const shardSize = this.node.tryGetContext("ShardSize") ?? 50;
+    const shardConcurrency = this.node.tryGetContext("ShardConcurrency") ?? 4;
+    const streamBatchWindow = this.node.tryGetContext("StreamBatchWindow") ?? 60;
 
     // parameters
     const template_name  = new CfnParameter(this, 'TemplateName', {
@@ -130,6 +138,7 @@ export class ShFindingIntimationsStack extends Stack {
             `arn:aws:lambda:${region}:${accountId}:function:*SHEmailNotify`,
             `arn:aws:lambda:${region}:${accountId}:function:*AddSESIdentity`,
             `arn:aws:lambda:${region}:${accountId}:function:*GetSHMembers`,
+            `arn:aws:lambda:${region}:${accountId}:function:*SHOrgReport`,
           ]
         })
       ]
@@ -244,6 +253,7 @@ export class ShFindingIntimationsStack extends Stack {
         new iam.PolicyStatement({
           actions: [
             "dynamodb:GetItem",
+            "dynamodb:BatchGetItem",
             "dynamodb:Scan",
             "dynamodb:Query"
           ],
@@ -263,6 +273,33 @@ export class ShFindingIntimationsStack extends Stack {
         })
       ]
     });
+    // Summary state of incremental summary mode and sh-findings-stream: summary#<account>
+    // counts and UpdatedAt watermarks, finding#<id> count keys of every finding seen;
+    // digest#<account> digests of the last summary reports sent (digest_store.py)
+    const summaryStateTable = new dyndb.Table(this, 'SHSummaryStateTable', {
+      partitionKey: { name: 'account_id', type: dyndb.AttributeType.STRING },
+      billingMode: dyndb.BillingMode.PAY_PER_REQUEST,
+      encryption: dyndb.TableEncryption.AWS_MANAGED,
+      removalPolicy: cdk.RemovalPolicy.DESTROY
+    });
+    // Run ledger (run#<run_id>#<stage>#<account> items, see run_ledger.py); every scheduled
+    // run records its members, so items expire through the expires_at TTL attribute
+    const runLedgerTable = new dyndb.Table(this, 'SHRunLedgerTable', {
+      partitionKey: { name: 'account_id', type: dyndb.AttributeType.STRING },
+      billingMode: dyndb.BillingMode.PAY_PER_REQUEST,
+      encryption: dyndb.TableEncryption.AWS_MANAGED,
+      timeToLiveAttribute: 'expires_at',
+      removalPolicy: cdk.RemovalPolicy.DESTROY
+    });
+    // Estimated per account costs (cost#<account> items, see shard_planner.py) for balancing
+    // report shards; accounts no longer reported expire through the expires_at TTL attribute
+    const accountCostTable = new dyndb.Table(this, 'SHAccountCostTable', {
+      partitionKey: { name: 'account_id', type: dyndb.AttributeType.STRING },
+      billingMode: dyndb.BillingMode.PAY_PER_REQUEST,
+      encryption: dyndb.TableEncryption.AWS_MANAGED,
+      timeToLiveAttribute: 'expires_at',
+      removalPolicy: cdk.RemovalPolicy.DESTROY
+    });
     // Role for sh-insights-collector lambda
     /*
     const shInsightsCollectorRole = new iam.Role(this, 'SHInsightsCollectorRole',  {
@@ -272,15 +309,40 @@ export class ShFindingIntimationsStack extends Stack {
     shInsightsCollectorRole.attachInlinePolicy(cwPolicy);
     shInsightsCollectorRole.attachInlinePolicy(stsPolicy);
     shInsightsCollectorRole.attachInlinePolicy(shPolicy);
+    // arnparse, precompiled for python3.9 (src/lambda/package-arnparse-layer.sh)
+    const arnparseLayer = new lambda.LayerVersion(this, 'ArnparseLayer', {
+      code: lambda.Code.fromAsset('src/lambda/arnparse-layer.zip'),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_9],
+      description: 'arnparse with precompiled bytecode'
+    });
+    // Work items (account, region, resources) of sh-resource-findings; items failing
+    // maxReceiveCount times move to the DLQ
+    const shResourceWorkDLQ = new sqs.Queue(this, 'SHResourceWorkDLQ', {
+      retentionPeriod: Duration.days(14)
+    });
+    const shResourceWorkQueue = new sqs.Queue(this, 'SHResourceWorkQueue', {
+      deadLetterQueue: {
+        maxReceiveCount: 5,
+        queue: shResourceWorkDLQ
+      },
+      // at least 6 times the consumer timeout
+      visibilityTimeout: Duration.seconds(5400)
+    });
+    shResourceWorkQueue.grantSendMessages(shInsightsCollectorRole);
     // sh-insights-collector
     const shInsightsCollector = new lambda.Function(this, 'SHInsightsCollector', {
       code: lambda.Code.fromAsset('src/lambda/sh-insights-collector.zip'),
       description: 'Lambda to find Security Hub Insight Results for Member Accounts',
       environment: {
-        'log_level': 'INFO'
+        'distribution': 'queue',
+        'log_level': 'INFO',
+        // read: needs 'snapshot_bucket' set to the payload bucket the summary collectors write
+        'snapshot_mode': 'off',
+        'work_queue_url': shResourceWorkQueue.queueUrl
       },
       functionName: 'SHInsightsCollector',
       handler: 'sh-insights-collector.lambda_handler',
+      layers: [arnparseLayer],
       memorySize: 512,
       role: shInsightsCollectorRole,
       runtime: lambda.Runtime.PYTHON_3_9,
@@ -296,12 +358,27 @@ export class ShFindingIntimationsStack extends Stack {
     shResourceFindingsRole.attachInlinePolicy(cwPolicy);
     shResourceFindingsRole.attachInlinePolicy(stsPolicy);
     shResourceFindingsRole.attachInlinePolicy(shPolicy);
+    // Results of the work items, keyed by <account>/<region>/<item_id>.json
+    const shResourceFindingsBucket = new s3.Bucket(this, 'SHResourceFindingsBucket', {
+      blockPublicAccess: s3.BlockPublicAccess.BLOCK_ALL,
+      encryption: s3.BucketEncryption.S3_MANAGED,
+      enforceSSL: true,
+      lifecycleRules: [
+        {
+          expiration: Duration.days(7)
+        }
+      ]
+    });
+    shResourceFindingsBucket.grantWrite(shResourceFindingsRole);
     // sh-resource-findings
     const shResourceFindings = new lambda.Function(this, 'SHResourceFindings', {
       code: lambda.Code.fromAsset('src/lambda/sh-resource-findings.zip'),
       description: 'Lambda to get Security Hub Findings for Member Account Resource',
       environment: {
-        'log_level': 'INFO'
+        'log_level': 'INFO',
+        'result_bucket': shResourceFindingsBucket.bucketName,
+        // read: needs 'snapshot_bucket' set to the payload bucket the summary collectors write
+        'snapshot_mode': 'off'
       },
       functionName: 'SHResourceFindings',
       handler: 'sh-resource-findings.lambda_handler',
@@ -309,6 +386,13 @@ export class ShFindingIntimationsStack extends Stack {
       runtime: lambda.Runtime.PYTHON_3_9,
       timeout: Duration.seconds(900)
     });
+    // Consumers scale out with the queue depth; only failed items of a batch are received again
+    shResourceFindings.addEventSource(new lambdaes.SqsEventSource(shResourceWorkQueue, {
+      batchSize: 10,
+      maxBatchingWindow: Duration.seconds(5),
+      maxConcurrency: 20,
+      reportBatchItemFailures: true
+    }));
     */
     // Role for sh-summary-collector
     const shSummaryCollectorRole = new iam.Role(this, 'SHSummaryCollectorRole', {
@@ -322,7 +406,15 @@ export class ShFindingIntimationsStack extends Stack {
       code: lambda.Code.fromAsset('src/lambda/sh-summary-collector.zip'),
       description: 'Lambda to get Security Hub summary data for Member Account',
       environment: {
-        'log_level': 'INFO'
+        'log_level': 'INFO',
+        // scheduled runs reconcile the counts sh-findings-stream updates: findings updated
+        // since the last run (events lost to the DLQ included) and a full recount every 28 days
+        'incremental': 'true',
+        'recount_days': '28',
+        'snapshot_mode': 'off',
+        'summary_table_name': summaryStateTable.tableName,
+        'ledger_table_name': runLedgerTable.tableName,
+        'cost_table_name': accountCostTable.tableName
       },
       functionName: 'SHSummaryCollector',
       handler: 'sh-summary-collector.lambda_handler',
@@ -330,6 +422,17 @@ export class ShFindingIntimationsStack extends Stack {
       runtime: lambda.Runtime.PYTHON_3_9,
       timeout: Duration.seconds(900)
     });
+    // Bucket for Lambda payloads too large for Step Functions state
+    const payloadBucket = new s3.Bucket(this, 'SHPayloadBucket', {
+      blockPublicAccess: s3.BlockPublicAccess.BLOCK_ALL,
+      encryption: s3.BucketEncryption.S3_MANAGED,
+      enforceSSL: true,
+      lifecycleRules: [
+        {
+          expiration: Duration.days(7)
+        }
+      ]
+    });
     // Role for sh-email-notify
     const shEmailNotifyRole = new iam.Role(this, 'SHEmailNotifyRole', {
       assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
@@ -344,7 +447,10 @@ export class ShFindingIntimationsStack extends Stack {
       environment: {
         'log_level': 'INFO',
         'sender_email': this.node.tryGetContext("SenderEmail"),
-        'template_name': template_name.valueAsString
+        'template_name': template_name.valueAsString,
+        'suppress_unchanged': 'true',
+        'digest_table_name': summaryStateTable.tableName,
+        'ledger_table_name': runLedgerTable.tableName
       },
       functionName: 'SHEmailNotify',
       handler: 'sh-email-notify.lambda_handler',
@@ -370,7 +476,8 @@ export class ShFindingIntimationsStack extends Stack {
       handler: 'add-ses-identity.lambda_handler',
       role: addSesIdentityRole,
       runtime: lambda.Runtime.PYTHON_3_9,
-      timeout: Duration.seconds(60)
+      // batch mode checks and adds the identities of every member in one invocation
+      timeout: Duration.seconds(900)
     });
     // Role for get-sh-members
     const getShMembersRole = new iam.Role(this, 'GetSHMembersRole', {
@@ -386,7 +493,8 @@ export class ShFindingIntimationsStack extends Stack {
       description: 'Lambda to get SecurityHub Members',
       environment: {
         'log_level': 'INFO',
-        'table_name': dyndb_table_name.valueAsString
+        'table_name': dyndb_table_name.valueAsString,
+        'cost_table_name': accountCostTable.tableName
       },
       functionName: 'GetSHMembers',
       handler: 'get-sh-members.lambda_handler',
@@ -394,6 +502,122 @@ export class ShFindingIntimationsStack extends Stack {
       runtime: lambda.Runtime.PYTHON_3_9,
       timeout: Duration.seconds(300)
     });
+    payloadBucket.grantReadWrite(getShMembers);
+    payloadBucket.grantRead(addSesIdentity);
+    getShMembers.addEnvironment('payload_bucket', payloadBucket.bucketName);
+    // findings snapshots (snapshot_mode) are shared by every container through the bucket
+    payloadBucket.grantReadWrite(shSummaryCollector);
+    shSummaryCollector.addEnvironment('snapshot_bucket', payloadBucket.bucketName);
+    // Role for sh-org-report
+    const shOrgReportRole = new iam.Role(this, 'SHOrgReportRole', {
+      assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
+      description: 'Role for SHOrgReport Lambda'
+    });
+    shOrgReportRole.attachInlinePolicy(cwPolicy);
+    shOrgReportRole.attachInlinePolicy(shPolicy);
+    shOrgReportRole.attachInlinePolicy(sesPolicy);
+    shOrgReportRole.attachInlinePolicy(dyndbPolicy);
+    // sh-org-report
+    const shOrgReport = new lambda.Function(this, 'SHOrgReport', {
+      code: lambda.Code.fromAsset('src/lambda/sh-org-report.zip'),
+      description: 'Lambda to collect and email Security Hub summary reports for a shard of Member Accounts',
+      environment: {
+        'log_level': 'INFO',
+        'incremental': 'true',
+        'recount_days': '28',
+        'snapshot_mode': 'off',
+        'summary_table_name': summaryStateTable.tableName,
+        'table_name': dyndb_table_name.valueAsString,
+        'sender_email': this.node.tryGetContext("SenderEmail"),
+        'template_name': template_name.valueAsString,
+        'suppress_unchanged': 'true',
+        'digest_table_name': summaryStateTable.tableName,
+        'ledger_table_name': runLedgerTable.tableName,
+        'cost_table_name': accountCostTable.tableName,
+        'payload_bucket': payloadBucket.bucketName,
+        'snapshot_bucket': payloadBucket.bucketName
+      },
+      functionName: 'SHOrgReport',
+      handler: 'sh-org-report.lambda_handler',
+      memorySize: 1024,
+      role: shOrgReportRole,
+      runtime: lambda.Runtime.PYTHON_3_9,
+      timeout: Duration.seconds(900)
+    });
+    payloadBucket.grantReadWrite(shOrgReport);
+    runLedgerTable.grantReadWriteData(shSummaryCollector);
+    runLedgerTable.grantReadWriteData(shEmailNotify);
+    runLedgerTable.grantReadWriteData(shOrgReport);
+    summaryStateTable.grantReadWriteData(shSummaryCollector);
+    summaryStateTable.grantReadWriteData(shEmailNotify);
+    summaryStateTable.grantReadWriteData(shOrgReport);
+    accountCostTable.grantReadData(getShMembers);
+    accountCostTable.grantReadWriteData(shSummaryCollector);
+    accountCostTable.grantReadWriteData(shOrgReport);
+    // Security Hub finding events, collected for sh-findings-stream micro-batches
+    const shFindingEventsDLQ = new sqs.Queue(this, 'SHFindingEventsDLQ', {
+      retentionPeriod: Duration.days(14)
+    });
+    const shFindingEventsQueue = new sqs.Queue(this, 'SHFindingEventsQueue', {
+      deadLetterQueue: {
+        maxReceiveCount: 3,
+        queue: shFindingEventsDLQ
+      },
+      // at least 6 times the consumer timeout
+      visibilityTimeout: Duration.seconds(1800)
+    });
+    // Role for sh-findings-stream
+    const shFindingsStreamRole = new iam.Role(this, 'SHFindingsStreamRole', {
+      assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
+      description: 'Role for SHFindingsStream Lambda'
+    });
+    shFindingsStreamRole.attachInlinePolicy(cwPolicy);
+    shFindingsStreamRole.attachInlinePolicy(shPolicy);
+    shFindingsStreamRole.attachInlinePolicy(dyndbPolicy);
+    // sh-findings-stream
+    const shFindingsStream = new lambda.Function(this, 'SHFindingsStream', {
+      code: lambda.Code.fromAsset('src/lambda/sh-findings-stream.zip'),
+      description: 'Lambda to apply Security Hub finding events to Member Account summaries',
+      environment: {
+        'log_level': 'INFO',
+        'summary_table_name': summaryStateTable.tableName,
+        'table_name': dyndb_table_name.valueAsString,
+        'high_threshold': '10',
+        'critical_threshold': '1',
+        'notify_function_name': shEmailNotify.functionName,
+        'payload_bucket': payloadBucket.bucketName
+      },
+      functionName: 'SHFindingsStream',
+      handler: 'sh-findings-stream.lambda_handler',
+      memorySize: 512,
+      // one consumer at a time; the accounts of a batch are also leased in summaryStateTable,
+      // so batches and scheduled incremental runs of the same accounts do not overlap
+      reservedConcurrentExecutions: 1,
+      role: shFindingsStreamRole,
+      runtime: lambda.Runtime.PYTHON_3_9,
+      timeout: Duration.seconds(300)
+    });
+    shEmailNotify.grantInvoke(shFindingsStream);
+    payloadBucket.grantReadWrite(shFindingsStream);
+    summaryStateTable.grantReadWriteData(shFindingsStream);
+    payloadBucket.grantRead(shEmailNotify);
+    shFindingsStream.addEventSource(new lambdaes.SqsEventSource(shFindingEventsQueue, {
+      batchSize: 1000,
+      maxBatchingWindow: Duration.seconds(streamBatchWindow)
+    }));
+    // Finding events rule
+    const shFindingsImportedRule = new ev.Rule(this, 'SHFindingsImportedRule', {
+      description: 'Security Hub Findings - Imported events for SHFindingsStream',
+      enabled: true,
+      ruleName: 'SHFindingsImportedRule',
+      eventPattern: {
+        source: ['aws.securityhub'],
+        detailType: ['Security Hub Findings - Imported']
+      },
+      targets: [
+        new evt.SqsQueue(shFindingEventsQueue)
+      ]
+    });
     // Role for SESIdentitiesSM statemachine
     const sesIdentitiesSMRole = new iam.Role(this, 'SESIdentitiesSMRole', {
       assumedBy: new iam.ServicePrincipal('states.amazonaws.com'),
@@ -407,21 +631,15 @@ export class ShFindingIntimationsStack extends Stack {
       comment: "Get Security Hub enabled Member Accounts",
       outputPath: "$.Payload"
     });
-    // Task for add-ses-identity
-    const addSesIdentityTask = new tasks.LambdaInvoke(this, 'Add Identity', {
+    // Task for add-ses-identity: batch mode over the whole member_list, inline or spilled to
+    // payloadBucket (member_list_ref), so no Map over "$.member_list" is needed
+    const addSesIdentityTask = new tasks.LambdaInvoke(this, 'Add Identities', {
       lambdaFunction: addSesIdentity,
-      comment: 'Check and Add SES Identity for Member Email',
+      comment: 'Check and Add SES Identities for Member Emails',
       outputPath: "$.Payload"
     });
-    // For each Member
-    const eachMember = new sf.Map(this, 'Each Member', {
-      comment: "Process each Member",
-      itemsPath: "$.member_list",
-      maxConcurrency: 1
-    });
-    eachMember.iterator(addSesIdentityTask);
-    // chain tasks and nodes
-    const smDefinition = getShMembersTask.next(eachMember)
+    // chain tasks
+    const smDefinition = getShMembersTask.next(addSesIdentityTask)
     // state machine
     const sesIdentitiesSM = new sf.StateMachine(this, 'SESIdentitiesSM', {
       definition: smDefinition,
@@ -437,35 +655,36 @@ export class ShFindingIntimationsStack extends Stack {
     });
     emailNotifySHSummaryReportSMRole.attachInlinePolicy(lambdaPolicy);
     emailNotifySHSummaryReportSMRole.attachInlinePolicy(xrayPolicy);
-    // Unique Task for get-sh-members
+    // Unique Task for get-sh-members, split into shards of Member Accounts
     const getShMembers1Task = new tasks.LambdaInvoke(this, 'Get SH Members', {
       lambdaFunction: getShMembers,
-      comment: "Get Security Hub enabled Member Accounts",
+      comment: "Get Security Hub enabled Member Accounts in shards",
+      payload: sf.TaskInput.fromObject({
+        'shard_size': shardSize,
+        // concurrent shards of the Map state, for the shard planner's makespan estimate
+        'shard_concurrency': shardConcurrency,
+        // execution input { "force": true } sends reports even when unchanged;
+        // { "run_id": "..", "resume": true } skips members that run already completed
+        'execution_input.$': '$$.Execution.Input',
+        'execution_name.$': '$$.Execution.Name'
+      }),
       outputPath: "$.Payload"
     });
-    // Task for sh-summary-collector
-    const shSummaryCollectorTask = new tasks.LambdaInvoke(this, 'Collect Summary Report', {
-      lambdaFunction: shSummaryCollector,
-      comment: 'Collect Security Hub Insight Summary data',
-      outputPath: '$.Payload'
-    });
-    // Task for sh-email-notify
-    const shEmailNotifyTask = new tasks.LambdaInvoke(this, 'Send Email', {
-      lambdaFunction: shEmailNotify,
-      comment: 'Send Email with Security Hub Summary Report',
+    // Task for sh-org-report (summary and email for a shard of Member Accounts)
+    const shOrgReportTask = new tasks.LambdaInvoke(this, 'Report Shard', {
+      lambdaFunction: shOrgReport,
+      comment: 'Collect Security Hub summary data and send Emails for a shard of Member Accounts',
       outputPath: '$.Payload'
     });
-    // link tasks
-    shSummaryCollectorTask.next(shEmailNotifyTask);
-    // For each Account
-    const eachAccount = new sf.Map(this, 'Each Account', {
-      comment: "Process each Member",
-      itemsPath: "$.member_list",
-      maxConcurrency: 1
+    // For each Shard
+    const eachShard = new sf.Map(this, 'Each Shard', {
+      comment: "Process each shard of Members",
+      itemsPath: "$.shards",
+      maxConcurrency: shardConcurrency
     });
-    eachAccount.iterator(shSummaryCollectorTask);
+    eachShard.iterator(shOrgReportTask);
     // link tasks and nodes
-    const smDefinition1 = getShMembers1Task.next(eachAccount);
+    const smDefinition1 = getShMembers1Task.next(eachShard);
     // state machine
     const emailNotifySHSummaryReportSM = new sf.StateMachine(this, 'EmailNotifySHSummaryReportSM', {
       definition: smDefinition1,
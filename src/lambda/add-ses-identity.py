@@ -2,6 +2,12 @@
 # Purpose: Create Email Identity in SES
 # NOTE:
 # - If Email Identity exists and Not Verified, then Add Email Identity to force dispatch of verification email
+# - A member_list event (inline or spilled, member_list_ref) checks all addresses with one identity
+#   listing and chunked status lookups; it returns the number of addresses per verification status,
+#   so that the result of a large organization fits a Step Functions state
+# - Addresses are only (re)verified when their status is known: a failed identity listing fails the
+#   invocation and addresses of a failed status lookup are skipped (status LookupFailed)
+# - verified_cache_ttl (seconds) enables a cache of verified addresses, optionally persisted to verified_cache_path
 #
 
 import os
@@ -10,9 +16,14 @@ import json
 import logging
 from datetime import date, datetime
 import traceback
+import time
+import payload_store
+import sh_logging
+import sh_metrics
+import sh_retry
 #import argparse
 
-session = boto3.Session()
+session = sh_metrics.instrument(boto3.Session())
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -29,9 +40,45 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError('Type %s not serializable' % type(obj))
 
+# GetIdentityVerificationAttributes accepts at most 100 identities per call
+verification_max_identities = 100
+# Status of addresses whose verification attributes could not be read
+lookup_failed_status = 'LookupFailed'
+verified_cache_ttl = int(os.environ.get('verified_cache_ttl', '0'))
+verified_cache_path = os.environ.get('verified_cache_path')
+# email address -> time verified, kept across warm invocations
+verified_cache = {}
+
+def load_verified_cache():
+    if verified_cache_ttl <= 0 or verified_cache or not verified_cache_path:
+        return
+    try:
+        with open(verified_cache_path) as cache_file:
+            verified_cache.update(json.load(cache_file))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        LOGGER.error(f'failed to load verified cache: {e}')
+
+def save_verified_cache():
+    if verified_cache_ttl <= 0 or not verified_cache_path:
+        return
+    try:
+        with open(verified_cache_path, 'w') as cache_file:
+            json.dump(verified_cache, cache_file)
+    except Exception as e:
+        LOGGER.error(f'failed to save verified cache: {e}')
+
+def is_cached_verified(email_address):
+    if verified_cache_ttl <= 0:
+        return False
+    verified_at = verified_cache.get(email_address)
+    return verified_at is not None and time.time() - verified_at < verified_cache_ttl
+
 
 def get_email_identities(ses_client):
-    email_identities = []
+    # Lazily yield identities page by page; raises when a page cannot be listed, since
+    # the addresses on the missing pages would look unknown and be verified again
     try:
         paginator = ses_client.get_paginator('list_identities')
         iterator = paginator.paginate(
@@ -39,21 +86,12 @@ def get_email_identities(ses_client):
         )
         for page in iterator:
             for identity in page['Identities']:
-                email_identities.append(identity)
-        return email_identities
+                yield identity
     except Exception as e:
         LOGGER.error(f'failed in list_identities(..): {e}')
         LOGGER.error(str(e))
         LOGGER.error(traceback.format_exc())
-
-def get_verification_status(ses_client, identity):
-    try:
-        response = ses_client.get_identity_verification_attributes(Identities=[ identity ])
-        return response
-    except Exception as e:
-        LOGGER.error(f'failed in get_identity_verification_attributes(..):  {e}')
-        LOGGER.error(str(e))
-        LOGGER.error(traceback.format_exc())
+        raise
 
 def add_identity(ses_client, member_email):
     try:
@@ -64,36 +102,83 @@ def add_identity(ses_client, member_email):
         LOGGER.error(str(e))
         LOGGER.error(traceback.format_exc())
 
-def submit_email_verification(ses_client, email_address):
-    email_identities = get_email_identities(ses_client)
-    identity_verified = False
-    if email_address in email_identities:
-        response = get_verification_status(ses_client, email_address)
-        #print(json.dumps(response, indent=2))
-        verification_status = response['VerificationAttributes'].get(email_address, {'VerificationStatus': 'NotFound'})['VerificationStatus']
-        LOGGER.info('Verification Status: {}'.format(verification_status))
+def get_verification_statuses(ses_client, email_addresses):
+    # Addresses of a chunk that fails are given lookup_failed_status
+    verification_statuses = {}
+    for idx in range(0, len(email_addresses), verification_max_identities):
+        chunk = email_addresses[idx:idx + verification_max_identities]
+        try:
+            response = ses_client.get_identity_verification_attributes(Identities=chunk)
+            for email_address in chunk:
+                verification_statuses[email_address] = response['VerificationAttributes'].get(email_address, {'VerificationStatus': 'NotFound'})['VerificationStatus']
+        except Exception as e:
+            LOGGER.error(f'failed in get_identity_verification_attributes(..):  {e}')
+            LOGGER.error(str(e))
+            LOGGER.error(traceback.format_exc())
+            for email_address in chunk:
+                verification_statuses[email_address] = lookup_failed_status
+    return verification_statuses
+
+def submit_email_verifications(ses_client, email_addresses):
+    # List identities once, check status in chunks and only add missing or unverified identities
+    load_verified_cache()
+    email_addresses = [ email_address for email_address in dict.fromkeys(email_addresses) if not is_cached_verified(email_address) ]
+    if len(email_addresses) == 0:
+        LOGGER.info('All Email Addresses verified (cached). No further action required')
+        return {}
+    # only identities of the requested addresses are kept in memory
+    wanted = set(email_addresses)
+    email_identities = set([ identity for identity in get_email_identities(ses_client) if identity in wanted ])
+    existing = [ email_address for email_address in email_addresses if email_address in email_identities ]
+    verification_statuses = get_verification_statuses(ses_client, existing)
+    for email_address in email_addresses:
+        verification_status = verification_statuses.get(email_address, 'NotFound')
+        LOGGER.info('Verification Status for {}: {}'.format(email_address, verification_status))
         if verification_status == 'Success':
             LOGGER.info('SES Identity for Email Address: {} exists and verified. No further action required'.format(email_address))
-            identity_verified = True
-    else:
-        LOGGER.info('SES Identity for Member Email: {} not found !')
-        add_identity(ses_client, email_address)
-    if not identity_verified:
-        LOGGER.info('SES Identity for Member Email: {} exists, but Verification incomplete !')
-        add_identity(ses_client, email_address)
+            verified_cache[email_address] = time.time()
+        elif verification_status == lookup_failed_status:
+            LOGGER.error('Verification Status for Email Address: {} unknown, skipped'.format(email_address))
+        elif email_address in email_identities:
+            LOGGER.info('SES Identity for Member Email: {} exists, but Verification incomplete !'.format(email_address))
+            add_identity(ses_client, email_address)
+        else:
+            LOGGER.info('SES Identity for Member Email: {} not found !'.format(email_address))
+            add_identity(ses_client, email_address)
+        verification_statuses[email_address] = verification_status
+    save_verified_cache()
+    return verification_statuses
 
+def submit_email_verification(ses_client, email_address):
+    submit_email_verifications(ses_client, [ email_address ])
+
+def get_member_email_addresses(member):
+    email_addresses = [ member['account_email'] ]
+    # check if tech_owner_email exists
+    if 'tech_owner_email' in member:
+        email_addresses.append(member['tech_owner_email'])
+    return email_addresses
+
+@sh_metrics.metrics_handler
 def lambda_handler(event, context):
 #def main():
-    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
-    account_email = event['account_email']
+    LOGGER.info('REQUEST RECEIVED: %s', sh_logging.lazy(event))
     #args = parser.parse_args()
     #member_email = args.member_email
-    ses_client = session.client('ses')
-    submit_email_verification(ses_client, account_email)
-    # check if tech_owner_email exists
-    if 'tech_owner_email' in event:
-        tech_owner_email = event['tech_owner_email']
-        submit_email_verification(ses_client, tech_owner_email)
+    ses_client = sh_retry.get_client(session, 'ses')
+    # Batch mode: verify the addresses of every member in member_list
+    if 'member_list' in event or 'member_list_ref' in event:
+        email_addresses = []
+        for member in payload_store.records_from_event(event, 'member_list'):
+            email_addresses.extend(get_member_email_addresses(member))
+        verification_statuses = submit_email_verifications(ses_client, email_addresses)
+        verification_counts = {}
+        for verification_status in verification_statuses.values():
+            verification_counts[verification_status] = verification_counts.get(verification_status, 0) + 1
+        return {
+            'verification_counts': verification_counts
+        }
+    submit_email_verifications(ses_client, get_member_email_addresses(event))
 
 #if __name__ == '__main__':
 #    main()
\ No newline at end of file
@@ -0,0 +1,84 @@
+#
+# Purpose: Digests of the last summary report sent to each Member Account
+# NOTE:
+# - A digest is a stable hash of what a report would contain (summary data, recipients, template)
+# - Digests are kept as digest#<account> items of digest_table_name (DynamoDB, keyed by account_id;
+#   the stack owned SHSummaryStateTable, not the imported members table) or in digest_store_path
+#   (local JSON file stand-in)
+# - A digest is only stored after its report was sent, so failed sends are retried next run
+#
+
+import os
+import json
+import logging
+import template_renderer
+import sh_metrics
+import sh_retry
+
+LOGGER = logging.getLogger()
+
+_session = None
+
+class LocalDigestStore(object):
+    # Digests kept in a local JSON file
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as store_file:
+                self.data = json.load(store_file)
+        except FileNotFoundError:
+            self.data = {}
+
+    def get_digests(self, member_accounts):
+        return { member_account: self.data[member_account] for member_account in member_accounts if member_account in self.data }
+
+    def put_digests(self, digests):
+        if len(digests) == 0:
+            return
+        self.data.update(digests)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as store_file:
+            json.dump(self.data, store_file)
+        os.replace(tmp_path, self.path)
+
+class DynamoDBDigestStore(object):
+    # Digests kept as digest#<account> items of a DynamoDB table keyed by account_id
+    def __init__(self, db_client, table_name):
+        self.db_client = db_client
+        self.table_name = table_name
+
+    def get_digests(self, member_accounts):
+        digests = {}
+        keys = [ 'digest#' + member_account for member_account in member_accounts ]
+        for item in sh_retry.batch_get_items(self.db_client, self.table_name, keys):
+            digests[item['account_id']['S'].split('#', 1)[1]] = item['digest']['S']
+        return digests
+
+    def put_digests(self, digests):
+        items = [
+            {
+                'account_id': { 'S': 'digest#' + member_account },
+                'digest': { 'S': digest }
+            } for member_account, digest in digests.items()
+        ]
+        sh_retry.batch_write_items(self.db_client, self.table_name, items)
+
+def get_digest_store(session=None):
+    global _session
+    if 'digest_table_name' in os.environ:
+        if session is None:
+            if _session is None:
+                # boto3 is only needed with a DynamoDB store
+                import boto3
+                _session = sh_metrics.instrument(boto3.Session())
+            session = _session
+        return DynamoDBDigestStore(sh_retry.get_client(session, 'dynamodb'), os.environ['digest_table_name'])
+    return LocalDigestStore(os.environ.get('digest_store_path', '/tmp/sh-report-digests.json'))
+
+def report_digest(member_summary_data, destination, template_name):
+    # Reports with the same data, recipients and template have the same digest
+    return template_renderer.data_digest({
+        'member_summary': member_summary_data,
+        'destination': destination,
+        'template_name': template_name
+    })
@@ -0,0 +1,511 @@
+#
+# Purpose: Local columnar snapshot of the organization's active FAILED findings
+# NOTE:
+# - One get_findings pass fills dictionary encoded columns (account, region, severity, workflow,
+#   product, primary resource, title and exploded types) kept in compact typed arrays
+# - Severity, type and per resource views are group-bys over the code columns; numpy is used
+#   when it can be imported, plain Python counting otherwise
+# - sh-summary-collector counts severities and types from snapshots; with snapshot_mode=read,
+#   sh-insights-collector takes resource counts (insight results) and sh-resource-findings the
+#   latest findings per resource from them
+# - Snapshots are saved gzip compressed to s3://<snapshot_bucket>/<snapshot_prefix> or to
+#   snapshot_dir; each covers the accounts it was built for ('org' for the whole organization)
+#   and is ignored by readers after snapshot_max_age_seconds. snapshot_dir is local to one
+#   container, so Lambdas share snapshots through snapshot_bucket
+# - Ad-hoc reports read snapshots only (no API calls):
+#   python findings_snapshot.py severity|types|resources|latest [--account ..] [--resource ..] [--severity ..]
+#
+
+import os
+import sys
+import json
+import gzip
+import time
+import array
+import bisect
+import hashlib
+import logging
+from collections import Counter
+from datetime import datetime
+
+# numpy is optional and imported by the first group-by (load_numpy)
+numpy = None
+_numpy_loaded = False
+
+LOGGER = logging.getLogger()
+
+snapshot_bucket = os.environ.get('snapshot_bucket')
+snapshot_prefix = os.environ.get('snapshot_prefix', 'snapshots/')
+snapshot_dir = os.environ.get('snapshot_dir', '/tmp/sh-findings-snapshots')
+snapshot_max_age_seconds = int(os.environ.get('snapshot_max_age_seconds', '3600'))
+
+snapshot_version = 1
+# Dictionary encoded columns, one code per finding
+code_columns = [ 'account', 'region', 'severity', 'workflow', 'product', 'resource', 'title' ]
+
+class Dictionary(object):
+    # Distinct values of a column; a value's code is its position
+    def __init__(self, values=None):
+        self.values = list(values or [])
+        self.codes = { value: code for code, value in enumerate(self.values) }
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.codes[value] = code
+        return code
+
+    def __len__(self):
+        return len(self.values)
+
+def parse_timestamp(timestamp):
+    # ISO 8601 finding timestamp -> epoch seconds (0 when missing or malformed)
+    if not timestamp:
+        return 0.0
+    try:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return 0.0
+
+def format_timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(seconds))
+
+def accounts_name(accounts):
+    # Snapshot name of a set of accounts ('org' when built for the whole organization)
+    if accounts is None:
+        return 'org'
+    return hashlib.sha256(','.join(sorted(accounts)).encode('utf-8')).hexdigest()[:16]
+
+class FindingsSnapshot(object):
+    def __init__(self, accounts=None, created_at=None):
+        # accounts: accounts covered by the snapshot, None for the whole organization
+        self.accounts = None if accounts is None else sorted(set(accounts))
+        self.created_at = created_at if created_at is not None else time.time()
+        self.dictionaries = { name: Dictionary() for name in code_columns + [ 'type' ] }
+        self.columns = { name: array.array('I') for name in code_columns }
+        self.observed = array.array('d')
+        # Types exploded to (row, type code) pairs, in row order
+        self.type_rows = array.array('I')
+        self.type_codes = array.array('I')
+        # Finding Ids as one utf-8 blob and row offsets
+        self.id_blob = bytearray()
+        self.id_offsets = array.array('Q', [ 0 ])
+
+    def __len__(self):
+        return len(self.observed)
+
+    def covers(self, member_accounts):
+        return self.accounts is None or set(member_accounts) <= set(self.accounts)
+
+    def add(self, finding):
+        # Append a finding; only ACTIVE FAILED findings with a NEW or NOTIFIED workflow are kept
+        if finding.get('Compliance', {}).get('Status') != 'FAILED' or finding.get('RecordState') != 'ACTIVE':
+            return False
+        workflow_status = finding.get('Workflow', {}).get('Status')
+        if workflow_status not in ('NEW', 'NOTIFIED'):
+            return False
+        resources = finding.get('Resources') or [ {} ]
+        values = {
+            'account': finding['AwsAccountId'],
+            'region': finding.get('Region'),
+            'severity': finding.get('Severity', {}).get('Label'),
+            'workflow': workflow_status,
+            'product': finding.get('ProductName'),
+            'resource': resources[0].get('Id'),
+            'title': finding.get('Title')
+        }
+        row = len(self.observed)
+        for name in code_columns:
+            self.columns[name].append(self.dictionaries[name].encode(values[name]))
+        self.observed.append(parse_timestamp(finding.get('LastObservedAt') or finding.get('UpdatedAt')))
+        for finding_type in sorted(set(finding.get('Types', []))):
+            self.type_rows.append(row)
+            self.type_codes.append(self.dictionaries['type'].encode(finding_type))
+        self.id_blob.extend(finding['Id'].encode('utf-8'))
+        self.id_offsets.append(len(self.id_blob))
+        return True
+
+    def add_findings(self, findings):
+        for finding in findings:
+            self.add(finding)
+        return self
+
+    def extend(self, other):
+        # Append the rows of another snapshot, re-encoding its codes
+        mappings = {
+            name: [ self.dictionaries[name].encode(value) for value in other.dictionaries[name].values ]
+            for name in self.dictionaries
+        }
+        row_offset = len(self.observed)
+        for name in code_columns:
+            mapping = mappings[name]
+            self.columns[name].extend(array.array('I', [ mapping[code] for code in other.columns[name] ]))
+        self.observed.extend(other.observed)
+        self.type_rows.extend(array.array('I', [ row + row_offset for row in other.type_rows ]))
+        self.type_codes.extend(array.array('I', [ mappings['type'][code] for code in other.type_codes ]))
+        blob_offset = len(self.id_blob)
+        self.id_blob.extend(other.id_blob)
+        self.id_offsets.extend(array.array('Q', [ offset + blob_offset for offset in other.id_offsets[1:] ]))
+        return self
+
+    def select_accounts(self, accounts, exclude=False):
+        # Snapshot of the rows of accounts (of every other account with exclude)
+        codes = self.account_codes(accounts)
+        if exclude:
+            excluded = set(codes)
+            codes = [ code for code in range(len(self.dictionaries['account'])) if code not in excluded ]
+            selected_accounts = None if self.accounts is None else [ account for account in self.accounts if account not in set(accounts) ]
+        else:
+            selected_accounts = accounts
+        rows = select(None, self.columns['account'], codes)
+        subset = FindingsSnapshot(selected_accounts, self.created_at)
+        subset.dictionaries = { name: Dictionary(dictionary.values) for name, dictionary in self.dictionaries.items() }
+        for name in code_columns:
+            subset.columns[name] = take(self.columns[name], rows)
+        subset.observed = take(self.observed, rows)
+        positions = { row: position for position, row in enumerate(rows) }
+        for row, type_code in zip(self.type_rows, self.type_codes):
+            position = positions.get(row)
+            if position is not None:
+                subset.type_rows.append(position)
+                subset.type_codes.append(type_code)
+        for row in rows:
+            subset.id_blob.extend(self.id_blob[self.id_offsets[row]:self.id_offsets[row + 1]])
+            subset.id_offsets.append(len(subset.id_blob))
+        return subset
+
+    def finding_id(self, row):
+        return self.id_blob[self.id_offsets[row]:self.id_offsets[row + 1]].decode('utf-8')
+
+    def row_types(self, row):
+        # type_rows is sorted, so a row's types are one contiguous run
+        lo = bisect.bisect_left(self.type_rows, row)
+        types_ = []
+        while lo < len(self.type_rows) and self.type_rows[lo] == row:
+            types_.append(self.dictionaries['type'].values[self.type_codes[lo]])
+            lo += 1
+        return types_
+
+    def value(self, name, row):
+        return self.dictionaries[name].values[self.columns[name][row]]
+
+    def value_codes(self, name, values):
+        # Codes of the values of a column that occur (None for all values)
+        if values is None:
+            return None
+        codes = self.dictionaries[name].codes
+        return [ codes[value] for value in values if value in codes ]
+
+    def account_codes(self, accounts):
+        return self.value_codes('account', accounts)
+
+    def severity_counts(self, finding_type=None, accounts=None):
+        # {account: {severity label: count}} of NEW findings (with finding_type when given)
+        workflow_code = self.dictionaries['workflow'].codes.get('NEW')
+        if workflow_code is None:
+            return {}
+        if finding_type is None:
+            rows = None
+        else:
+            type_code = self.dictionaries['type'].codes.get(finding_type)
+            if type_code is None:
+                return {}
+            rows = select(self.type_rows, self.type_codes, [ type_code ])
+        rows = select(rows, take(self.columns['workflow'], rows), [ workflow_code ])
+        account_codes = self.account_codes(accounts)
+        if account_codes is not None:
+            rows = select(rows, take(self.columns['account'], rows), account_codes)
+        pairs = group_count(take(self.columns['account'], rows), take(self.columns['severity'], rows), len(self.dictionaries['severity']))
+        return self.decode_pairs(pairs, 'account', 'severity')
+
+    def type_counts(self, product_name='Security Hub', accounts=None):
+        # {account: {type: count}} of findings of product_name
+        product_code = self.dictionaries['product'].codes.get(product_name)
+        if product_code is None:
+            return {}
+        type_rows = self.type_rows
+        selected = select(None, take(self.columns['product'], type_rows), [ product_code ])
+        account_codes = self.account_codes(accounts)
+        if account_codes is not None:
+            selected = select(selected, take(self.columns['account'], take(type_rows, selected)), account_codes)
+        rows = take(type_rows, selected)
+        pairs = group_count(take(self.columns['account'], rows), take(self.type_codes, selected), len(self.dictionaries['type']))
+        return self.decode_pairs(pairs, 'account', 'type')
+
+    def resource_counts(self, accounts=None, limit=100, severities=None):
+        # Resources with the most findings (of severities when given), shaped like
+        # InsightResults ResultValues
+        rows = None
+        account_codes = self.account_codes(accounts)
+        if account_codes is not None:
+            rows = select(None, self.columns['account'], account_codes)
+        severity_codes = self.value_codes('severity', severities)
+        if severity_codes is not None:
+            rows = select(rows, take(self.columns['severity'], rows), severity_codes)
+        counts = group_count(take(self.columns['resource'], rows))
+        resources = self.dictionaries['resource'].values
+        results = sorted([ (resources[code], count) for code, count in counts.items() if resources[code] is not None ], key=lambda item: (-item[1], item[0]))
+        return [ { 'GroupByAttributeValue': resource, 'Count': count } for resource, count in results[:limit] ]
+
+    def latest_findings(self, resource_ids, per_resource=2, severities=None):
+        # {resource: [finding, ..]} with the per_resource most recently observed findings
+        # (of severities when given)
+        rows = select(None, self.columns['resource'], self.value_codes('resource', resource_ids))
+        severity_codes = self.value_codes('severity', severities)
+        if severity_codes is not None:
+            rows = select(rows, take(self.columns['severity'], rows), severity_codes)
+        latest = {}
+        for row in sorted(rows, key=lambda row: -self.observed[row]):
+            resource_id = self.value('resource', row)
+            resource_findings = latest.setdefault(resource_id, [])
+            if len(resource_findings) < per_resource:
+                resource_findings.append(self.to_finding(row))
+        return latest
+
+    def to_finding(self, row):
+        # Compact finding with the snapshot's columns
+        return {
+            'Id': self.finding_id(row),
+            'AwsAccountId': self.value('account', row),
+            'Region': self.value('region', row),
+            'Title': self.value('title', row),
+            'ProductName': self.value('product', row),
+            'Types': self.row_types(row),
+            'Severity': { 'Label': self.value('severity', row) },
+            'Workflow': { 'Status': self.value('workflow', row) },
+            'Resources': [ { 'Id': self.value('resource', row), 'Region': self.value('region', row) } ],
+            'LastObservedAt': format_timestamp(self.observed[row])
+        }
+
+    def decode_pairs(self, pairs, outer, inner):
+        outer_values = self.dictionaries[outer].values
+        inner_values = self.dictionaries[inner].values
+        result = {}
+        for (outer_code, inner_code), count in pairs.items():
+            result.setdefault(outer_values[outer_code], {})[inner_values[inner_code]] = count
+        return result
+
+    def to_bytes(self):
+        # gzip(header line, then the raw bytes of every column)
+        columns = [ (name, self.columns[name]) for name in code_columns ] + [
+            ('observed', self.observed),
+            ('type_rows', self.type_rows),
+            ('type_codes', self.type_codes),
+            ('id_offsets', self.id_offsets)
+        ]
+        header = {
+            'version': snapshot_version,
+            'created_at': self.created_at,
+            'accounts': self.accounts,
+            'byteorder': sys.byteorder,
+            'dictionaries': { name: dictionary.values for name, dictionary in self.dictionaries.items() },
+            'columns': [ [ name, column.typecode, len(column) ] for name, column in columns ],
+            'id_blob': len(self.id_blob)
+        }
+        parts = [ json.dumps(header).encode('utf-8'), b'\n' ]
+        parts.extend([ column.tobytes() for name, column in columns ])
+        parts.append(bytes(self.id_blob))
+        return gzip.compress(b''.join(parts), compresslevel=6)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = gzip.decompress(data)
+        header_end = data.index(b'\n')
+        header = json.loads(data[:header_end].decode('utf-8'))
+        if header['version'] != snapshot_version:
+            raise ValueError('unsupported snapshot version {}'.format(header['version']))
+        snapshot = cls(header['accounts'], header['created_at'])
+        snapshot.dictionaries = { name: Dictionary(values) for name, values in header['dictionaries'].items() }
+        position = header_end + 1
+        for name, typecode, count in header['columns']:
+            column = array.array(typecode)
+            size = column.itemsize * count
+            column.frombytes(data[position:position + size])
+            if header['byteorder'] != sys.byteorder:
+                column.byteswap()
+            position += size
+            if name in snapshot.columns:
+                snapshot.columns[name] = column
+            else:
+                setattr(snapshot, name, column)
+        snapshot.id_blob = bytearray(data[position:position + header['id_blob']])
+        return snapshot
+
+def load_numpy():
+    global numpy, _numpy_loaded
+    if not _numpy_loaded:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_loaded = True
+    return numpy
+
+def select(rows, values, codes):
+    # Positions of rows (all rows when None) whose value is one of codes;
+    # values are the column values of those rows
+    if load_numpy() is not None:
+        matched = numpy.flatnonzero(numpy.isin(as_numpy(values), numpy.asarray(codes, dtype=numpy.uint32)))
+        if rows is not None:
+            matched = as_numpy(rows)[matched]
+        return array.array('I', matched.astype(numpy.uint32).tobytes())
+    codes = set(codes)
+    if rows is None:
+        return array.array('I', [ row for row, value in enumerate(values) if value in codes ])
+    return array.array('I', [ row for row, value in zip(rows, values) if value in codes ])
+
+def take(column, rows):
+    # Values of column at rows (the whole column when rows is None)
+    if rows is None:
+        return column
+    if load_numpy() is not None:
+        return array.array(column.typecode, as_numpy(column)[as_numpy(rows)].tobytes())
+    return array.array(column.typecode, [ column[row] for row in rows ])
+
+def group_count(keys, inner_keys=None, inner_size=None):
+    # {key: count}, or {(key, inner key): count} for two code columns
+    if inner_keys is not None:
+        keys = combine(keys, inner_keys, inner_size)
+    if load_numpy() is not None and len(keys) > 0:
+        values, counts = numpy.unique(as_numpy(keys), return_counts=True)
+        counts = dict(zip(values.tolist(), counts.tolist()))
+    else:
+        counts = Counter(keys)
+    if inner_keys is None:
+        return counts
+    return { divmod(key, inner_size): count for key, count in counts.items() }
+
+def combine(keys, inner_keys, inner_size):
+    if load_numpy() is not None:
+        return array.array('Q', (as_numpy(keys).astype(numpy.uint64) * inner_size + as_numpy(inner_keys)).tobytes())
+    return array.array('Q', [ key * inner_size + inner_key for key, inner_key in zip(keys, inner_keys) ])
+
+def as_numpy(column):
+    dtypes = { 'I': numpy.uint32, 'Q': numpy.uint64, 'd': numpy.float64 }
+    return numpy.frombuffer(column, dtype=dtypes[column.typecode]) if len(column) > 0 else numpy.zeros(0, dtype=dtypes[column.typecode])
+
+def merge(snapshots):
+    # Concatenated rows of snapshots of distinct findings (regions or account chunks of one
+    # pass); overlapping saved snapshots are resolved by load_snapshot
+    snapshots = list(snapshots)
+    if len(snapshots) == 0:
+        return None
+    accounts = set()
+    for snapshot in snapshots:
+        if snapshot.accounts is None:
+            accounts = None
+            break
+        accounts.update(snapshot.accounts)
+    merged = FindingsSnapshot(accounts, min([ snapshot.created_at for snapshot in snapshots ]))
+    for snapshot in snapshots:
+        merged.extend(snapshot)
+    return merged
+
+def get_s3_client():
+    import payload_store
+    return payload_store.get_s3_client()
+
+def save_snapshot(snapshot):
+    # Store a snapshot under the name of the accounts it covers
+    data = snapshot.to_bytes()
+    file_name = 'findings-{}.snap.gz'.format(accounts_name(snapshot.accounts))
+    if snapshot_bucket is not None:
+        key = snapshot_prefix + file_name
+        get_s3_client().put_object(Bucket=snapshot_bucket, Key=key, Body=data)
+        ref = { 'bucket': snapshot_bucket, 'key': key }
+    else:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        path = os.path.join(snapshot_dir, file_name)
+        with open(path + '.tmp', 'wb') as snapshot_file:
+            snapshot_file.write(data)
+        os.replace(path + '.tmp', path)
+        ref = { 'path': path }
+    LOGGER.info('Saved snapshot of {} findings ({} bytes) to {}'.format(len(snapshot), len(data), ref))
+    return ref
+
+def read_snapshot_files():
+    if snapshot_bucket is not None:
+        s3_client = get_s3_client()
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=snapshot_bucket, Prefix=snapshot_prefix):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith('.snap.gz'):
+                    yield s3_client.get_object(Bucket=snapshot_bucket, Key=item['Key'])['Body'].read()
+        return
+    if not os.path.isdir(snapshot_dir):
+        return
+    for file_name in sorted(os.listdir(snapshot_dir)):
+        if file_name.endswith('.snap.gz'):
+            with open(os.path.join(snapshot_dir, file_name), 'rb') as snapshot_file:
+                yield snapshot_file.read()
+
+def load_snapshot(member_accounts=None, max_age_seconds=None):
+    # Merged fresh snapshots, or None when they do not cover member_accounts
+    # (None: the whole organization), with the newest rows of each account
+    if max_age_seconds is None:
+        max_age_seconds = snapshot_max_age_seconds
+    oldest = time.time() - max_age_seconds
+    snapshots = []
+    try:
+        for data in read_snapshot_files():
+            snapshot = FindingsSnapshot.from_bytes(data)
+            if snapshot.created_at >= oldest:
+                snapshots.append(snapshot)
+    except Exception as e:
+        LOGGER.error(f'failed in load_snapshot(..): {e}')
+        LOGGER.error(str(e))
+        return None
+    # Snapshots overlap (shards of different runs, organization wide ones): each account's
+    # rows are taken from the newest snapshot covering it, so no finding is counted twice
+    parts = []
+    claimed = set()
+    for snapshot in sorted(snapshots, key=lambda snapshot: -snapshot.created_at):
+        if snapshot.accounts is None:
+            # covers every account no newer snapshot covers
+            parts.append(snapshot.select_accounts(claimed, exclude=True) if len(claimed) > 0 else snapshot)
+            break
+        accounts = [ account for account in snapshot.accounts if account not in claimed ]
+        if len(accounts) > 0:
+            parts.append(snapshot.select_accounts(accounts) if len(accounts) < len(snapshot.accounts) else snapshot)
+            claimed.update(accounts)
+    snapshot = parts[0] if len(parts) == 1 else merge(parts)
+    if snapshot is None:
+        return None
+    # with an organization wide part every account is covered
+    if snapshot.accounts is None:
+        return snapshot
+    if member_accounts is None or not snapshot.covers(member_accounts):
+        return None
+    return snapshot
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Ad-hoc reports from the findings snapshots (no API calls)')
+    parser.add_argument('view', choices=[ 'severity', 'types', 'resources', 'latest' ])
+    parser.add_argument('--account', action='append', help='Member Account Id (repeatable)')
+    parser.add_argument('--type', help='Finding type of the severity view')
+    parser.add_argument('--resource', action='append', default=[], help='Resource Id of the latest view (repeatable)')
+    parser.add_argument('--severity', action='append', help='Severity label of the resources and latest views (repeatable)')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--max-age', type=int, default=None, help='Ignore snapshots older than this many seconds')
+    args = parser.parse_args()
+
+    snapshot = load_snapshot(args.account, args.max_age)
+    if snapshot is None:
+        sys.exit('No snapshot covers the requested accounts')
+    started = time.perf_counter()
+    if args.view == 'severity':
+        result = snapshot.severity_counts(args.type, args.account)
+    elif args.view == 'types':
+        result = snapshot.type_counts(accounts=args.account)
+    elif args.view == 'resources':
+        result = snapshot.resource_counts(args.account, args.limit, args.severity)
+    else:
+        result = snapshot.latest_findings(args.resource, severities=args.severity)
+    print(json.dumps(result, indent=2))
+    print('{} findings, {:.1f} ms'.format(len(snapshot), (time.perf_counter() - started) * 1000.0), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,15 @@
 import os
 import json
-import traceback
 import boto3
 from datetime import date, datetime
 import logging
+import payload_store
+import shard_planner
+import sh_logging
+import sh_metrics
+import sh_retry
 
-session = boto3.Session()
+session = sh_metrics.instrument(boto3.Session())
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -19,68 +23,134 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError('Type %s not serializable' % type(obj))
 
+# BatchGetItem accepts at most 100 keys per request
+batch_get_max_keys = 100
+# Shard planner: 'lpt' balances the estimated work of shards, 'fixed' keeps list order
+shard_planner_mode = os.environ.get('shard_planner', 'lpt').lower()
+
 def get_members(sh_admin_client):
-    member_list = []
+    # Lazily yield members page by page
     try:
         paginator = sh_admin_client.get_paginator('list_members')
         iterator = paginator.paginate(OnlyAssociated=True)
         for page in iterator:
             for member in page['Members']:
-                member_list.append({
+                yield {
                     'account_id': member['AccountId'],
                     'account_email': member['Email'],
                     'sh_status': member['MemberStatus']
-                })
-        return member_list
+                }
     except Exception as e:
         LOGGER.error(f'failed in list_members(..): {e}')
         LOGGER.error(str(e))
 
-# TODO: add any other email addresses as needed using query
-def get_dyndb_account_emails(db_client, table_name, member):
-    account_id = member['account_id']
-    LOGGER.info('Query Additional Email addresses associated with Account: {} ..'.format(account_id))
-    dyn_expr_value = {
-        ':ac_id': {
-            'S': account_id
-        }
-    }
+# Attributes of the account email table added to each member
+account_email_projection = 'account_id, tech_owner_email'
+
+def get_dyndb_account_emails(db_client, table_name, member_list):
+    # tech_owner_email by account_id, looked up with BatchGetItem in chunks of 100 keys.
+    # Raises when keys stay unprocessed, so members are not dropped silently
+    account_emails = {}
+    account_ids = list(dict.fromkeys([ member['account_id'] for member in member_list ]))
+    LOGGER.info('Query Additional Email addresses associated with {} Accounts ..'.format(len(account_ids)))
     try:
-        response = db_client.query(
-            TableName=table_name,
-            Select='ALL_ATTRIBUTES',
-            KeyConditionExpression='account_id = :ac_id',
-            ExpressionAttributeValues=dyn_expr_value
-        )
-        #print(json.dumps(response, indent=2))
-        if len(response['Items']) == 1:
+        items = sh_retry.batch_get_items(db_client, table_name, account_ids, projection=account_email_projection)
+    except Exception as e:
+        LOGGER.error(f'Failed in batch_get_item(..): {e}')
+        raise
+    for item in items:
+        if 'tech_owner_email' in item:
+            account_emails[item['account_id']['S']] = item['tech_owner_email']['S']
+    return account_emails
+
+def get_member_emails(db_client, table_name, members):
+    # Stream members through BatchGetItem one chunk at a time.
+    # Members without an entry in the table are dropped
+    chunk = []
+    for member in members:
+        chunk.append(member)
+        if len(chunk) == batch_get_max_keys:
+            yield from add_account_emails(db_client, table_name, chunk)
+            chunk = []
+    if len(chunk) > 0:
+        yield from add_account_emails(db_client, table_name, chunk)
+
+def add_account_emails(db_client, table_name, member_list):
+    account_emails = get_dyndb_account_emails(db_client, table_name, member_list)
+    for member in member_list:
+        if member['account_id'] in account_emails:
             member.update({
-                'tech_owner_email': response['Items'][0]['tech_owner_email']['S']
+                'tech_owner_email': account_emails[member['account_id']]
             })
-            return member
-        else:
-            return None
-    except Exception as e:
-        LOGGER.error(f'Failed in query(..): {e}')
-        LOGGER.error(str(e))
-        LOGGER.error(traceback.format_exc())
+            yield member
+
+def get_shards(member_list, shard_size, force=False, run_id=None, resume=False, costs=None, workers=1):
+    # Without costs, shards are consecutive slices of shard_size members. With costs, the same
+    # number of shards is packed to balance their estimated work, heaviest shard first
+    shard_count = (len(member_list) + shard_size - 1) // shard_size
+    plan = None
+    if costs is None:
+        shards = [ member_list[idx:idx + shard_size] for idx in range(0, len(member_list), shard_size) ]
+        shard_costs = [ None for shard in shards ]
+    else:
+        # a multiple of workers shards of equal cost finish together
+        shard_count = -(-shard_count // max(1, workers)) * max(1, workers)
+        planned = shard_planner.plan_shards(member_list, costs, shard_count)
+        shards = [ shard for shard_cost, shard in planned ]
+        shard_costs = [ shard_cost for shard_cost, shard in planned ]
+        plan = shard_planner.plan_summary(planned, costs, workers)
+        LOGGER.info('Shard plan: %s', sh_logging.lazy(plan))
+    # all shards share one state payload
+    max_inline = payload_store.max_inline_bytes // max(len(shards), 1)
+    LOGGER.info('Member Count: {}, Shard Count: {}'.format(len(member_list), len(shards)))
+    shard_payloads = []
+    for shard, shard_cost in zip(shards, shard_costs):
+        shard_payload = payload_store.to_payload('member_list', shard, max_inline)
+        if shard_cost is not None:
+            shard_payload.update({ 'estimated_cost': round(shard_cost, 1) })
+        # force: send reports even when unchanged since the last run
+        if force:
+            shard_payload.update({ 'force': True })
+        # run_id: stages completed for each member are kept in the run ledger;
+        # resume: skip the members the run already completed
+        if run_id:
+            shard_payload.update({ 'run_id': run_id, 'resume': resume })
+        shard_payloads.append(shard_payload)
+    result = {
+        'member_count': len(member_list),
+        'shards': shard_payloads
+    }
+    if plan is not None:
+        result.update({ 'plan': plan })
+    return result
 
 #def main():
+@sh_metrics.metrics_handler
 def lambda_handler(event, context):
-    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    LOGGER.info('REQUEST RECEIVED: %s', sh_logging.lazy(event))
     table_name = os.environ['table_name']
-    sh_admin_client = session.client('securityhub')
-    db_client = session.client('dynamodb')
-    member_emails_list = []
-    member_list = get_members(sh_admin_client)
-    for member in member_list:
-        member_emails = get_dyndb_account_emails(db_client, table_name, member)
-        if member_emails != None:
-            member_emails_list.append(member_emails)
-    LOGGER.info('Member Count: %s' % str(len(member_emails_list)))
-    return {
-        'member_list': member_emails_list
-    }
+    sh_admin_client = sh_retry.get_client(session, 'securityhub')
+    db_client = sh_retry.get_client(session, 'dynamodb')
+    member_emails = get_member_emails(db_client, table_name, get_members(sh_admin_client))
+    # Shard mode: split members into shards for the org batch report, balanced by the
+    # estimated work of each account (shard_planner) unless shard_planner is fixed
+    if 'shard_size' in event:
+        execution_input = event.get('execution_input') or {}
+        force = event.get('force', False) or execution_input.get('force', False)
+        run_id = event.get('run_id') or execution_input.get('run_id') or event.get('execution_name')
+        resume = event.get('resume', False) or execution_input.get('resume', False)
+        member_list = list(member_emails)
+        costs = None
+        if shard_planner_mode == 'lpt':
+            costs = shard_planner.estimate_costs(
+                [ member['account_id'] for member in member_list ],
+                shard_planner.get_cost_store(session),
+                sh_admin_client
+            )
+        return get_shards(member_list, int(event['shard_size']), force, run_id, resume, costs, int(event.get('shard_concurrency', 4)))
+    payload = payload_store.to_payload('member_list', member_emails)
+    LOGGER.info('Member Count: %s' % str(len(payload['member_list']) if 'member_list' in payload else payload['member_list_ref']['count']))
+    return payload
 
 #if __name__ == '__main__':
 #    main()
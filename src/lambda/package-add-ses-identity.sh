@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package add-ses-identity.zip
 
-zip add-ses-identity.zip add-ses-identity.py
+zip add-ses-identity.zip add-ses-identity.py payload_store.py sh_logging.py sh_metrics.py sh_retry.py
 
 popd > /dev/null
\ No newline at end of file
@@ -0,0 +1,21 @@
+#!/bin/bash
+# Lambda layer with arnparse, precompiled for the Lambda runtime (python3.9).
+# /opt is read only in Lambda, so modules without bundled bytecode are compiled
+# on every cold start; unchecked-hash .pyc files stay valid whatever the zip timestamps
+SCRIPT_DIRECTORY="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+PYTHON=${PYTHON:-python3.9}
+
+pushd $SCRIPT_DIRECTORY > /dev/null
+
+rm -rf .layer arnparse-layer.zip
+
+mkdir -p .layer/python
+cp -r package/arnparse package/arnparse-0.0.2.dist-info .layer/python/
+find .layer -name __pycache__ -prune -exec rm -rf {} \;
+$PYTHON -m compileall -q --invalidation-mode unchecked-hash .layer/python/arnparse
+cd .layer
+zip -r ../arnparse-layer.zip python
+cd ../
+rm -rf .layer
+
+popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package get-sh-members.zip
 
-zip get-sh-members.zip get-sh-members.py
+zip get-sh-members.zip get-sh-members.py payload_store.py shard_planner.py sh_logging.py sh_metrics.py sh_retry.py
 
 popd > /dev/null
\ No newline at end of file
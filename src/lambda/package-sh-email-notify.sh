@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package sh-email-notify.zip
 
-zip sh-email-notify.zip sh-email-notify.py
+zip sh-email-notify.zip sh-email-notify.py payload_store.py template_renderer.py digest_store.py run_ledger.py sh_logging.py sh_metrics.py sh_retry.py
 
 popd > /dev/null
\ No newline at end of file
@@ -0,0 +1,10 @@
+#!/bin/bash
+SCRIPT_DIRECTORY="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+pushd $SCRIPT_DIRECTORY > /dev/null
+
+rm -rf .package sh-findings-stream.zip
+
+zip sh-findings-stream.zip sh-findings-stream.py get-sh-members.py sh-summary-collector.py payload_store.py findings_snapshot.py sh_async.py run_ledger.py shard_planner.py sh_logging.py sh_metrics.py sh_retry.py
+
+popd > /dev/null
\ No newline at end of file
@@ -1,13 +1,11 @@
 #!/bin/bash
+# arnparse is provided by the arnparse layer (package-arnparse-layer.sh)
 SCRIPT_DIRECTORY="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
 pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package sh-insights-collector.zip
 
-cd package
-zip -r ../sh-insights-collector.zip .
-cd ../
-zip -g sh-insights-collector.zip sh-insights-collector.py
+zip sh-insights-collector.zip sh-insights-collector.py work_queue.py findings_snapshot.py payload_store.py sts_session_cache.py sh_async.py sh_logging.py sh_metrics.py sh_retry.py
 
 popd > /dev/null
\ No newline at end of file
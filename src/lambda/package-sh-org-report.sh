@@ -0,0 +1,10 @@
+#!/bin/bash
+SCRIPT_DIRECTORY="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+pushd $SCRIPT_DIRECTORY > /dev/null
+
+rm -rf .package sh-org-report.zip
+
+zip sh-org-report.zip sh-org-report.py get-sh-members.py sh-summary-collector.py sh-email-notify.py payload_store.py findings_snapshot.py sh_async.py template_renderer.py digest_store.py run_ledger.py shard_planner.py sh_logging.py sh_metrics.py sh_retry.py
+
+popd > /dev/null
\ No newline at end of file
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package sh-resource-findings.zip
 
-zip sh-resource-findings.zip sh-resource-findings.py
+zip sh-resource-findings.zip sh-resource-findings.py payload_store.py findings_snapshot.py work_queue.py sts_session_cache.py sh_async.py sh_logging.py sh_metrics.py sh_retry.py
 
 popd > /dev/null
\ No newline at end of file
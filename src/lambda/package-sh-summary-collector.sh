@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package sh-summary-collector.zip
 
-zip sh-summary-collector.zip sh-summary-collector.py
+zip sh-summary-collector.zip sh-summary-collector.py payload_store.py run_ledger.py shard_planner.py findings_snapshot.py sh_async.py sh_logging.py sh_metrics.py sh_retry.py
 
 popd > /dev/null
\ No newline at end of file
@@ -1 +1 @@
-from .arnparse import arnparse
+from .arnparse import arnparse, arnparse_many
@@ -1,7 +1,17 @@
 from __future__ import absolute_import
 
+import re
+from collections import namedtuple
+from functools import lru_cache
+
 from arnparse.str_utils import empty_str_to_none
 
+# Number of distinct ARN strings kept by the memoized parser
+ARNPARSE_CACHE_SIZE = 65536
+
+_SERVICES_WITHOUT_RESOURCE_TYPE = frozenset(['s3', 'sns', 'apigateway', 'execute-api'])
+_RESOURCE_SEPARATOR = re.compile('[:/]')
+
 
 class MalformedArnError(Exception):
     def __init__(self, arn_str):
@@ -11,47 +21,71 @@ class MalformedArnError(Exception):
         return 'arn_str: {arn_str}'.format(arn_str=self.arn_str)
 
 
-class Arn(object):
-    def __init__(self, partition, service, region, account_id, resource_type, resource):
-        self.partition = partition
-        self.service = service
-        self.region = region
-        self.account_id = account_id
-        self.resource_type = resource_type
-        self.resource = resource
+class Arn(namedtuple('Arn', ['partition', 'service', 'region', 'account_id', 'resource_type', 'resource'])):
+    # Immutable so that parsed values can be shared by the memoized parser
+    __slots__ = ()
 
 
-def arnparse(arn_str):
+_new_arn = tuple.__new__
+
+
+def _arnparse(arn_str):
     if not arn_str.startswith('arn:'):
         raise MalformedArnError(arn_str)
 
     elements = arn_str.split(':', 5)
+    # e.g. 'arn:aws:s3' has no region, account and resource elements
+    if len(elements) != 6:
+        raise MalformedArnError(arn_str)
+
     service = elements[2]
     resource = elements[5]
 
-    if service in ['s3', 'sns', 'apigateway', 'execute-api']:
+    if service in _SERVICES_WITHOUT_RESOURCE_TYPE:
         resource_type = None
     else:
         resource_type, resource = _parse_resource(resource)
 
-    return Arn(
-        partition=elements[1],
-        service=service,
-        region=empty_str_to_none(elements[3]),
-        account_id=empty_str_to_none(elements[4]),
-        resource_type=resource_type,
-        resource=resource,
-    )
+    # positional tuple construction avoids the keyword argument overhead of Arn(..)
+    return _new_arn(Arn, (
+        elements[1],
+        service,
+        empty_str_to_none(elements[3]),
+        empty_str_to_none(elements[4]),
+        resource_type,
+        resource,
+    ))
+
+
+arnparse = lru_cache(maxsize=ARNPARSE_CACHE_SIZE)(_arnparse)
+
+
+def arnparse_many(arn_strs, ignore_malformed=False):
+    # Parse ARNs and group them as account_id -> [(arn_str, Arn), ..] in input order.
+    # Malformed ARNs raise MalformedArnError unless ignore_malformed is set.
+    # Bulk input is parsed without the memo cache to avoid evicting it
+    groupings = {}
+    parse = _arnparse
+    for arn_str in arn_strs:
+        try:
+            arn = parse(arn_str)
+        except MalformedArnError:
+            if ignore_malformed:
+                continue
+            raise
+        account_id = arn[3]
+        if account_id in groupings:
+            groupings[account_id].append((arn_str, arn))
+        else:
+            groupings[account_id] = [(arn_str, arn)]
+    return groupings
 
 
 def _parse_resource(resource):
-    first_separator_index = -1
-    for idx, c in enumerate(resource):
-        if c in (':', '/'):
-            first_separator_index = idx
-            break
+    match = _RESOURCE_SEPARATOR.search(resource)
 
-    if first_separator_index != -1:
+    if match is not None:
+        first_separator_index = match.start()
         resource_type = resource[:first_separator_index]
         resource = resource[first_separator_index + 1:]
     else:
@@ -0,0 +1,98 @@
+#
+# Purpose: Stream large Lambda payloads through NDJSON instead of memory
+# NOTE:
+# - Records are written one per line to a local file while they are produced
+# - Payloads up to max_inline_bytes are returned inline as today ({name: [..]})
+# - Larger payloads are spilled to s3://<payload_bucket>/<payload_prefix> or kept in
+#   payload_dir (local stand-in) and returned as a reference ({name + '_ref': {..}})
+# - Without payload_bucket or payload_dir, payloads are always returned inline
+#
+
+import os
+import json
+import uuid
+import logging
+import sh_logging
+import sh_metrics
+import sh_retry
+import tempfile
+from datetime import date, datetime
+
+LOGGER = logging.getLogger()
+
+# Step Functions limits state payloads to 256 KB; leave room for the envelope
+max_inline_bytes = int(os.environ.get('max_inline_bytes', str(200 * 1024)))
+payload_bucket = os.environ.get('payload_bucket')
+payload_prefix = os.environ.get('payload_prefix', 'payloads/')
+payload_dir = os.environ.get('payload_dir')
+
+_s3_client = None
+
+def json_serial(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError('Type %s not serializable' % type(obj))
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        # boto3 is only needed once a payload is spilled to (or read from) S3
+        import boto3
+        _s3_client = sh_retry.wrap_client(sh_metrics.instrument(boto3.client('s3')))
+    return _s3_client
+
+def read_records(ref):
+    # Lazily yield the records of a spilled payload
+    if 'path' in ref:
+        with open(ref['path']) as payload_file:
+            for line in payload_file:
+                if line.strip():
+                    yield sh_logging.loads(line)
+    else:
+        response = get_s3_client().get_object(Bucket=ref['bucket'], Key=ref['key'])
+        for line in response['Body'].iter_lines():
+            if line.strip():
+                yield sh_logging.loads(line)
+
+def records_from_event(event, name):
+    # Records passed inline as event[name] or spilled as event[name + '_ref']
+    if name + '_ref' in event:
+        return read_records(event[name + '_ref'])
+    return iter(event.get(name, []))
+
+def to_payload(name, records, max_inline=None):
+    # Stream records to NDJSON and return them inline or as a reference.
+    # max_inline lowers the inline limit, e.g. when several payloads share one state
+    if max_inline is None:
+        max_inline = max_inline_bytes
+    spill_enabled = payload_bucket is not None or payload_dir is not None
+    file_dir = payload_dir if payload_dir is not None else tempfile.gettempdir()
+    if payload_dir is not None:
+        os.makedirs(payload_dir, exist_ok=True)
+    file_name = '{}-{}.ndjson'.format(name, uuid.uuid4().hex)
+    path = os.path.join(file_dir, file_name)
+    size = 0
+    count = 0
+    with open(path, 'w') as payload_file:
+        for record in records:
+            line = sh_logging.dumps(record, default=json_serial)
+            payload_file.write(line)
+            payload_file.write('\n')
+            size += len(line) + 1
+            count += 1
+    if size <= max_inline or not spill_enabled:
+        if size > max_inline:
+            LOGGER.warning('Payload {} is {} bytes; set payload_bucket or payload_dir to spill it'.format(name, size))
+        records = list(read_records({ 'path': path }))
+        os.remove(path)
+        return { name: records }
+    LOGGER.info('Spilling {} records ({} bytes) of {}'.format(count, size, name))
+    if payload_bucket is not None:
+        key = payload_prefix + file_name
+        get_s3_client().upload_file(path, payload_bucket, key)
+        os.remove(path)
+        ref = { 'bucket': payload_bucket, 'key': key }
+    else:
+        ref = { 'path': path }
+    ref.update({ 'count': count })
+    return { name + '_ref': ref }
@@ -0,0 +1,136 @@
+#
+# Purpose: Ledger of the report stages completed for each Member Account of a run
+# NOTE:
+# - A run is identified by run_id: the run_id of the execution input, else the execution name
+# - Completed stages are kept as run#<run_id>#<stage>#<account> items of ledger_table_name
+#   (DynamoDB, keyed by account_id; the stack owned SHRunLedgerTable, not the imported members
+#   table) or in ledger_path (local JSON file stand-in)
+# - summary entries keep the member summary, so a resumed run (resume: true) emails it without
+#   querying Security Hub again; email entries keep the delivery status
+# - Only completed work is recorded, so failed sends are retried by a resumed run
+# - DynamoDB items carry expires_at (now + ledger_ttl_days) for the table's TTL
+#
+
+import os
+import json
+import time
+import logging
+import threading
+import sh_logging
+import sh_metrics
+import sh_retry
+
+LOGGER = logging.getLogger()
+
+SUMMARY = 'summary'
+EMAIL = 'email'
+
+ledger_ttl_days = int(os.environ.get('ledger_ttl_days', '7'))
+
+_session = None
+
+def entry_key(run_id, stage, member_account):
+    return 'run#{}#{}#{}'.format(run_id, stage, member_account)
+
+class LocalRunLedger(object):
+    # Ledger kept in a local JSON file
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as ledger_file:
+                self.data = json.load(ledger_file)
+        except FileNotFoundError:
+            self.data = {}
+
+    def get_completed(self, run_id, stage, member_accounts):
+        with self.lock:
+            return {
+                member_account: self.data[entry_key(run_id, stage, member_account)]
+                for member_account in member_accounts if entry_key(run_id, stage, member_account) in self.data
+            }
+
+    def put_completed(self, run_id, stage, entries):
+        if len(entries) == 0:
+            return
+        with self.lock:
+            self.data.update({ entry_key(run_id, stage, member_account): entry for member_account, entry in entries.items() })
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as ledger_file:
+                json.dump(self.data, ledger_file)
+            os.replace(tmp_path, self.path)
+
+class DynamoDBRunLedger(object):
+    # Ledger kept as run#<run_id>#<stage>#<account> items of a DynamoDB table keyed by account_id
+    def __init__(self, db_client, table_name):
+        self.db_client = db_client
+        self.table_name = table_name
+
+    def get_completed(self, run_id, stage, member_accounts):
+        completed = {}
+        keys = [ entry_key(run_id, stage, member_account) for member_account in member_accounts ]
+        for item in sh_retry.batch_get_items(self.db_client, self.table_name, keys):
+            completed[item['account_id']['S'].rsplit('#', 1)[1]] = sh_logging.loads(item['entry']['S'])
+        return completed
+
+    def put_completed(self, run_id, stage, entries):
+        expires_at = str(int(time.time()) + ledger_ttl_days * 86400)
+        items = [
+            {
+                'account_id': { 'S': entry_key(run_id, stage, member_account) },
+                'entry': { 'S': sh_logging.dumps(entry) },
+                'expires_at': { 'N': expires_at }
+            } for member_account, entry in entries.items()
+        ]
+        sh_retry.batch_write_items(self.db_client, self.table_name, items)
+
+class LedgerRecorder(object):
+    # Thread safe buffer of completed entries, written 25 at a time (one BatchWriteItem)
+    def __init__(self, ledger, run_id, stage, batch_size=25):
+        self.ledger = ledger
+        self.run_id = run_id
+        self.stage = stage
+        self.batch_size = batch_size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def record(self, entries):
+        with self.lock:
+            self.entries.update(entries)
+            if len(self.entries) < self.batch_size:
+                return
+            entries, self.entries = self.entries, {}
+        put_completed(self.ledger, self.run_id, self.stage, entries)
+
+    def flush(self):
+        with self.lock:
+            entries, self.entries = self.entries, {}
+        put_completed(self.ledger, self.run_id, self.stage, entries)
+
+def get_run_ledger(session=None):
+    global _session
+    if 'ledger_table_name' in os.environ:
+        if session is None:
+            if _session is None:
+                import boto3
+                _session = sh_metrics.instrument(boto3.Session())
+            session = _session
+        return DynamoDBRunLedger(sh_retry.get_client(session, 'dynamodb'), os.environ['ledger_table_name'])
+    return LocalRunLedger(os.environ.get('ledger_path', '/tmp/sh-run-ledger.json'))
+
+def get_completed(ledger, run_id, stage, member_accounts):
+    # Entries of member_accounts completed by run_id; none when the ledger cannot be read
+    try:
+        return ledger.get_completed(run_id, stage, member_accounts)
+    except Exception as e:
+        LOGGER.error(f'failed in get_completed(..): {e}')
+        LOGGER.error(str(e))
+        return {}
+
+def put_completed(ledger, run_id, stage, entries):
+    # A lost ledger write only means the work is done again by a resumed run
+    try:
+        ledger.put_completed(run_id, stage, entries)
+    except Exception as e:
+        LOGGER.error(f'failed in put_completed(..): {e}')
+        LOGGER.error(str(e))
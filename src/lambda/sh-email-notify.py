@@ -1,16 +1,32 @@
 import os
-import sys
 import json
 import boto3
 import logging
 from datetime import datetime, date
 import traceback
+import payload_store
+import template_renderer
+import digest_store
+import run_ledger
+import sh_logging
+import sh_metrics
+import sh_retry
+import time
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # env variables
 # sender_email = 'kd-audit@kyndryl.com'
 # template_name = <set by stack>
+# max_workers = <parallel send_bulk_templated_email calls in batch mode>
+# render_mode = 'ses' (SES renders template_name) | 'local' (render here and send_email)
+# template_path = <optional local copy of the SES template json for render_mode 'local'>
+# suppress_unchanged = 'true' skips Members whose report is unchanged since the last one sent
+# digest_table_name / digest_store_path = <where report digests are kept, see digest_store>
+# ledger_table_name / ledger_path = <run ledger of batch mode events with a run_id, see run_ledger>
 
-session = boto3.Session()
+session = sh_metrics.instrument(boto3.Session())
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -24,31 +40,299 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError('Type %s not serializable' % type(obj))
 
-def send_notification(ses_client, sender_email_address, to_email_address, cc_email_addresses, template_name, member_summary_data):
+# SendBulkTemplatedEmail accepts at most 50 destinations per call
+bulk_max_destinations = 50
+
+render_mode = os.environ.get('render_mode', 'ses')
+# Skip reports identical to the last report sent; event 'force': true sends them anyway
+suppress_unchanged = os.environ.get('suppress_unchanged', 'false').lower() == 'true'
+
+# Compiled email templates by template name, kept across warm invocations
+email_templates = {}
+
+class TokenBucket(object):
+    # Thread safe token bucket refilled at the SES maximum send rate
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # requests larger than the bucket take the bucket into debt: all tokens are taken
+        # and the caller waits until the balance is back to zero, so bulk sends of more
+        # recipients than the capacity are paced at rate on average
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= float(tokens)
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+def get_send_rate(ses_client):
+    try:
+        response = ses_client.get_send_quota()
+        return response['MaxSendRate']
+    except Exception as e:
+        LOGGER.error(f'failed in get_send_quota(..): {e}')
+        LOGGER.error(str(e))
+        # SES sandbox default
+        return 1.0
+
+def get_destination(to_email_address, cc_email_addresses):
     destination = {
         'ToAddresses': [ to_email_address ]
     }
     # If cc_email_addresses has an email address, then add cc
     if len(cc_email_addresses) > 0:
-        destination = {
-            'ToAddresses': [ to_email_address ],
+        destination.update({
             'CcAddresses': [ cc_email_addresses ]
-        }
+        })
+    return destination
+
+def send_notification(ses_client, sender_email_address, to_email_address, cc_email_addresses, template_name, member_summary_data):
+    destination = get_destination(to_email_address, cc_email_addresses)
     try:
         response = ses_client.send_templated_email(
             Source=sender_email_address,
             Destination=destination,
             Template=template_name,
-            TemplateData=json.dumps(member_summary_data)
+            TemplateData=sh_logging.dumps(member_summary_data)
         )
-        print(json.dumps(response, indent=2))
+        LOGGER.debug('send_templated_email(..): %s', sh_logging.lazy(response))
+        return { 'email_status': 'Success', 'message_id': response['MessageId'], 'error': None }
     except Exception as e:
         LOGGER.error(f'failed in send_templated_email(..): {e}')
         LOGGER.error(str(e))
         print(traceback.format_exc())
+        return { 'email_status': 'Failed', 'message_id': None, 'error': str(e) }
 
+def get_email_template(ses_client, template_name):
+    # Compile the template once per container, from template_path or from SES
+    if template_name in email_templates:
+        return email_templates[template_name]
+    try:
+        if 'template_path' in os.environ:
+            with open(os.environ['template_path']) as template_file:
+                template = json.load(template_file)['Template']
+        else:
+            template = ses_client.get_template(TemplateName=template_name)['Template']
+        email_template = template_renderer.EmailTemplate(template)
+    except Exception as e:
+        LOGGER.error(f'failed in get_email_template(..): {e}')
+        LOGGER.error(str(e))
+        raise
+    email_templates[template_name] = email_template
+    return email_template
+
+def send_rendered_notification(ses_client, sender_email_address, destination, email_template, member_summary_data):
+    # Render locally (memoized by a digest of member_summary_data) and send with send_email
+    digest, parts = email_template.render(member_summary_data)
+    body = {}
+    if 'HtmlPart' in parts:
+        body['Html'] = { 'Charset': 'UTF-8', 'Data': parts['HtmlPart'] }
+    if 'TextPart' in parts:
+        body['Text'] = { 'Charset': 'UTF-8', 'Data': parts['TextPart'] }
+    try:
+        response = ses_client.send_email(
+            Source=sender_email_address,
+            Destination=destination,
+            Message={
+                'Subject': { 'Charset': 'UTF-8', 'Data': parts.get('SubjectPart', '') },
+                'Body': body
+            }
+        )
+        return { 'email_status': 'Success', 'message_id': response['MessageId'], 'error': None, 'report_digest': digest }
+    except Exception as e:
+        LOGGER.error(f'failed in send_email(..): {e}')
+        LOGGER.error(str(e))
+        LOGGER.error(traceback.format_exc())
+        return { 'email_status': 'Failed', 'message_id': None, 'error': str(e), 'report_digest': digest }
+
+def get_member_summary_data(member):
+    return {
+        'member_account': member['account_id'],
+        'severity_count': member['severity_count'],
+        'SecurityHub': member['SecurityHub']
+    }
+
+def send_bulk_notification(ses_client, token_bucket, sender_email_address, template_name, members):
+    # Send up to bulk_max_destinations members with one send_bulk_templated_email call
+    # and return the delivery status of each member
+    destinations = []
+    recipients = 0
+    for member in members:
+        destination = get_destination(member['account_email'], member.get('tech_owner_email', ''))
+        recipients += len(destination['ToAddresses']) + len(destination.get('CcAddresses', []))
+        destinations.append({
+            'Destination': destination,
+            'ReplacementTemplateData': sh_logging.dumps(get_member_summary_data(member))
+        })
+    token_bucket.acquire(recipients)
+    try:
+        response = ses_client.send_bulk_templated_email(
+            Source=sender_email_address,
+            Template=template_name,
+            DefaultTemplateData=sh_logging.dumps({ 'member_account': '', 'severity_count': [], 'SecurityHub': [] }),
+            Destinations=destinations
+        )
+        statuses = []
+        for status in response['Status']:
+            statuses.append({
+                'email_status': status['Status'],
+                'message_id': status.get('MessageId'),
+                'error': status.get('Error')
+            })
+        return statuses
+    except Exception as e:
+        LOGGER.error(f'failed in send_bulk_templated_email(..): {e}')
+        LOGGER.error(str(e))
+        LOGGER.error(traceback.format_exc())
+        return [ { 'email_status': 'Failed', 'message_id': None, 'error': str(e) } for member in members ]
+
+def send_rendered_notifications(ses_client, token_bucket, sender_email_address, email_template, members):
+    # Send each member its locally rendered email and return the delivery status of each member
+    statuses = []
+    for member in members:
+        destination = get_destination(member['account_email'], member.get('tech_owner_email', ''))
+        token_bucket.acquire(len(destination['ToAddresses']) + len(destination.get('CcAddresses', [])))
+        statuses.append(send_rendered_notification(ses_client, sender_email_address, destination, email_template, get_member_summary_data(member)))
+    return statuses
+
+def get_unchanged_members(store, digests, force):
+    # Member Accounts whose report digest matches the digest of the last report sent
+    if force or len(digests) == 0:
+        return set()
+    try:
+        sent_digests = store.get_digests(list(digests))
+    except Exception as e:
+        LOGGER.error(f'failed in get_digests(..): {e}')
+        LOGGER.error(str(e))
+        return set()
+    return set([ member_account for member_account, digest in digests.items() if sent_digests.get(member_account) == digest ])
+
+def save_sent_digests(store, digests, member_statuses):
+    sent_digests = {}
+    for member in member_statuses:
+        if member['email_status'] == 'Success' and member['account_id'] in digests:
+            sent_digests[member['account_id']] = digests[member['account_id']]
+    try:
+        store.put_digests(sent_digests)
+    except Exception as e:
+        LOGGER.error(f'failed in put_digests(..): {e}')
+        LOGGER.error(str(e))
+
+def summary_failed_status():
+    return { 'email_status': 'SummaryFailed', 'message_id': None, 'error': 'Security Hub summary failed, no report sent' }
+
+def ledger_entry(status):
+    return { 'email_status': status['email_status'], 'message_id': status.get('message_id') }
+
+def send_batch_notifications(ses_client, sender_email_address, template_name, member_list, max_workers, force=False, run_id=None, resume=False):
+    # Members already sent by an earlier attempt are not sent again
+    pending = [ member for member in member_list if member.get('email_status') != 'Success' ]
+    # Members whose summary failed (sh-summary-collector summary_status) get no report
+    summary_failed = [ member for member in pending if member.get('summary_status') == 'failed' ]
+    pending = [ member for member in pending if member.get('summary_status') != 'failed' ]
+    # With a run_id, completed sends are recorded in the run ledger as they finish;
+    # a resumed run skips the Members its earlier executions completed
+    ledger = run_ledger.get_run_ledger(session) if run_id else None
+    completed = {}
+    if ledger is not None and resume:
+        completed = run_ledger.get_completed(ledger, run_id, run_ledger.EMAIL, [ member['account_id'] for member in pending ])
+        pending = [ member for member in pending if member['account_id'] not in completed ]
+        LOGGER.info("Resuming run {}: {} Members already completed".format(run_id, len(completed)))
+    recorder = run_ledger.LedgerRecorder(ledger, run_id, run_ledger.EMAIL) if ledger is not None else None
+    unchanged = []
+    if suppress_unchanged:
+        store = digest_store.get_digest_store(session)
+        digests = {}
+        for member in pending:
+            destination = get_destination(member['account_email'], member.get('tech_owner_email', ''))
+            digests[member['account_id']] = digest_store.report_digest(get_member_summary_data(member), destination, template_name)
+        unchanged_accounts = get_unchanged_members(store, digests, force)
+        unchanged = [ member for member in pending if member['account_id'] in unchanged_accounts ]
+        pending = [ member for member in pending if member['account_id'] not in unchanged_accounts ]
+        LOGGER.info("Skipping {} Members with unchanged Summary Reports".format(len(unchanged)))
+    # one send rate limit shared by every worker
+    token_bucket = TokenBucket(get_send_rate(ses_client))
+    if render_mode == 'local':
+        email_template = get_email_template(ses_client, template_name)
+        chunk_size = 1
+        send_chunk = functools.partial(send_rendered_notifications, ses_client, token_bucket, sender_email_address, email_template)
+    else:
+        chunk_size = bulk_max_destinations
+        send_chunk = functools.partial(send_bulk_notification, ses_client, token_bucket, sender_email_address, template_name)
+    if recorder is not None:
+        recorder.record({ member['account_id']: { 'email_status': 'Unchanged', 'message_id': None } for member in unchanged })
+        send_chunk = record_chunk(send_chunk, recorder)
+    chunks = [ pending[idx:idx + chunk_size] for idx in range(0, len(pending), chunk_size) ]
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            chunk_statuses = list(executor.map(send_chunk, chunks))
+    finally:
+        # keep what was sent even when a chunk failed
+        if recorder is not None:
+            recorder.flush()
+    member_statuses = []
+    for member in member_list:
+        if member.get('email_status') == 'Success':
+            member_statuses.append(member)
+        elif member['account_id'] in completed:
+            member_status = dict(member)
+            member_status.update(completed[member['account_id']])
+            member_status.update({ 'error': None, 'resumed': True })
+            member_statuses.append(member_status)
+    for member in summary_failed:
+        member_status = dict(member)
+        member_status.update(summary_failed_status())
+        member_statuses.append(member_status)
+    for member in unchanged:
+        member_status = dict(member)
+        member_status.update({ 'email_status': 'Unchanged', 'message_id': None, 'error': None })
+        member_statuses.append(member_status)
+    for chunk, statuses in zip(chunks, chunk_statuses):
+        for member, status in zip(chunk, statuses):
+            member_status = dict(member)
+            member_status.update(status)
+            member_statuses.append(member_status)
+    if suppress_unchanged:
+        save_sent_digests(store, digests, member_statuses)
+    return member_statuses
+
+def record_chunk(send_chunk, recorder):
+    # send_chunk that records the Members it sent successfully
+    def send_and_record(chunk):
+        statuses = send_chunk(chunk)
+        recorder.record({
+            member['account_id']: ledger_entry(status)
+            for member, status in zip(chunk, statuses) if status['email_status'] == 'Success'
+        })
+        return statuses
+    return send_and_record
+
+@sh_metrics.metrics_handler
 def lambda_handler(event, context):
-    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    LOGGER.info('REQUEST RECEIVED: %s', sh_logging.lazy(event))
+    # Batch mode: send all member summaries in member_list with bulk templated emails
+    if 'member_list' in event or 'member_list_ref' in event:
+        sender_email_address = os.environ['sender_email']
+        template_name = os.environ['template_name']
+        max_workers = int(os.environ.get('max_workers', '4'))
+        ses_client = sh_retry.get_client(session, 'ses')
+        member_list = list(payload_store.records_from_event(event, 'member_list'))
+        LOGGER.info("Sending Summary Report Data for {} Members ..".format(len(member_list)))
+        member_statuses = send_batch_notifications(ses_client, sender_email_address, template_name, member_list, max_workers, event.get('force', False), event.get('run_id'), event.get('resume', False))
+        payload = payload_store.to_payload('member_list', member_statuses)
+        payload.update({
+            'failed_count': len([ member for member in member_statuses if member['email_status'] not in ('Success', 'Unchanged') ]),
+            'unchanged_count': len([ member for member in member_statuses if member['email_status'] == 'Unchanged' ]),
+            'email_template': template_name
+        })
+        return payload
     member_account = event['account_id']
     to_address = event['account_email']
     cc_addresses = ''
@@ -63,22 +347,35 @@ def lambda_handler(event, context):
     }
     sender_email_address = os.environ['sender_email']
     template_name = os.environ['template_name']
-    ses_client = session.client('ses')
+    ses_client = sh_retry.get_client(session, 'ses')
     LOGGER.info("Sending Summary Report Data ..")
-    status = send_notification(ses_client, sender_email_address, to_address, cc_addresses, template_name, member_summary_data)
-    if len(cc_addresses) > 0:
-        return {
-            'account_id': member_account,
-            'to_address': to_address,
-            'cc_addresses': cc_addresses,
-            'member_summary': member_summary_data,
-            'email_template': template_name
-        }
+    destination = get_destination(to_address, cc_addresses)
+    store = None
+    digests = {}
+    if suppress_unchanged:
+        store = digest_store.get_digest_store(session)
+        digests[member_account] = digest_store.report_digest(member_summary_data, destination, template_name)
+    if event.get('summary_status') == 'failed':
+        LOGGER.error("Summary failed for {}, skipping ..".format(member_account))
+        status = summary_failed_status()
+    elif member_account in get_unchanged_members(store, digests, event.get('force', False)):
+        LOGGER.info("Summary Report unchanged, skipping ..")
+        status = { 'email_status': 'Unchanged', 'message_id': None, 'error': None }
+    elif render_mode == 'local':
+        email_template = get_email_template(ses_client, template_name)
+        status = send_rendered_notification(ses_client, sender_email_address, destination, email_template, member_summary_data)
     else:
-        return {
-            'account_id': member_account,
-            'to_address': to_address,
-            'member_summary': member_summary_data,
-            'email_template': template_name
-        }
+        status = send_notification(ses_client, sender_email_address, to_address, cc_addresses, template_name, member_summary_data)
+    if suppress_unchanged:
+        save_sent_digests(store, digests, [ dict(status, account_id=member_account) ])
+    result = {
+        'account_id': member_account,
+        'to_address': to_address,
+        'member_summary': member_summary_data,
+        'email_template': template_name
+    }
+    if len(cc_addresses) > 0:
+        result.update({ 'cc_addresses': cc_addresses })
+    result.update(status)
+    return result
 
@@ -0,0 +1,150 @@
+#
+# Purpose: Near real time summary updates from Security Hub "Findings - Imported" events
+# NOTE:
+# - Events reach this Lambda through an SQS queue (EventBridge rule target); the SQS event
+#   source collects them for the batching window, so each invocation is one micro-batch
+# - Also accepts a single EventBridge event or { 'events': [..] } (replayed recordings)
+# - The latest version of every finding in the batch is applied in place to the stored
+#   per-account severity/type counts of incremental summary mode (sh-summary-collector
+#   stream_aggregate), without a get_findings pass
+# - Accounts whose HIGH or CRITICAL counts reach high_threshold / critical_threshold in this
+#   batch (below before, at or above after) get their updated report from sh-email-notify,
+#   invoked asynchronously as notify_function_name; without it notifications are only returned
+# - Counts of an account are read, updated and written back under a lease on its stored state,
+#   shared with scheduled incremental summaries: a batch waits (at most lease_wait_seconds) for a
+#   running summary of the same accounts to commit, then fails and is received again
+#
+
+import os
+import logging
+import importlib.util
+import payload_store
+import sh_logging
+import sh_metrics
+import sh_retry
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+high_threshold = int(os.environ.get('high_threshold', '10'))
+critical_threshold = int(os.environ.get('critical_threshold', '1'))
+notify_function_name = os.environ.get('notify_function_name')
+# GetMembers accepts at most 50 account ids
+get_members_max_accounts = 50
+
+def load_lambda_module(name):
+    # Lambda source files have hyphenated names and are bundled next to this file
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name + '.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+get_sh_members = load_lambda_module('get-sh-members')
+sh_summary_collector = load_lambda_module('sh-summary-collector')
+session = sh_summary_collector.session
+
+def get_events(event):
+    # EventBridge events of an SQS batch, a replayed list or a single event
+    if 'Records' in event:
+        return [ sh_logging.loads(record['body']) for record in event['Records'] ]
+    if 'events' in event:
+        return event['events']
+    return [ event ]
+
+def get_findings(events):
+    # Latest version (UpdatedAt) of each finding of the batch
+    latest = {}
+    for finding_event in events:
+        if finding_event.get('detail-type') != 'Security Hub Findings - Imported':
+            continue
+        for finding in finding_event['detail'].get('findings', []):
+            previous = latest.get(finding['Id'])
+            if previous is None or finding.get('UpdatedAt', '') >= previous.get('UpdatedAt', ''):
+                latest[finding['Id']] = finding
+    return list(latest.values())
+
+def severity_total(account_counts, severity_label):
+    # Findings of severity_label over all standards (severity|<standard index>|<label> keys)
+    return sum([ count for key, count in account_counts.items() if key.startswith('severity|') and key.endswith('|' + severity_label) ])
+
+def crossed_thresholds(previous_counts, account_counts):
+    # Severities whose total reached its threshold with this batch
+    crossed = []
+    for severity_label, threshold in (('CRITICAL', critical_threshold), ('HIGH', high_threshold)):
+        if severity_total(previous_counts, severity_label) < threshold <= severity_total(account_counts, severity_label):
+            crossed.append(severity_label)
+    return crossed
+
+def get_member_list(sh_admin_client, member_accounts):
+    # Members as listed by get-sh-members: account email from Security Hub, tech owner
+    # email from table_name (members without an entry are dropped, as in the reports)
+    members = []
+    for idx in range(0, len(member_accounts), get_members_max_accounts):
+        response = sh_admin_client.get_members(AccountIds=member_accounts[idx:idx + get_members_max_accounts])
+        members.extend([
+            {
+                'account_id': member['AccountId'],
+                'account_email': member['Email'],
+                'sh_status': member['MemberStatus']
+            } for member in response['Members']
+        ])
+    if 'table_name' not in os.environ:
+        return members
+    db_client = sh_retry.get_client(session, 'dynamodb')
+    return list(get_sh_members.add_account_emails(db_client, os.environ['table_name'], members))
+
+def notify(sh_admin_client, alerts, accounts_counts):
+    # Send the updated reports of the alerted accounts through sh-email-notify (batch mode)
+    member_list = [
+        sh_summary_collector.member_summary_output(member, sh_summary_collector.to_member_summary(accounts_counts[member['account_id']]))
+        for member in get_member_list(sh_admin_client, sorted(alerts))
+    ]
+    if len(member_list) == 0:
+        return 0
+    lambda_client = sh_retry.get_client(session, 'lambda')
+    lambda_client.invoke(
+        FunctionName=notify_function_name,
+        InvocationType='Event',
+        Payload=sh_logging.dumps(payload_store.to_payload('member_list', member_list)).encode('utf-8')
+    )
+    return len(member_list)
+
+@sh_metrics.metrics_handler
+def lambda_handler(event, context):
+    LOGGER.info('REQUEST RECEIVED: %s', sh_logging.lazy(event))
+    events = get_events(event)
+    findings = get_findings(events)
+    if len(findings) == 0:
+        return { 'event_count': len(events), 'finding_count': 0, 'account_count': 0, 'alerts': {}, 'notified_count': 0 }
+    sh_admin_client = sh_retry.get_client(session, 'securityhub')
+    store = sh_summary_collector.get_summary_store()
+    # failures raise, so the SQS batch is received again; stored contributions that were
+    # not committed are ignored by the retry
+    accounts_changes = sh_summary_collector.stream_aggregate(sh_admin_client, store, findings)
+    alerts = {}
+    for member_account, (previous_counts, account_counts) in accounts_changes.items():
+        if previous_counts is None:
+            continue
+        crossed = crossed_thresholds(previous_counts, account_counts)
+        if len(crossed) > 0:
+            alerts[member_account] = crossed
+    notified_count = 0
+    if len(alerts) > 0 and notify_function_name:
+        try:
+            notified_count = notify(sh_admin_client, alerts, { member_account: account_counts for member_account, (previous_counts, account_counts) in accounts_changes.items() })
+        except Exception as e:
+            LOGGER.error(f'failed in notify(..): {e}')
+            LOGGER.error(str(e))
+    LOGGER.info('Applied {} findings of {} events to {} accounts, {} alerts, {} notified'.format(len(findings), len(events), len(accounts_changes), len(alerts), notified_count))
+    return {
+        'event_count': len(events),
+        'finding_count': len(findings),
+        'account_count': len(accounts_changes),
+        'alerts': alerts,
+        'notified_count': notified_count
+    }
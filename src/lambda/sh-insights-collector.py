@@ -1,14 +1,28 @@
 import os
-import sys
-import json
-import boto3
-import urllib3
 import logging
 from datetime import date, datetime
-import time
-from arnparse import arnparse
+from concurrent.futures import ThreadPoolExecutor
+from arnparse import arnparse_many
+import sts_session_cache
+import sh_async
+import sh_logging
+import sh_metrics
 
-session = boto3.Session()
+# work_queue is imported on first use (queue distribution only)
+work_queue = None
+# findings_snapshot is imported on first use (snapshot mode only)
+findings_snapshot = None
+
+# Bounded worker pool size for per-member I/O (work queue sends)
+max_workers = int(os.environ.get('max_workers', '8'))
+# inline: return the member insight results for the resource findings step
+# queue: enqueue (account, region, resources) work items for sh-resource-findings consumers
+distribution = os.environ.get('distribution', 'inline').lower()
+# Security Hub accepts at most 20 values per filter field, one query per work item
+work_item_resources = 20
+# read: results of insights grouped by ResourceId are counted from a fresh findings snapshot
+# of the members (saved by sh-summary-collector), GetInsightResults is called without one
+snapshot_mode = os.environ.get('snapshot_mode', 'off').lower()
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -22,43 +36,27 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError('Type %s not serializable' % type(obj))
 
-def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    LOGGER.info("Assumed region_session for Account {}".format(aws_account_number))
-    return sts_session
-
 def get_members(sh_admin_client):
-    member_list = []
+    # Lazily yield members page by page
     try:
         paginator = sh_admin_client.get_paginator('list_members')
         iterator = paginator.paginate(OnlyAssociated=True)
         for page in iterator:
             for member in page['Members']:
-                member_list.append({
+                yield {
                     'AccountId': member['AccountId'],
                     'Email': member['Email'],
                     'MemberStatus': member['MemberStatus']
-                })
-        return member_list
+                }
     except Exception as e:
         LOGGER.error(f'failed in list_members(..): {e}')
         LOGGER.error(str(e))
 
+def get_insight_arn(insight_arn_suffix):
+    return 'arn:aws:securityhub:::insight/securityhub/default/{}'.format(insight_arn_suffix)
+
 def get_insight_data(sh_admin_client, insight_arn_suffix):
-    sh_insight_arn = 'arn:aws:securityhub:::insight/securityhub/default/{}'.format(insight_arn_suffix)
+    sh_insight_arn = get_insight_arn(insight_arn_suffix)
     try:
         paginator = sh_admin_client.get_paginator('get_insights')
         iterator = paginator.paginate(
@@ -71,47 +69,140 @@ def get_insight_data(sh_admin_client, insight_arn_suffix):
         LOGGER.error(f'failed in get_insights(..): {e}')
         LOGGER.error(str(e))
 
-def member_insight_results(sh_admin_client, insight_data, member_account):
-    account_insight_results = []
+def list_members(sh_admin_client):
+    return list(get_members(sh_admin_client))
+
+def get_insight_results(sh_admin_client, insight_arn):
     try:
-        response = sh_admin_client.get_insight_results(InsightArn=insight_data['InsightArn'])
-        for result in response['InsightResults']['ResultValues']:
-            #print(json.dumps(result, indent=2))
-            # parse resource arn
-            #arn:aws:ec2:us-west-2:863224780407:instance/i-0575030ea9e05460d
-            resource_arn = arnparse(result['GroupByAttributeValue'])
-            if resource_arn.account_id is not None and resource_arn.account_id == member_account:
-                print('Resource Id: %s' % resource_arn.resource)
-                print('Resource Region: %s' % resource_arn.region)
-                print('Number of Findings: %d' % result['Count'])
-                account_insight_results.append({
-                    'AccountId': resource_arn.account_id,
-                    'ResourceId': result['GroupByAttributeValue'],
-                    'ResourceRegion': resource_arn.region
-                })
-        return account_insight_results
+        response = sh_admin_client.get_insight_results(InsightArn=insight_arn)
+        return response['InsightResults']['ResultValues']
     except Exception as e:
         LOGGER.error(f'failed in get_insight_results(..): {e}')
         LOGGER.error(str(e))
 
+def get_snapshot_insight_results(insight_data, member_list):
+    # ResultValues of the insight from the snapshot, None when it cannot answer the insight.
+    # Snapshots hold ACTIVE FAILED findings with a NEW or NOTIFIED workflow; of the insight's
+    # filters, the SeverityLabel EQUALS values are applied
+    global findings_snapshot
+    import findings_snapshot
+    if insight_data is None or insight_data.get('GroupByAttribute') != 'ResourceId':
+        return None
+    try:
+        snapshot = findings_snapshot.load_snapshot([ member['AccountId'] for member in member_list ])
+        if snapshot is None:
+            return None
+        severities = [
+            severity_filter['Value']
+            for severity_filter in insight_data.get('Filters', {}).get('SeverityLabel', [])
+            if severity_filter.get('Comparison') == 'EQUALS'
+        ]
+        LOGGER.info('Using findings snapshot of {} findings'.format(len(snapshot)))
+        return snapshot.resource_counts(severities=severities or None)
+    except Exception as e:
+        LOGGER.error(f'failed in get_snapshot_insight_results(..): {e}')
+        LOGGER.error(str(e))
+
+def partition_insight_results(insight_results):
+    # Parse each resource arn once and group results by member account
+    accounts_insight_results = {}
+    results_by_arn = { result['GroupByAttributeValue']: result for result in insight_results }
+    #arn:aws:ec2:us-west-2:863224780407:instance/i-0575030ea9e05460d
+    sampler = sh_logging.LogSampler(LOGGER, 'insight_resource')
+    for account_id, account_arns in arnparse_many(results_by_arn, ignore_malformed=True).items():
+        if account_id is None:
+            continue
+        for arn_str, resource_arn in account_arns:
+            sampler.log(resource_id=resource_arn.resource, region=resource_arn.region, findings=results_by_arn[arn_str]['Count'])
+            accounts_insight_results.setdefault(account_id, []).append({
+                'AccountId': account_id,
+                'ResourceId': arn_str,
+                'ResourceRegion': resource_arn.region
+            })
+    sampler.summary(accounts=len(accounts_insight_results))
+    return accounts_insight_results
+
+def member_insight_results(accounts_insight_results, member_account):
+    return accounts_insight_results.get(member_account, [])
+
+def get_work_items(member_insights_result):
+    # Split the member's resources into (region, up to work_item_resources resources) items
+    region_resources = {}
+    for result in member_insights_result['member_insight_results']:
+        region_resources.setdefault(result['ResourceRegion'], [])
+        if result['ResourceId'] not in region_resources[result['ResourceRegion']]:
+            region_resources[result['ResourceRegion']].append(result['ResourceId'])
+    work_items = []
+    for region, resource_ids in region_resources.items():
+        for idx in range(0, len(resource_ids), work_item_resources):
+            chunk = resource_ids[idx:idx + work_item_resources]
+            work_items.append({
+                'item_id': work_queue.item_id(member_insights_result['member_account'], region, chunk),
+                'org_id': member_insights_result['org_id'],
+                'assume_role': member_insights_result['assume_role'],
+                'audit_account': member_insights_result['audit_account'],
+                'insight_arn': member_insights_result['insight_arn'],
+                'insight_name': member_insights_result['insight_name'],
+                'member_account': member_insights_result['member_account'],
+                'region': region,
+                'resource_ids': chunk
+            })
+    return work_items
+
+def enqueue_member(queue, member_insights_result):
+    # Work items of one member are sent together; the member reports how many were queued
+    work_items = get_work_items(member_insights_result)
+    try:
+        queue.send(work_items)
+        queued = len(work_items)
+    except Exception as e:
+        LOGGER.error(f'failed in send_message_batch(..): {e}')
+        LOGGER.error(str(e))
+        queued = 0
+    return {
+        'org_id': member_insights_result['org_id'],
+        'audit_account': member_insights_result['audit_account'],
+        'insight_arn': member_insights_result['insight_arn'],
+        'insight_name': member_insights_result['insight_name'],
+        'member_account': member_insights_result['member_account'],
+        'work_items': len(work_items),
+        'queued_items': queued
+    }
+
+@sh_metrics.metrics_handler
 def lambda_handler(event, context):
-    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    LOGGER.info('REQUEST RECEIVED: %s', sh_logging.lazy(event))
     resProps = event['ResourceProperties']
     org_id = resProps['org_id']
     assume_role_name = resProps['assume_role']
     audit_account = resProps['audit_account']
     insight_arn_suffix = resProps['insight_arn_suffix']
-    sh_admin_session = assume_role(org_id, audit_account, assume_role_name)
-    sh_admin_client = sh_admin_session.client('securityhub')
-    insight_data = get_insight_data(sh_admin_client, insight_arn_suffix)
-    member_list = get_members(sh_admin_client)
-    members_insights_results = []
-    for member_json in member_list:
+    sh_admin_client = sts_session_cache.get_client(org_id, audit_account, assume_role_name, 'securityhub')
+    # Insight, members and insight results are independent and fetched concurrently;
+    # insight results are fetched once and partitioned by member account
+    if snapshot_mode == 'read':
+        insight_data, member_list = sh_async.run_all([
+            (get_insight_data, (sh_admin_client, insight_arn_suffix), {}),
+            (list_members, (sh_admin_client,), {})
+        ])
+        insight_results = get_snapshot_insight_results(insight_data, member_list)
+        if insight_results is None:
+            insight_results = get_insight_results(sh_admin_client, get_insight_arn(insight_arn_suffix))
+    else:
+        insight_data, member_list, insight_results = sh_async.run_all([
+            (get_insight_data, (sh_admin_client, insight_arn_suffix), {}),
+            (list_members, (sh_admin_client,), {}),
+            (get_insight_results, (sh_admin_client, get_insight_arn(insight_arn_suffix)), {})
+        ])
+    accounts_insight_results = partition_insight_results(insight_results or [])
+    sampler = sh_logging.LogSampler(LOGGER, 'member_insights')
+
+    def member_insights(member_json):
         member_account = member_json['AccountId']
-        print('Insights for Member: %s' % member_account)
-        member_results = member_insight_results(sh_admin_client, insight_data, member_account)
+        member_results = member_insight_results(accounts_insight_results, member_account)
+        sampler.log(member_account=member_account, resources=len(member_results))
         if len(member_results) > 0:
-            members_insights_results.append({
+            return {
                 'org_id': org_id,
                 'assume_role': assume_role_name,
                 'audit_account': audit_account,
@@ -119,5 +210,20 @@ def lambda_handler(event, context):
                 'insight_name': insight_data['Name'],
                 'member_account': member_account,
                 'member_insight_results': member_results
-            })
+            }
+
+    # per member work is a lookup in the partitioned results
+    members_insights_results = [
+        member_insights_result
+        for member_insights_result in map(member_insights, member_list)
+        if member_insights_result is not None
+    ]
+    sampler.summary(members_with_results=len(members_insights_results))
+    if distribution == 'queue':
+        global work_queue
+        import work_queue
+        queue = work_queue.get_work_queue()
+        # queue sends are I/O and run on the bounded pool
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda member_insights_result: enqueue_member(queue, member_insights_result), members_insights_results))
     return members_insights_results
@@ -0,0 +1,75 @@
+#
+# Purpose: Security Hub Summary Report for a shard of Member Accounts in one invocation
+# NOTE:
+# - Runs get-sh-members -> sh-summary-collector -> sh-email-notify in one process
+# - Event with member_list (or member_list_ref) processes that shard; an empty event processes all members
+# - Summary collection and email sending use the batch modes of those Lambdas (internal parallelism)
+# - Members whose report is unchanged since the last run are skipped unless the event has force: true
+# - With a run_id both stages are recorded in the run ledger; resume: true skips completed members
+#
+
+import os
+import logging
+import importlib.util
+import payload_store
+import sh_logging
+import sh_metrics
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+def load_lambda_module(name):
+    # Lambda source files have hyphenated names and are bundled next to this file
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name + '.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+get_sh_members = load_lambda_module('get-sh-members')
+sh_summary_collector = load_lambda_module('sh-summary-collector')
+sh_email_notify = load_lambda_module('sh-email-notify')
+
+@sh_metrics.metrics_handler
+def lambda_handler(event, context):
+    LOGGER.info('REQUEST RECEIVED: %s', sh_logging.lazy(event))
+    if 'member_list' in event or 'member_list_ref' in event:
+        shard = event
+    else:
+        shard = get_sh_members.lambda_handler({}, context)
+        shard.update({ key: event[key] for key in ('run_id', 'resume') if key in event })
+    summaries = sh_summary_collector.lambda_handler(shard, context)
+    summaries.update({
+        'force': event.get('force', False),
+        'run_id': shard.get('run_id'),
+        'resume': shard.get('resume', False)
+    })
+    email_result = sh_email_notify.lambda_handler(summaries, context)
+    member_count = 0
+    unchanged_count = 0
+    resumed_count = 0
+    failed_members = []
+    for member in payload_store.records_from_event(email_result, 'member_list'):
+        member_count += 1
+        if member.get('resumed', False):
+            resumed_count += 1
+        if member['email_status'] == 'Unchanged':
+            unchanged_count += 1
+        elif member['email_status'] != 'Success':
+            failed_members.append({
+                'account_id': member['account_id'],
+                'email_status': member['email_status'],
+                'error': member.get('error')
+            })
+    LOGGER.info('Shard processed: {} Members, {} unchanged, {} resumed, {} failed'.format(member_count, unchanged_count, resumed_count, len(failed_members)))
+    return {
+        'member_count': member_count,
+        'unchanged_count': unchanged_count,
+        'resumed_count': resumed_count,
+        'failed_count': len(failed_members),
+        'failed_members': failed_members
+    }
@@ -1,11 +1,15 @@
 import os
-import sys
-import json
-import boto3
 import logging
 from datetime import datetime, date
+import sts_session_cache
+import sh_async
+import sh_logging
+import sh_metrics
 
-session = boto3.Session()
+# work_queue is imported on first use (SQS work items only)
+work_queue = None
+# findings_snapshot is imported on first use (snapshot mode only)
+findings_snapshot = None
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -19,83 +23,193 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError('Type %s not serializable' % type(obj))
 
-def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    print("Assumed region_session for Account {}".format(aws_account_number))
-    return sts_session
+# Latest findings reported per Resource
+findings_per_resource = 2
+# Security Hub accepts at most 20 values per filter field
+max_filter_values = 20
+# Query all resources of a region together unless batch_mode is disabled
+batch_mode = os.environ.get('batch_mode', 'true').lower() == 'true'
+# read: take the latest findings from a fresh findings snapshot of the member account (saved by
+# sh-summary-collector) as compact findings with the snapshot's columns; queried without one
+snapshot_mode = os.environ.get('snapshot_mode', 'off').lower()
+# Severities of the reported findings (SeverityLabel of get_findings_filters)
+report_severities = [ 'HIGH', 'CRITICAL' ]
+
+def get_sh_client(org_id, assume_role_name, account_id, region):
+    # one regional client per (account, role, region), reused across resources
+    return sts_session_cache.get_client(org_id, account_id, assume_role_name, 'securityhub', region, endpoint_url=f"https://securityhub.{region}.amazonaws.com")
+
+def get_findings_filters(resource_ids):
+    return {
+        'ResourceId': [
+            {
+                'Value': resource_id,
+                'Comparison': 'EQUALS'
+            } for resource_id in resource_ids
+        ],
+        'WorkflowStatus': [
+            {
+                'Value': 'NEW',
+                'Comparison': 'EQUALS'
+            },
+            {
+                'Value': 'NOTIFIED',
+                'Comparison': 'EQUALS'
+            }
+        ],
+        'RecordState': [
+            {
+                'Value': 'ACTIVE',
+                'Comparison': 'EQUALS'
+            }
+        ],
+        'ComplianceStatus': [
+            {
+                'Value': 'FAILED',
+                'Comparison': 'EQUALS'
+            }
+        ],
+        'SeverityLabel': [
+            {
+                'Value': 'HIGH',
+                'Comparison': 'EQUALS'
+            },
+            {
+                'Value': 'CRITICAL',
+                'Comparison': 'EQUALS'
+            }
+        ]
+    }
+
+def get_sort_criteria():
+    lastObservedCriterion = {
+        'Field': 'LastObservedAt',
+        'SortOrder': 'desc'
+    }
+    sortCriteria = []
+    sortCriteria.append(lastObservedCriterion)
+    return sortCriteria
 
 def get_findings(org_id, assume_role_name, account_id, region, resource_id):
     try:
-        member_session = assume_role(org_id, account_id, assume_role_name)
-        sh_client = member_session.client('securityhub', endpoint_url=f"https://securityhub.{region}.amazonaws.com", region_name=region)
-        filters = {
-            'ResourceId': [
-                {
-                    'Value': resource_id,
-                    'Comparison': 'EQUALS'
-                }
-            ],
-            'WorkflowStatus': [
-                {
-                    'Value': 'NEW',
-                    'Comparison': 'EQUALS'
-                },
-                {
-                    'Value': 'NOTIFIED',
-                    'Comparison': 'EQUALS'
-                }
-            ],
-            'RecordState': [
-                {
-                    'Value': 'ACTIVE',
-                    'Comparison': 'EQUALS'
-                }
-            ],
-            'ComplianceStatus': [
-                {
-                    'Value': 'FAILED',
-                    'Comparison': 'EQUALS'
-                }
-            ],
-            'SeverityLabel': [
-                {
-                    'Value': 'HIGH',
-                    'Comparison': 'EQUALS'
-                },
-                {
-                    'Value': 'CRITICAL',
-                    'Comparison': 'EQUALS'
-                }
-            ]
-        }
-        lastObservedCriterion = {
-            'Field': 'LastObservedAt',
-            'SortOrder': 'desc'
-        }
-        sortCriteria = []
-        sortCriteria.append(lastObservedCriterion)
+        sh_client = get_sh_client(org_id, assume_role_name, account_id, region)
         # Get latest 2 findings per Resource
-        response = sh_client.get_findings(Filters=filters, SortCriteria=sortCriteria, MaxResults=2)
+        response = sh_client.get_findings(Filters=get_findings_filters([ resource_id ]), SortCriteria=get_sort_criteria(), MaxResults=findings_per_resource)
         return response['Findings']
     except Exception as e:
         LOGGER.error(f'failed in get_findings(..): {e}')
         LOGGER.error(str(e))
 
+def get_findings_batch(org_id, assume_role_name, account_id, region, resource_ids):
+    # Query up to max_filter_values resources per call and split the results
+    # client side into the latest findings per Resource
+    resource_findings = { resource_id: [] for resource_id in resource_ids }
+    try:
+        sh_client = get_sh_client(org_id, assume_role_name, account_id, region)
+        for idx in range(0, len(resource_ids), max_filter_values):
+            chunk = resource_ids[idx:idx + max_filter_values]
+            pending = set(chunk)
+            paginator = sh_client.get_paginator('get_findings')
+            iterator = paginator.paginate(
+                Filters=get_findings_filters(chunk),
+                SortCriteria=get_sort_criteria(),
+                PaginationConfig={'PageSize': 100}
+            )
+            for page in iterator:
+                # findings are sorted by LastObservedAt desc across the whole result
+                for finding in page['Findings']:
+                    for resource in finding.get('Resources', []):
+                        resource_id = resource.get('Id')
+                        if resource_id in pending:
+                            resource_findings[resource_id].append(finding)
+                            if len(resource_findings[resource_id]) == findings_per_resource:
+                                pending.discard(resource_id)
+                # every Resource of the chunk has its latest findings
+                if not pending:
+                    break
+        return resource_findings
+    except Exception as e:
+        LOGGER.error(f'failed in get_findings(..): {e}')
+        LOGGER.error(str(e))
+
+def get_snapshot_findings(account_id, resource_ids):
+    # {resource: latest findings} from a snapshot covering account_id, None without one
+    global findings_snapshot
+    import findings_snapshot
+    try:
+        snapshot = findings_snapshot.load_snapshot([ account_id ])
+        if snapshot is None:
+            return None
+        latest = snapshot.latest_findings(resource_ids, findings_per_resource, report_severities)
+        return { resource_id: latest.get(resource_id, []) for resource_id in resource_ids }
+    except Exception as e:
+        LOGGER.error(f'failed in get_snapshot_findings(..): {e}')
+        LOGGER.error(str(e))
+
+def get_region_findings(org_id, assume_role_name, account_id, member_insight_results):
+    # Group resources by region and query each region in batches
+    region_resources = {}
+    for result in member_insight_results:
+        region_resources.setdefault(result['ResourceRegion'], [])
+        if result['ResourceId'] not in region_resources[result['ResourceRegion']]:
+            region_resources[result['ResourceRegion']].append(result['ResourceId'])
+    # regions are queried concurrently
+    regions = list(region_resources)
+    results = sh_async.run_all([
+        (get_findings_batch, (org_id, assume_role_name, account_id, region, region_resources[region]), {})
+        for region in regions
+    ])
+    return dict(zip(regions, results))
+
+def process_work_item(record):
+    # Latest findings of one (account, region, resources) work item, stored under its key;
+    # raises so the message is reported as a batch item failure and received again
+    item = sh_logging.loads(record['body'])
+    resource_findings = None
+    if snapshot_mode == 'read':
+        resource_findings = get_snapshot_findings(item['member_account'], item['resource_ids'])
+    if resource_findings is None:
+        resource_findings = get_findings_batch(item['org_id'], item['assume_role'], item['member_account'], item['region'], item['resource_ids'])
+    if resource_findings is None:
+        raise RuntimeError('no findings for work item {}'.format(item['item_id']))
+    work_queue.put_result(item, {
+        'org_id': item['org_id'],
+        'audit_account': item['audit_account'],
+        'insight_arn': item['insight_arn'],
+        'insight_name': item['insight_name'],
+        'member_account': item['member_account'],
+        'region': item['region'],
+        'resource_findings': resource_findings
+    })
+
+def process_work_items(records):
+    # SQS batch: items are processed concurrently and only failed messages are returned
+    # (ReportBatchItemFailures), so the rest of the batch is not processed again
+    global work_queue
+    import work_queue
+
+    def process(record):
+        try:
+            process_work_item(record)
+            return True
+        except Exception as e:
+            LOGGER.error(f'failed in process_work_item(..): {e}')
+            LOGGER.error(str(e))
+            return False
+
+    processed = sh_async.run_all([ (process, (record,), {}) for record in records ])
+    return {
+        'batchItemFailures': [
+            { 'itemIdentifier': record['messageId'] }
+            for record, success in zip(records, processed) if not success
+        ]
+    }
+
+@sh_metrics.metrics_handler
 def lambda_handler(event, context):
-    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    LOGGER.info('REQUEST RECEIVED: %s', sh_logging.lazy(event))
+    if 'Records' in event:
+        return process_work_items(event['Records'])
     member_insight_findings = []
     resProps = event['ResourceProperties']
     org_id = resProps['org_id']
@@ -105,8 +219,25 @@ def lambda_handler(event, context):
     insight_name = resProps['insight_name']
     member_account = resProps['member_account']
     member_insight_results = resProps['member_insight_results']
-    for result in member_insight_results:
-        findings = get_findings(org_id, assume_role_name, member_account, result['ResourceRegion'], result['ResourceId'])
+    snapshot_findings = None
+    if snapshot_mode == 'read':
+        snapshot_findings = get_snapshot_findings(member_account, [ result['ResourceId'] for result in member_insight_results ])
+    if snapshot_findings is None and batch_mode:
+        region_findings = get_region_findings(org_id, assume_role_name, member_account, member_insight_results)
+    elif snapshot_findings is None:
+        # one query per resource, issued concurrently
+        resources_findings = sh_async.run_all([
+            (get_findings, (org_id, assume_role_name, member_account, result['ResourceRegion'], result['ResourceId']), {})
+            for result in member_insight_results
+        ])
+    for idx, result in enumerate(member_insight_results):
+        if snapshot_findings is not None:
+            findings = snapshot_findings[result['ResourceId']]
+        elif batch_mode:
+            resource_findings = region_findings[result['ResourceRegion']]
+            findings = resource_findings[result['ResourceId']] if resource_findings is not None else None
+        else:
+            findings = resources_findings[idx]
         member_insight_findings.append({
             'org_id': org_id,
             'assume_role': assume_role_name,
@@ -116,4 +247,4 @@ def lambda_handler(event, context):
             'member_account': member_account,
             'resource_findings': findings
         })
-    return member_insight_findings
\ No newline at end of file
+    return member_insight_findings
@@ -6,21 +6,53 @@
 # 1. AWS Foundations Security Best Practices - Software and Configuration Checks/Industry and Regulatory Standards
 # 2. AWS Foundations Security Best Practices - Effects/Data Exposure
 # 3. CIS AWS Foundations Benchmark - Software and Configuration Checks/Industry and Regulatory Standards
+# NOTE:
+# - Both summaries are computed in a single paginated get_findings pass
+#   (no temporary insights are created), for one account or for a whole member_list
+# - With incremental=true only findings updated since the last run are read, and their
+#   changes are applied to counts kept in summary_table_name (DynamoDB) or summary_store_path
+#   (accounts are counted again with a full pass every recount_days); each finding's count keys
+#   are stored with its UpdatedAt, so versions not newer than the counted one are skipped
+# - Every enabled Security Hub region (or the configured regions) is queried, with one
+#   concurrent pass per region and chunk of 20 accounts (sh_async); results are merged per account
+# - With a finding aggregator, its aggregation region (from the aggregator ARN) stands in for the
+#   regions it links; enabled regions it does not link are still queried on their own
+# - With snapshot_mode=write the pass fills a columnar findings snapshot (findings_snapshot) that is
+#   saved and aggregated locally; snapshot_mode=read aggregates a fresh saved snapshot without any
+#   get_findings call and builds one only when none covers the requested accounts
+# - Events with a run_id record each member summary in the run ledger (run_ledger); with
+#   resume: true, members already summarized by that run are not queried again
+# - Members whose findings could not be counted (retries exhausted) are returned with
+#   summary_status: failed; sh-email-notify sends them no report
+# - Batch mode stores the findings counted for each member (shard_planner cost store), so the
+#   next run's shards are balanced by get-sh-members
+# - stream_aggregate(..) applies findings pushed by Security Hub (sh-findings-stream) to the same
+#   stored counts without a query; the account watermark is left to the scheduled runs, which
+#   read those findings again and find their contributions already counted
+# - Incremental runs and stream_aggregate(..) hold a lease on the stored state of their accounts
+#   (DynamoDB conditional writes) from reading it to committing it, so concurrent runs of the
+#   same accounts wait for each other instead of overwriting each other's counts
 #
 
 import os
-import sys
 import json
 import boto3
-import csv
 #import argparse
-import urllib3
 import logging
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
 import time
+import uuid
+import random
+import payload_store
+import run_ledger
+import shard_planner
+import sh_async
+import sh_logging
+import sh_metrics
+import sh_retry
 
 
-session = boto3.Session()
+session = sh_metrics.instrument(boto3.Session())
 
 aws_standard_types = 'Software and Configuration Checks/Industry and Regulatory Standards/AWS-Foundational-Security-Best-Practices'
 aws_dataexposure_types = 'Effects/Data Exposure/AWS-Foundational-Security-Best-Practices'
@@ -30,6 +62,28 @@ standard_types = [
     aws_dataexposure_types,
     cis_standard_types
 ]
+# Security Hub accepts at most 20 values per filter field
+max_filter_values = 20
+# Regions queried for findings (comma separated); empty discovers enabled Security Hub regions
+configured_regions = [ region.strip() for region in os.environ.get('regions', '').split(',') if region.strip() ]
+enabled_regions = None
+# Incremental mode: apply findings updated since the last run to stored counts
+incremental = os.environ.get('incremental', 'false').lower() == 'true'
+# Findings updated this many seconds before the watermark are read again
+watermark_overlap_seconds = int(os.environ.get('watermark_overlap_seconds', '300'))
+# Accounts whose last full pass (baseline) is older than this many days are counted again
+# with a full pass, reconciling drift of the stored counts (0: never)
+recount_days = int(os.environ.get('recount_days', '0'))
+# Accounts without stored counts seen by stream_aggregate: count (full pass) or skip
+stream_new_accounts = os.environ.get('stream_new_accounts', 'count').lower()
+# Leases on the stored state of accounts: held at most lease_seconds (longer than the Lambda
+# timeout, so only leases of runs that died expire) and waited for at most lease_wait_seconds
+lease_seconds = int(os.environ.get('lease_seconds', '960'))
+lease_wait_seconds = int(os.environ.get('lease_wait_seconds', '240'))
+# Snapshot mode: off, write (build and save a findings snapshot) or read (reuse a saved one)
+snapshot_mode = os.environ.get('snapshot_mode', 'off').lower()
+# findings_snapshot is imported on first use (snapshot mode only)
+findings_snapshot = None
 
 #parser = argparse.ArgumentParser()
 #parser.add_argument('member_account', help='Member Account Id')
@@ -46,16 +100,10 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError('Type %s not serializable' % type(obj))
 
-def create_severity_summary_insight(sh_admin_client, member_account, standard_type):
-    insight_name = '{}-severity-insight-{}'.format(member_account, datetime.now().strftime('%Y%m%d%H%M%S'))
-    print('Creating Insight for Standard Type: {}'.format(standard_type))
+def get_summary_filters(member_accounts=None):
+    # Union of the severity and type insight filters; the narrower
+    # conditions of each view are applied client side in aggregate_findings
     filters = {
-        'AwsAccountId': [
-            {
-                'Value': member_account,
-                'Comparison': 'EQUALS'
-            }
-        ],
         'ComplianceStatus': [
             {
                 'Value': 'FAILED',
@@ -68,131 +116,701 @@ def create_severity_summary_insight(sh_admin_client, member_account, standard_ty
                 'Comparison': 'EQUALS'
             }
         ],
-        'Type': [
-            {
-                'Value': standard_type,
-                'Comparison': 'EQUALS'
-            }
-        ],
         'WorkflowStatus': [
             {
                 'Value': 'NEW',
                 'Comparison': 'EQUALS'
+            },
+            {
+                'Value': 'NOTIFIED',
+                'Comparison': 'EQUALS'
             }
         ]
     }
+    if member_accounts and len(member_accounts) <= max_filter_values:
+        filters.update({
+            'AwsAccountId': [
+                {
+                    'Value': member_account,
+                    'Comparison': 'EQUALS'
+                } for member_account in member_accounts
+            ]
+        })
+    return filters
+
+def finding_contribution(finding):
+    # Count keys a finding adds to its account summary:
+    # severity|<standard index>|<SeverityLabel> and type|<Type>
+    contribution = []
+    if finding.get('Compliance', {}).get('Status') != 'FAILED' or finding.get('RecordState') != 'ACTIVE':
+        return contribution
+    workflow_status = finding.get('Workflow', {}).get('Status')
+    if workflow_status not in ('NEW', 'NOTIFIED'):
+        return contribution
+    finding_types = finding.get('Types', [])
+    # Findings by severity for each Standard Type (WorkflowStatus NEW only)
+    if workflow_status == 'NEW':
+        severity_label = finding.get('Severity', {}).get('Label')
+        for idx, standard_type in enumerate(standard_types):
+            if standard_type in finding_types:
+                contribution.append('severity|{}|{}'.format(idx, severity_label))
+    # Findings by Type for Security Hub product findings
+    if finding.get('ProductName') == 'Security Hub':
+        for finding_type in sorted(set(finding_types)):
+            contribution.append('type|{}'.format(finding_type))
+    return contribution
+
+def count_contribution(account_counts, contribution, sign=1):
+    for key in contribution:
+        count = account_counts.get(key, 0) + sign
+        if count > 0:
+            account_counts[key] = count
+        else:
+            account_counts.pop(key, None)
+
+def to_result_values(counts):
+    # Same shape and order as InsightResults ResultValues (Count descending)
+    return [
+        {
+            'GroupByAttributeValue': value,
+            'Count': count
+        } for value, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    ]
+
+def to_member_summary(account_counts):
+    severity_counts = [ {} for standard_type in standard_types ]
+    type_counts = {}
+    for key, count in account_counts.items():
+        view, value = key.split('|', 1)
+        if view == 'severity':
+            idx, severity_label = value.split('|', 1)
+            severity_counts[int(idx)][severity_label] = count
+        else:
+            type_counts[value] = count
+    severity_count = []
+    for idx, standard_type in enumerate(standard_types):
+        severity_count.append({
+            'standard_type': standard_type,
+            'result': to_result_values(severity_counts[idx])
+        })
+    return {
+        'severity_count': severity_count,
+        'SecurityHub': to_result_values(type_counts)
+    }
+
+def account_chunks(member_accounts):
+    # member_accounts in chunks that fit an AwsAccountId filter; None (the whole
+    # organization) stays a single unfiltered chunk
+    if member_accounts and len(member_accounts) > max_filter_values:
+        return [ member_accounts[idx:idx + max_filter_values] for idx in range(0, len(member_accounts), max_filter_values) ]
+    return [ member_accounts ]
+
+def get_findings_pages(sh_admin_client, filters, member_accounts=None):
+    # Pages of findings, restricted to member_accounts when given
+    paginator = sh_admin_client.get_paginator('get_findings')
+    iterator = paginator.paginate(
+        Filters=filters,
+        PaginationConfig={'PageSize': 100}
+    )
+    accounts = set(member_accounts or [])
+    for page in iterator:
+        if accounts:
+            yield [ finding for finding in page['Findings'] if finding['AwsAccountId'] in accounts ]
+        else:
+            yield page['Findings']
+
+def get_hub_enabled(region):
     try:
-        response = sh_admin_client.create_insight(Name=insight_name, Filters=filters, GroupByAttribute='SeverityLabel')
-        LOGGER.info(json.dumps(response, indent=2))
-        return response['InsightArn']
+        get_regional_client(region).describe_hub()
+        return True
     except Exception as e:
-        LOGGER.error(f'failed in create_insight(..): {e}')
+        LOGGER.info('Security Hub not enabled in {}: {}'.format(region, e))
+        return False
+
+def get_regional_client(region):
+    # one pooled client per region, reused across warm invocations
+    return sh_retry.get_client(session, 'securityhub', region_name=region)
+
+def get_aggregator_regions(sh_admin_client):
+    # (aggregation region, RegionLinkingMode, Regions) of the finding aggregator, or None.
+    # The aggregator lives in the region of its ARN, which need not be the home region
+    response = sh_admin_client.list_finding_aggregators()
+    aggregators = response.get('FindingAggregators', [])
+    if len(aggregators) == 0:
+        return None
+    aggregator_arn = aggregators[0]['FindingAggregatorArn']
+    aggregation_region = aggregator_arn.split(':')[3]
+    aggregator = get_regional_client(aggregation_region).get_finding_aggregator(FindingAggregatorArn=aggregator_arn)
+    return aggregation_region, aggregator.get('RegionLinkingMode'), aggregator.get('Regions', [])
+
+def discover_regions():
+    regions = session.get_available_regions('securityhub')
+    hub_enabled = sh_async.run_all([ (get_hub_enabled, (region,), {}) for region in regions ])
+    return [ region for region, enabled in zip(regions, hub_enabled) if enabled ]
+
+def get_regions(sh_admin_client):
+    # Security Hub regions to query: configured regions, the aggregation region of a finding
+    # aggregator plus the enabled regions it does not link, or discovered enabled regions
+    global enabled_regions
+    if len(configured_regions) > 0:
+        return configured_regions
+    if enabled_regions is None:
+        home_region = sh_admin_client.meta.region_name
+        aggregation = None
+        try:
+            aggregation = get_aggregator_regions(sh_admin_client)
+        except Exception as e:
+            LOGGER.error(f'failed in get_finding_aggregator(..): {e}')
+        if aggregation is not None and aggregation[1] == 'ALL_REGIONS':
+            enabled_regions = [ aggregation[0] ]
+        else:
+            regions = discover_regions() or [ home_region ]
+            if aggregation is not None and aggregation[1] in ('SPECIFIED_REGIONS', 'ALL_REGIONS_EXCEPT_SPECIFIED'):
+                aggregation_region, linking_mode, mode_regions = aggregation
+                if linking_mode == 'SPECIFIED_REGIONS':
+                    linked_regions = set(mode_regions)
+                else:
+                    linked_regions = set(regions) - set(mode_regions)
+                # findings of linked regions are read once, in the aggregation region
+                regions = [ aggregation_region ] + [ region for region in regions if region != aggregation_region and region not in linked_regions ]
+            enabled_regions = regions
+        LOGGER.info('Security Hub regions: {}'.format(enabled_regions))
+    return enabled_regions
+
+def get_region_clients(sh_admin_client):
+    home_region = sh_admin_client.meta.region_name
+    return [
+        sh_admin_client if region == home_region else get_regional_client(region)
+        for region in get_regions(sh_admin_client)
+    ]
+
+def count_region_findings(sh_client, member_accounts=None, contributions=None):
+    # Count keys per account from a single paginated get_findings pass in one region.
+    # contributions, when given, collects the count keys of each finding
+    accounts_counts = {}
+    for member_account in member_accounts or []:
+        accounts_counts[member_account] = {}
+    for findings in get_findings_pages(sh_client, get_summary_filters(member_accounts), member_accounts):
+        for finding in findings:
+            contribution = finding_contribution(finding)
+            count_contribution(accounts_counts.setdefault(finding['AwsAccountId'], {}), contribution)
+            if contributions is not None and len(contribution) > 0:
+                contributions[finding['Id']] = {
+                    'member_account': finding['AwsAccountId'],
+                    'keys': contribution,
+                    'updated_at': finding.get('UpdatedAt', '')
+                }
+    return accounts_counts
+
+def count_findings(sh_admin_client, member_accounts=None, contributions=None):
+    # Count keys per account over every Security Hub region, with one concurrent
+    # AwsAccountId filtered pass per (region, chunk of accounts)
+    jobs = [ (sh_client, chunk) for sh_client in get_region_clients(sh_admin_client) for chunk in account_chunks(member_accounts) ]
+    jobs_contributions = [ {} if contributions is not None else None for job in jobs ]
+    jobs_counts = sh_async.run_all([
+        (count_region_findings, (sh_client, chunk, jobs_contributions[idx]), {})
+        for idx, (sh_client, chunk) in enumerate(jobs)
+    ])
+    # merge the per-region aggregates into one summary per account
+    accounts_counts = {}
+    for idx, job_counts in enumerate(jobs_counts):
+        for member_account, job_account_counts in job_counts.items():
+            account_counts = accounts_counts.setdefault(member_account, {})
+            for key, count in job_account_counts.items():
+                account_counts[key] = account_counts.get(key, 0) + count
+        if contributions is not None:
+            contributions.update(jobs_contributions[idx])
+    return accounts_counts
+
+def aggregate_findings(sh_admin_client, member_accounts=None):
+    # Single paginated get_findings pass over all requested accounts
+    # (or the whole organization when member_accounts is None)
+    try:
+        accounts_counts = count_findings(sh_admin_client, member_accounts)
+        return {
+            member_account: to_member_summary(account_counts)
+            for member_account, account_counts in accounts_counts.items()
+        }
+    except Exception as e:
+        LOGGER.error(f'failed in get_findings(..): {e}')
         LOGGER.error(str(e))
 
-def create_type_findings_insight(sh_admin_client, member_account):
-    insight_name = '{}-type-insight-{}'.format(member_account, datetime.now().strftime('%Y%m%d%H%M%S'))
-    filters = {
-        'AwsAccountId': [
-            {
-                'Value': member_account,
-                'Comparison': 'EQUALS'
-            }
-        ],
-        'ComplianceStatus': [
-            {
-                'Value': 'FAILED',
-                'Comparison': 'EQUALS'
+class LocalSummaryStore(object):
+    # Summary state kept in a local JSON file
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as store_file:
+                self.data = json.load(store_file)
+        except FileNotFoundError:
+            self.data = { 'accounts': {}, 'findings': {} }
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as store_file:
+            json.dump(self.data, store_file)
+        os.replace(tmp_path, self.path)
+
+    def acquire_leases(self, member_accounts, owner):
+        # a local store is used by a single process, one run at a time
+        pass
+
+    def release_leases(self, member_accounts, owner):
+        pass
+
+    def get_account_states(self, member_accounts):
+        return { member_account: self.data['accounts'][member_account] for member_account in member_accounts if member_account in self.data['accounts'] }
+
+    def put_account_states(self, account_states, owner=None):
+        self.data['accounts'].update(account_states)
+        self.save()
+
+    def get_contributions(self, finding_ids):
+        return { finding_id: self.data['findings'][finding_id] for finding_id in finding_ids if finding_id in self.data['findings'] }
+
+    def put_contributions(self, contributions):
+        self.data['findings'].update(contributions)
+        self.save()
+
+def is_conditional_check_failed(exception):
+    return getattr(exception, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+class DynamoDBSummaryStore(object):
+    # Summary state kept as items of a DynamoDB table keyed by account_id:
+    # summary#<account> holds counts and watermark, finding#<id> a finding's count keys.
+    # Runs updating the state of an account (incremental runs, sh-findings-stream batches) hold
+    # a lease on its summary#<account> item (lease_owner, lease_expires) from reading the state
+    # to committing it; the commit replaces the item only while the lease is held
+    def __init__(self, db_client, table_name):
+        self.db_client = db_client
+        self.table_name = table_name
+
+    def batch_get(self, keys):
+        return sh_retry.batch_get_items(self.db_client, self.table_name, keys)
+
+    def batch_put(self, items):
+        sh_retry.batch_write_items(self.db_client, self.table_name, items)
+
+    def acquire_lease(self, member_account, owner):
+        now = time.time()
+        try:
+            self.db_client.update_item(
+                TableName=self.table_name,
+                Key={ 'account_id': { 'S': 'summary#' + member_account } },
+                UpdateExpression='SET lease_owner = :owner, lease_expires = :expires',
+                ConditionExpression='attribute_not_exists(lease_owner) OR lease_expires < :now OR lease_owner = :owner',
+                ExpressionAttributeValues={
+                    ':owner': { 'S': owner },
+                    ':expires': { 'N': str(int(now + lease_seconds)) },
+                    ':now': { 'N': str(int(now)) }
+                }
+            )
+            return True
+        except Exception as e:
+            if is_conditional_check_failed(e):
+                return False
+            raise
+
+    def acquire_leases(self, member_accounts, owner):
+        # Leases are taken in account order, so two runs never wait on each other in a cycle
+        deadline = time.monotonic() + lease_wait_seconds
+        acquired = []
+        try:
+            for member_account in sorted(set(member_accounts)):
+                attempt = 0
+                while not self.acquire_lease(member_account, owner):
+                    if time.monotonic() >= deadline:
+                        raise RuntimeError('summary#{} leased by another run for more than {}s'.format(member_account, lease_wait_seconds))
+                    time.sleep(random.uniform(0, min(5.0, 0.1 * (2 ** attempt))))
+                    attempt += 1
+                acquired.append(member_account)
+        except Exception:
+            self.release_leases(acquired, owner)
+            raise
+
+    def release_leases(self, member_accounts, owner):
+        # Leases still held by owner (committed accounts no longer have one)
+        for member_account in member_accounts:
+            try:
+                self.db_client.update_item(
+                    TableName=self.table_name,
+                    Key={ 'account_id': { 'S': 'summary#' + member_account } },
+                    UpdateExpression='REMOVE lease_owner, lease_expires',
+                    ConditionExpression='lease_owner = :owner',
+                    ExpressionAttributeValues={ ':owner': { 'S': owner } }
+                )
+            except Exception as e:
+                if not is_conditional_check_failed(e):
+                    LOGGER.error(f'failed in release_leases(..): {e}')
+
+    def get_account_states(self, member_accounts):
+        account_states = {}
+        for item in self.batch_get([ 'summary#' + member_account for member_account in member_accounts ]):
+            # items of accounts never committed hold only a lease
+            if 'counts' not in item:
+                continue
+            account_states[item['account_id']['S'].split('#', 1)[1]] = {
+                'watermark': item['watermark']['S'],
+                'baseline': item['baseline']['S'],
+                'committed_at': item.get('committed_at', item['watermark'])['S'],
+                'counts': sh_logging.loads(item['counts']['S'])
             }
-        ],
-        'ProductName': [
-            {
-                'Value': 'Security Hub',
-                'Comparison': 'EQUALS'
+        return account_states
+
+    def put_account_states(self, account_states, owner=None):
+        # Each item replaces the leased one (releasing the lease) only while owner holds it
+        for member_account, account_state in account_states.items():
+            request = {
+                'TableName': self.table_name,
+                'Item': {
+                    'account_id': { 'S': 'summary#' + member_account },
+                    'watermark': { 'S': account_state['watermark'] },
+                    'baseline': { 'S': account_state['baseline'] },
+                    'committed_at': { 'S': account_state.get('committed_at', account_state['watermark']) },
+                    'counts': { 'S': sh_logging.dumps(account_state['counts']) }
+                }
             }
-        ],
-        'RecordState': [
-            {
-                'Value': 'ACTIVE',
-                'Comparison': 'EQUALS'
+            if owner is not None:
+                request.update({
+                    'ConditionExpression': 'lease_owner = :owner',
+                    'ExpressionAttributeValues': { ':owner': { 'S': owner } }
+                })
+            try:
+                self.db_client.put_item(**request)
+            except Exception as e:
+                if is_conditional_check_failed(e):
+                    raise RuntimeError('lease on summary#{} lost before commit'.format(member_account))
+                raise
+
+    def get_contributions(self, finding_ids):
+        contributions = {}
+        for item in self.batch_get([ 'finding#' + finding_id for finding_id in finding_ids ]):
+            contributions[item['account_id']['S'].split('#', 1)[1]] = {
+                'member_account': item['member_account']['S'],
+                'keys': sh_logging.loads(item['keys']['S']),
+                'prev_keys': sh_logging.loads(item['prev_keys']['S']),
+                'updated_at': item.get('updated_at', { 'S': '' })['S'],
+                'prev_updated_at': item.get('prev_updated_at', { 'S': '' })['S'],
+                'written_at': item['written_at']['S']
             }
-        ],
-        'WorkflowStatus': [
-            {
-                'Value': 'NEW',
-                'Comparison': 'EQUALS'
-            },
+        return contributions
+
+    def put_contributions(self, contributions):
+        self.batch_put([
             {
-                'Value': 'NOTIFIED',
-                'Comparison': 'EQUALS'
+                'account_id': { 'S': 'finding#' + finding_id },
+                'member_account': { 'S': contribution['member_account'] },
+                'keys': { 'S': sh_logging.dumps(contribution['keys']) },
+                'prev_keys': { 'S': sh_logging.dumps(contribution.get('prev_keys', [])) },
+                'updated_at': { 'S': contribution.get('updated_at', '') },
+                'prev_updated_at': { 'S': contribution.get('prev_updated_at', '') },
+                'written_at': { 'S': contribution['written_at'] }
+            } for finding_id, contribution in contributions.items()
+        ])
+
+def get_summary_store():
+    if 'summary_table_name' in os.environ:
+        return DynamoDBSummaryStore(sh_retry.get_client(session, 'dynamodb'), os.environ['summary_table_name'])
+    return LocalSummaryStore(os.environ.get('summary_store_path', '/tmp/sh-summary-store.json'))
+
+def to_watermark(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def committed_contribution(contribution, account_states):
+    # Count keys and UpdatedAt of the finding version already included in the stored
+    # account counts. Keys written by a run that did not commit its account state are
+    # ignored in favour of prev_keys, and keys older than the account's full pass
+    # (baseline) are ignored altogether
+    account_state = account_states.get(contribution['member_account'])
+    if account_state is None or contribution['written_at'] > account_state.get('committed_at', account_state['watermark']):
+        return contribution.get('prev_keys', []), contribution.get('prev_updated_at', '')
+    if contribution['written_at'] < account_state['baseline']:
+        return [], ''
+    return contribution['keys'], contribution.get('updated_at', '')
+
+def apply_findings(store, findings, account_states, accounts_counts, written_at):
+    # Replace the committed count keys of findings by their current ones in accounts_counts
+    # and store the new keys, effective once the account state is committed after written_at.
+    # Findings not newer (UpdatedAt) than their committed version, e.g. an older version
+    # delivered late, are skipped
+    stored = store.get_contributions([ finding['Id'] for finding in findings ])
+    changes = {}
+    for finding in findings:
+        member_account = finding['AwsAccountId']
+        updated_at = finding.get('UpdatedAt', '')
+        old_keys, old_updated_at = committed_contribution(stored[finding['Id']], account_states) if finding['Id'] in stored else ([], '')
+        if updated_at and old_updated_at and updated_at <= old_updated_at:
+            continue
+        new_keys = finding_contribution(finding)
+        if old_keys != new_keys:
+            count_contribution(accounts_counts[member_account], old_keys, -1)
+            count_contribution(accounts_counts[member_account], new_keys)
+        if finding['Id'] in stored or len(new_keys) > 0:
+            changes[finding['Id']] = {
+                'member_account': member_account,
+                'keys': new_keys,
+                'prev_keys': old_keys,
+                'updated_at': updated_at,
+                'prev_updated_at': old_updated_at,
+                'written_at': written_at
             }
-        ]
-    }    
+    store.put_contributions(changes)
+
+def incremental_aggregate(sh_admin_client, store, member_accounts):
+    # Apply findings updated since the stored watermarks to the stored counts.
+    # Accounts without stored state, or with a baseline older than recount_days, are
+    # counted with a full pass first. The accounts are leased for the whole run, so that
+    # sh-findings-stream batches of the same accounts wait for its commit (and vice versa)
+    owner = uuid.uuid4().hex
+    leased_accounts = []
     try:
-        response = sh_admin_client.create_insight(Name=insight_name, Filters=filters, GroupByAttribute='Type')
-        LOGGER.info(json.dumps(response, indent=2))
-        return response['InsightArn']
+        store.acquire_leases(member_accounts, owner)
+        leased_accounts = member_accounts
+        # timestamps are taken once the leases are held: later than any earlier commit
+        run_at = datetime.now(timezone.utc)
+        watermark = to_watermark(run_at)
+        recount_before = to_watermark(run_at - timedelta(days=recount_days)) if recount_days > 0 else ''
+        account_states = store.get_account_states(member_accounts)
+        accounts_counts = { member_account: dict(account_state['counts']) for member_account, account_state in account_states.items() }
+        new_accounts = [
+            member_account for member_account in member_accounts
+            if member_account not in account_states or account_states[member_account]['baseline'] < recount_before
+        ]
+        full_pass_accounts = set(new_accounts)
+        if len(new_accounts) > 0:
+            contributions = {}
+            accounts_counts.update(count_findings(sh_admin_client, new_accounts, contributions))
+            for contribution in contributions.values():
+                contribution.update({ 'prev_keys': [], 'prev_updated_at': '', 'written_at': watermark })
+            store.put_contributions(contributions)
+        known_accounts = [ member_account for member_account in member_accounts if member_account not in full_pass_accounts ]
+        if len(known_accounts) > 0:
+            since = min([ account_states[member_account]['watermark'] for member_account in known_accounts ])
+            start = datetime.strptime(since, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc) - timedelta(seconds=watermark_overlap_seconds)
+            filters = {
+                'UpdatedAt': [
+                    {
+                        'Start': to_watermark(start),
+                        'End': watermark
+                    }
+                ]
+            }
+            # one AwsAccountId filtered query per (region, chunk of accounts), so that a shard
+            # reads the updates of its own accounts only
+            updated_count = 0
+            for findings in (
+                findings
+                for sh_client in get_region_clients(sh_admin_client)
+                for chunk in account_chunks(known_accounts)
+                for findings in get_findings_pages(sh_client, dict(filters, AwsAccountId=[
+                    { 'Value': member_account, 'Comparison': 'EQUALS' } for member_account in chunk
+                ]), chunk)
+            ):
+                apply_findings(store, findings, account_states, accounts_counts, watermark)
+                updated_count += len(findings)
+            LOGGER.info('Applied {} updated findings since {}'.format(updated_count, since))
+        # committing the account state makes this run's contributions effective
+        store.put_account_states({
+            member_account: {
+                'watermark': watermark,
+                'baseline': watermark if member_account in full_pass_accounts else account_states[member_account]['baseline'],
+                'committed_at': watermark,
+                'counts': accounts_counts.get(member_account, {})
+            } for member_account in member_accounts
+        }, owner)
+        leased_accounts = []
+        return {
+            member_account: to_member_summary(accounts_counts.get(member_account, {}))
+            for member_account in member_accounts
+        }
     except Exception as e:
-        LOGGER.error(f'failed in create_insight(..): {e}')
+        LOGGER.error(f'failed in incremental_aggregate(..): {e}')
         LOGGER.error(str(e))
+    finally:
+        store.release_leases(leased_accounts, owner)
 
-def delete_insight(sh_admin_client, insight_arn):
+def stream_aggregate(sh_admin_client, store, findings):
+    # Apply findings pushed by Security Hub events to the stored counts of their accounts.
+    # Accounts without stored counts get a full pass (or are skipped, stream_new_accounts=skip)
+    # and report no previous counts. Returns { account: (previous counts, counts) }.
+    # The accounts are leased from reading their state to committing it (see incremental_aggregate)
+    member_accounts = sorted(set([ finding['AwsAccountId'] for finding in findings ]))
+    owner = uuid.uuid4().hex
+    store.acquire_leases(member_accounts, owner)
     try:
-        sh_admin_client.delete_insight(InsightArn=insight_arn)
-        LOGGER.info('Deleted Insight: {}'.format(insight_arn))
+        accounts_changes = stream_update(sh_admin_client, store, findings, member_accounts, owner)
+    except Exception:
+        store.release_leases(member_accounts, owner)
+        raise
+    # committed accounts released their lease; skipped new accounts still hold one
+    store.release_leases([ member_account for member_account in member_accounts if member_account not in accounts_changes ], owner)
+    return accounts_changes
+
+def stream_update(sh_admin_client, store, findings, member_accounts, owner):
+    # stream_aggregate with the leases of member_accounts held by owner
+    committed_at = to_watermark(datetime.now(timezone.utc))
+    account_states = store.get_account_states(member_accounts)
+    accounts_counts = { member_account: dict(account_state['counts']) for member_account, account_state in account_states.items() }
+    new_accounts = [ member_account for member_account in member_accounts if member_account not in account_states ]
+    new_account_states = {}
+    if len(new_accounts) > 0 and stream_new_accounts == 'count':
+        contributions = {}
+        new_counts = count_findings(sh_admin_client, new_accounts, contributions)
+        for contribution in contributions.values():
+            contribution.update({ 'prev_keys': [], 'prev_updated_at': '', 'written_at': committed_at })
+        store.put_contributions(contributions)
+        new_account_states = {
+            member_account: {
+                'watermark': committed_at,
+                'baseline': committed_at,
+                'committed_at': committed_at,
+                'counts': new_counts.get(member_account, {})
+            } for member_account in new_accounts
+        }
+    # findings of new accounts are included in their full pass
+    findings = [ finding for finding in findings if finding['AwsAccountId'] in account_states ]
+    if len(findings) > 0:
+        apply_findings(store, findings, account_states, accounts_counts, committed_at)
+    updated_states = {
+        member_account: dict(account_state, committed_at=committed_at, counts=accounts_counts[member_account])
+        for member_account, account_state in account_states.items()
+    }
+    updated_states.update(new_account_states)
+    store.put_account_states(updated_states, owner)
+    accounts_changes = {
+        member_account: (account_state['counts'], accounts_counts[member_account])
+        for member_account, account_state in account_states.items()
+    }
+    accounts_changes.update({
+        member_account: (None, account_state['counts']) for member_account, account_state in new_account_states.items()
+    })
+    return accounts_changes
+
+def get_member_summary(summaries, member_account):
+    if summaries is None:
+        # findings could not be counted once retries were exhausted: keep the payload shape,
+        # marked failed so that no report is sent for the member
+        return {
+            'summary_status': 'failed',
+            'severity_count': [
+                {
+                    'standard_type': standard_type,
+                    'result': None
+                } for standard_type in standard_types
+            ],
+            'SecurityHub': None
+        }
+    return summaries[member_account]
+
+def snapshot_region_findings(sh_client, member_accounts=None):
+    snapshot = findings_snapshot.FindingsSnapshot(member_accounts)
+    for findings in get_findings_pages(sh_client, get_summary_filters(member_accounts), member_accounts):
+        snapshot.add_findings(findings)
+    return snapshot
+
+def build_snapshot(sh_admin_client, member_accounts=None):
+    # Same concurrent (region, chunk of accounts) passes as count_findings, into one snapshot
+    snapshots = sh_async.run_all([
+        (snapshot_region_findings, (sh_client, chunk), {})
+        for sh_client in get_region_clients(sh_admin_client) for chunk in account_chunks(member_accounts)
+    ])
+    snapshot = findings_snapshot.merge(snapshots)
+    snapshot.accounts = None if member_accounts is None else sorted(set(member_accounts))
+    return snapshot
+
+def snapshot_counts(snapshot, member_accounts):
+    # Count keys per account (as count_findings) from group-bys over the snapshot
+    accounts_counts = { member_account: {} for member_account in member_accounts }
+    for idx, standard_type in enumerate(standard_types):
+        for member_account, counts in snapshot.severity_counts(standard_type, member_accounts).items():
+            for severity_label, count in counts.items():
+                accounts_counts[member_account]['severity|{}|{}'.format(idx, severity_label)] = count
+    for member_account, counts in snapshot.type_counts('Security Hub', member_accounts).items():
+        for finding_type, count in counts.items():
+            accounts_counts[member_account]['type|{}'.format(finding_type)] = count
+    return accounts_counts
+
+def snapshot_aggregate(sh_admin_client, member_accounts):
+    global findings_snapshot
+    import findings_snapshot
+    try:
+        snapshot = None
+        if snapshot_mode == 'read':
+            snapshot = findings_snapshot.load_snapshot(member_accounts)
+            if snapshot is not None:
+                LOGGER.info('Using findings snapshot of {} findings'.format(len(snapshot)))
+        if snapshot is None:
+            snapshot = build_snapshot(sh_admin_client, member_accounts)
+            findings_snapshot.save_snapshot(snapshot)
+        return {
+            member_account: to_member_summary(account_counts)
+            for member_account, account_counts in snapshot_counts(snapshot, member_accounts).items()
+        }
     except Exception as e:
-        LOGGER.error(f'failed in delete_insight(..): {e}')
+        LOGGER.error(f'failed in snapshot_aggregate(..): {e}')
         LOGGER.error(str(e))
 
-def get_summary_result(sh_admin_client, insight_arn):
+def get_summaries(sh_admin_client, member_accounts):
+    if incremental:
+        return incremental_aggregate(sh_admin_client, get_summary_store(), member_accounts)
+    if snapshot_mode in ('read', 'write'):
+        return snapshot_aggregate(sh_admin_client, member_accounts)
+    return aggregate_findings(sh_admin_client, member_accounts)
+
+def save_costs(costs):
+    # Findings per account, used by get-sh-members to balance the next run's shards
     try:
-        response = sh_admin_client.get_insight_results(InsightArn=insight_arn)
-        return response['InsightResults']['ResultValues']
+        shard_planner.get_cost_store(session).put_costs(costs)
     except Exception as e:
-        LOGGER.error(f'failed in get_insight_results(..): {e}')
+        LOGGER.error(f'failed in put_costs(..): {e}')
         LOGGER.error(str(e))
 
+def member_summary_output(member, member_summary):
+    output = {
+        'account_id': member['account_id'],
+        'account_email': member['account_email'],
+        'tech_owner_email': member.get('tech_owner_email', ''),
+        'severity_count': member_summary['severity_count'],
+        'SecurityHub': member_summary['SecurityHub']
+    }
+    if 'summary_status' in member_summary:
+        output.update({ 'summary_status': member_summary['summary_status'] })
+    return output
+
+@sh_metrics.metrics_handler
 def lambda_handler(event, context):
 #def main():
     #args = parser.parse_args()
-    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    LOGGER.info('REQUEST RECEIVED: %s', sh_logging.lazy(event))
+    sh_admin_client = sh_retry.get_client(session, 'securityhub')
+    # Organization mode: one aggregation pass for every member in member_list
+    if 'member_list' in event or 'member_list_ref' in event:
+        member_list = list(payload_store.records_from_event(event, 'member_list'))
+        member_accounts = [ member['account_id'] for member in member_list ]
+        run_id = event.get('run_id')
+        ledger = run_ledger.get_run_ledger(session) if run_id else None
+        completed = {}
+        if ledger is not None and event.get('resume', False):
+            completed = run_ledger.get_completed(ledger, run_id, run_ledger.SUMMARY, member_accounts)
+            LOGGER.info('Resuming run {}: {} Members already summarized'.format(run_id, len(completed)))
+        pending_accounts = [ member_account for member_account in member_accounts if member_account not in completed ]
+        summaries = get_summaries(sh_admin_client, pending_accounts) if len(pending_accounts) > 0 else {}
+        if ledger is not None and summaries is not None:
+            run_ledger.put_completed(ledger, run_id, run_ledger.SUMMARY, {
+                member_account: summaries[member_account] for member_account in pending_accounts
+            })
+        if summaries is not None:
+            save_costs({ member_account: shard_planner.summary_cost(summaries[member_account]) for member_account in pending_accounts })
+        return payload_store.to_payload('member_list', (
+            member_summary_output(member, completed[member['account_id']] if member['account_id'] in completed else get_member_summary(summaries, member['account_id']))
+            for member in member_list
+        ))
     member_account = event['account_id']
-    account_email = event['account_email']
-    tech_owner_email = ''
-    if 'tech_owner_email' in event:
-        tech_owner_email = event['tech_owner_email']
     #member_account = args.member_account
-    sh_admin_client = session.client('securityhub')
-    member_summary_data = {}
-    standard_severity_list = []
-    insight_arns = []
-    # Get Insight Results Findings count by severity for each of: AWS Foundations, CIS
-    for standard_type in standard_types:
-        insight_arn = create_severity_summary_insight(sh_admin_client, member_account, standard_type)
-        result = get_summary_result(sh_admin_client, insight_arn)
-        standard_severity_list.append({
-            'standard_type': standard_type,
-            'result': result
-        })
-        insight_arns.append(insight_arn)
-    member_summary_data.update({'severity_count': standard_severity_list})
-    # Get Insight Results by Standard Type
-    insight_arn = create_type_findings_insight(sh_admin_client, member_account)
-    insight_arns.append(insight_arn)
-    result = get_summary_result(sh_admin_client, insight_arn)
-    # removed spaces
-    member_summary_data.update({ 'SecurityHub': result })
-    # delete insights
-    for insight_arn in insight_arns:
-        delete_insight(sh_admin_client, insight_arn)
+    summaries = get_summaries(sh_admin_client, [ member_account ])
+    member_summary_data = get_member_summary(summaries, member_account)
     #print(json.dumps(member_summary_data, indent=2))
-    return {
-        'account_id': member_account,
-        'account_email': account_email,
-        'tech_owner_email': tech_owner_email,
-        'severity_count': member_summary_data['severity_count'],
-        'SecurityHub': member_summary_data['SecurityHub']
-    }
+    return member_summary_output(event, member_summary_data)
 
 #if __name__ == '__main__':
 #    main()
-
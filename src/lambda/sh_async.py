@@ -0,0 +1,64 @@
+#
+# Purpose: asyncio layer for issuing blocking boto3 calls concurrently
+# NOTE:
+# - boto3 calls run on a shared thread pool and are awaited from coroutines
+# - A global semaphore (async_max_concurrency) bounds in-flight calls per process
+# - run_all(..) lets sync lambda_handlers fan out calls and keep their contracts;
+#   functions passed to run_all must not call run_all themselves (shared pool)
+# - aiobotocore is not part of the Lambda Python runtime; boto3 clients are thread safe,
+#   so the thread pool gives the same concurrency without an extra dependency
+# - asyncio and the thread pool are loaded by the first concurrent run_all, keeping them off
+#   the cold start path of handlers that never fan out
+#
+
+import os
+import functools
+import threading
+
+max_concurrency = int(os.environ.get('async_max_concurrency', '16'))
+
+# imported by run_all on first use
+asyncio = None
+
+_lock = threading.Lock()
+_executor = None
+_semaphores = {}
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='sh-async')
+        return _executor
+
+def get_semaphore():
+    # asyncio primitives belong to one event loop; keep one semaphore per loop
+    loop = asyncio.get_running_loop()
+    with _lock:
+        for known_loop in [ known_loop for known_loop in _semaphores if known_loop.is_closed() ]:
+            del _semaphores[known_loop]
+        if loop not in _semaphores:
+            _semaphores[loop] = asyncio.Semaphore(max_concurrency)
+        return _semaphores[loop]
+
+async def call(func, *args, **kwargs):
+    # Await a blocking call (a boto3 client method or a helper using one)
+    async with get_semaphore():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+async def gather_calls(calls):
+    # calls: list of (func, args, kwargs); results are returned in order
+    return await asyncio.gather(*[ call(func, *args, **kwargs) for func, args, kwargs in calls ])
+
+def run_all(calls):
+    # Sync entry point: run the calls concurrently and return their results in order
+    if len(calls) == 0:
+        return []
+    if len(calls) == 1:
+        func, args, kwargs = calls[0]
+        return [ func(*args, **kwargs) ]
+    global asyncio
+    import asyncio
+    return asyncio.run(gather_calls(calls))
@@ -0,0 +1,87 @@
+#
+# Purpose: Fast JSON serialization and deferred, sampled logging for the hot paths
+# NOTE:
+# - dumps(..) / loads(..) use orjson when it is importable (e.g. from a layer) and the stdlib
+#   json module otherwise; output is compact JSON, datetimes are ISO 8601 strings
+# - lazy(obj) defers serialization to the moment a log record is emitted:
+#   LOGGER.info('REQUEST RECEIVED: %s', sh_logging.lazy(event)) costs nothing below INFO
+# - LogSampler replaces per item logs (one per resource, member, ..) with structured lines for
+#   the first log_sample_first items and every log_sample_every-th item after that, plus
+#   one summary line with the number of items seen
+#
+
+import os
+import json
+import logging
+import threading
+from datetime import date, datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log_sample_first = int(os.environ.get('log_sample_first', '10'))
+log_sample_every = int(os.environ.get('log_sample_every', '1000'))
+
+def json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    return str(obj)
+
+def dumps(obj, default=json_default):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            # integers beyond 64 bit and other values orjson rejects
+            pass
+    return json.dumps(obj, default=default, separators=(',', ':'))
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class LazyJson(object):
+    # Serialized by str(..), i.e. only when a log record is formatted
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return dumps(self.obj)
+
+def lazy(obj):
+    return LazyJson(obj)
+
+class LogSampler(object):
+    # Thread safe sampling of the per item log lines of one kind (name)
+    def __init__(self, logger, name, level=logging.INFO, first=None, every=None):
+        self.logger = logger
+        self.name = name
+        self.level = level
+        self.first = log_sample_first if first is None else first
+        self.every = log_sample_every if every is None else every
+        self.seen = 0
+        self.logged = 0
+        self.lock = threading.Lock()
+
+    def log(self, **fields):
+        with self.lock:
+            self.seen += 1
+            seen = self.seen
+            sampled = seen <= self.first or (self.every > 0 and seen % self.every == 0)
+            if sampled:
+                self.logged += 1
+        if sampled and self.logger.isEnabledFor(self.level):
+            record = { 'log': self.name, 'item': seen }
+            record.update(fields)
+            self.logger.log(self.level, '%s', LazyJson(record))
+
+    def summary(self, **fields):
+        if self.logger.isEnabledFor(self.level):
+            record = { 'log': self.name, 'seen': self.seen, 'logged': self.logged }
+            record.update(fields)
+            self.logger.log(self.level, '%s', LazyJson(record))
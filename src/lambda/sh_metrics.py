@@ -0,0 +1,262 @@
+#
+# Purpose: Per operation telemetry for boto3 calls, emitted as CloudWatch Embedded Metric Format
+# NOTE:
+# - instrument(session_or_client) registers botocore event handlers; clients created from an
+#   instrumented session afterwards are instrumented too
+# - Records per operation: calls, errors, latency histogram, retries (RetryAttempts),
+#   retries by sh_retry after botocore gave up, throttled attempts and bytes sent/received
+# - @metrics_handler on a lambda_handler emits one EMF line per operation and a summary line
+#   per invocation; nested handlers (sh-org-report) are reported by the outermost one
+# - Outside Lambda (no AWS_LAMBDA_FUNCTION_NAME) the same records are plain structured JSON
+#
+
+import os
+import time
+import functools
+import threading
+import sh_logging
+
+metrics_enabled = os.environ.get('metrics_enabled', 'true').lower() == 'true'
+metrics_namespace = os.environ.get('metrics_namespace', 'SHFindingIntimations')
+
+# Error codes botocore treats as throttling
+throttle_error_codes = set([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'TransactionInProgressException',
+    'RequestLimitExceeded',
+    'BandwidthLimitExceeded',
+    'LimitExceededException',
+    'RequestThrottled',
+    'SlowDown',
+    'PriorRequestNotComplete',
+    'EC2ThrottledException'
+])
+# Latency histogram bucket upper bounds (milliseconds)
+latency_buckets = [ 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000 ]
+
+_lock = threading.Lock()
+_operations = {}
+_handler_depth = 0
+
+class OperationStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.client_retries = 0
+        self.throttles = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_min = None
+        self.latency_counts = [ 0 ] * (len(latency_buckets) + 1)
+
+    def add_latency(self, latency_ms):
+        self.latency_sum += latency_ms
+        self.latency_max = max(self.latency_max, latency_ms)
+        self.latency_min = latency_ms if self.latency_min is None else min(self.latency_min, latency_ms)
+        for idx, bound in enumerate(latency_buckets):
+            if latency_ms <= bound:
+                self.latency_counts[idx] += 1
+                return
+        self.latency_counts[-1] += 1
+
+    def latency_histogram(self):
+        # EMF histogram: bucket upper bounds (the last bucket reports the max) and their counts
+        values = []
+        counts = []
+        for idx, count in enumerate(self.latency_counts):
+            if count > 0:
+                values.append(latency_buckets[idx] if idx < len(latency_buckets) else round(self.latency_max, 3))
+                counts.append(count)
+        return {
+            'Values': values,
+            'Counts': counts,
+            'Min': round(self.latency_min or 0.0, 3),
+            'Max': round(self.latency_max, 3),
+            'Sum': round(self.latency_sum, 3),
+            'Count': sum(counts)
+        }
+
+def operation_key(event_name):
+    # 'after-call.securityhub.GetFindings' -> 'securityhub.GetFindings'
+    return event_name.split('.', 1)[1]
+
+def get_stats(key):
+    stats = _operations.get(key)
+    if stats is None:
+        stats = OperationStats()
+        _operations[key] = stats
+    return stats
+
+def before_call(context=None, **kwargs):
+    if context is not None:
+        context['sh_metrics_started'] = time.perf_counter()
+
+def request_created(request=None, event_name=None, **kwargs):
+    body = getattr(request, 'body', None)
+    if body is None or event_name is None:
+        return
+    size = len(body) if isinstance(body, (bytes, str)) else 0
+    with _lock:
+        get_stats(operation_key(event_name)).bytes_sent += size
+
+def needs_retry(response=None, event_name=None, **kwargs):
+    # Count throttled attempts; the retry decision is left to botocore
+    if response is None or event_name is None:
+        return None
+    parsed = response[1] if isinstance(response, tuple) and len(response) > 1 else {}
+    if (parsed or {}).get('Error', {}).get('Code') in throttle_error_codes:
+        with _lock:
+            get_stats(operation_key(event_name)).throttles += 1
+    return None
+
+def after_call(http_response=None, parsed=None, context=None, event_name=None, **kwargs):
+    # service errors also end in after-call; botocore raises them afterwards
+    failed = getattr(http_response, 'status_code', 200) >= 300
+    record_call(event_name, context, parsed, http_response, failed)
+
+def after_call_error(exception=None, context=None, event_name=None, **kwargs):
+    record_call(event_name, context, getattr(exception, 'response', None), None, True)
+
+def record_call(event_name, context, parsed, http_response, failed):
+    if event_name is None:
+        return
+    started = (context or {}).get('sh_metrics_started')
+    metadata = (parsed or {}).get('ResponseMetadata', {})
+    size = 0
+    if http_response is not None:
+        # content-length avoids reading streaming bodies
+        size = int(getattr(http_response, 'headers', {}).get('content-length', 0) or 0)
+    with _lock:
+        stats = get_stats(operation_key(event_name))
+        stats.calls += 1
+        stats.errors += 1 if failed else 0
+        stats.retries += metadata.get('RetryAttempts', 0)
+        stats.bytes_received += size
+        if started is not None:
+            stats.add_latency((time.perf_counter() - started) * 1000.0)
+
+def record_client_retry(service_name, operation_name, throttled):
+    # sh_retry retried an operation (snake_case name) that botocore reported as failed
+    key = '{}.{}'.format(service_name, ''.join([ part.title() for part in operation_name.split('_') ]))
+    with _lock:
+        get_stats(key).client_retries += 1
+
+def instrument(target):
+    # target: boto3 Session or client; objects without botocore events are returned unchanged
+    events = getattr(target, 'events', None)
+    if events is None:
+        events = getattr(getattr(target, 'meta', None), 'events', None)
+    if events is None or not metrics_enabled:
+        return target
+    events.register('before-call', before_call, unique_id='sh-metrics-before-call')
+    events.register('request-created', request_created, unique_id='sh-metrics-request-created')
+    events.register('needs-retry', needs_retry, unique_id='sh-metrics-needs-retry')
+    events.register('after-call', after_call, unique_id='sh-metrics-after-call')
+    events.register('after-call-error', after_call_error, unique_id='sh-metrics-after-call-error')
+    return target
+
+def reset():
+    with _lock:
+        _operations.clear()
+
+def to_records(function_name):
+    # One EMF record per operation
+    records = []
+    timestamp = int(time.time() * 1000)
+    with _lock:
+        operations = list(_operations.items())
+    for key, stats in sorted(operations):
+        record = {
+            'FunctionName': function_name,
+            'Operation': key,
+            'Calls': stats.calls,
+            'Errors': stats.errors,
+            'Retries': stats.retries,
+            'ClientRetries': stats.client_retries,
+            'Throttles': stats.throttles,
+            'BytesSent': stats.bytes_sent,
+            'BytesReceived': stats.bytes_received,
+            'Latency': stats.latency_histogram()
+        }
+        if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+            record['_aws'] = {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [
+                    {
+                        'Namespace': metrics_namespace,
+                        'Dimensions': [ [ 'FunctionName', 'Operation' ] ],
+                        'Metrics': [
+                            { 'Name': 'Calls', 'Unit': 'Count' },
+                            { 'Name': 'Errors', 'Unit': 'Count' },
+                            { 'Name': 'Retries', 'Unit': 'Count' },
+                            { 'Name': 'ClientRetries', 'Unit': 'Count' },
+                            { 'Name': 'Throttles', 'Unit': 'Count' },
+                            { 'Name': 'BytesSent', 'Unit': 'Bytes' },
+                            { 'Name': 'BytesReceived', 'Unit': 'Bytes' },
+                            { 'Name': 'Latency', 'Unit': 'Milliseconds' }
+                        ]
+                    }
+                ]
+            }
+        records.append(record)
+    return records
+
+def to_summary(function_name, duration_ms, records):
+    # Per invocation totals and the operations that took the most time
+    slowest = sorted(records, key=lambda record: -record['Latency']['Sum'])[:5]
+    return {
+        'metric_summary': function_name,
+        'duration_ms': round(duration_ms, 3),
+        'calls': sum([ record['Calls'] for record in records ]),
+        'errors': sum([ record['Errors'] for record in records ]),
+        'retries': sum([ record['Retries'] for record in records ]),
+        'client_retries': sum([ record['ClientRetries'] for record in records ]),
+        'throttles': sum([ record['Throttles'] for record in records ]),
+        'bytes_sent': sum([ record['BytesSent'] for record in records ]),
+        'bytes_received': sum([ record['BytesReceived'] for record in records ]),
+        'slowest_operations': [
+            {
+                'operation': record['Operation'],
+                'calls': record['Calls'],
+                'latency_ms': record['Latency']['Sum']
+            } for record in slowest
+        ]
+    }
+
+def flush(function_name, duration_ms):
+    records = to_records(function_name)
+    for record in records:
+        print(sh_logging.dumps(record))
+    print(sh_logging.dumps(to_summary(function_name, duration_ms, records)))
+    reset()
+
+def metrics_handler(handler):
+    # Decorator for lambda_handler: emit the metrics of each (outermost) invocation
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _handler_depth
+        if not metrics_enabled:
+            return handler(event, context)
+        with _lock:
+            _handler_depth += 1
+            outermost = _handler_depth == 1
+        if outermost:
+            reset()
+        started = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            with _lock:
+                _handler_depth -= 1
+            if outermost:
+                function_name = getattr(context, 'function_name', None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME', handler.__module__)
+                flush(function_name, (time.perf_counter() - started) * 1000.0)
+    return wrapper
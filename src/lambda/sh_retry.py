@@ -0,0 +1,324 @@
+#
+# Purpose: Throttling aware retries shared by every boto3 client of a Lambda process
+# NOTE:
+# - wrap_client(client) retries each operation (and each page of the paginators used here)
+#   after botocore's own retries are exhausted, so one throttled page does not drop a result
+# - Errors are classified as throttle, retryable (5xx, timeouts, connection errors) or fatal;
+#   fatal errors are raised at once, the others after retry_max_attempts
+# - Retries wait a full jitter exponential backoff, so threads do not retry in lockstep
+# - Each API (service.operation) gets an adaptive rate limit after its first throttle: the rate
+#   is cut on throttles and grows back on successes until the limit is lifted again
+# - Each service has a concurrency budget shared by all threads (sh_async and thread pools);
+#   throttles halve it and successes grow it back to retry_max_concurrency
+# - get_client(session, service) creates each retrying client once per process, so warm
+#   invocations reuse clients (and their connection pools) instead of creating new ones;
+#   botocore's own retries are turned off (client_config) so that attempts do not multiply
+# - batch_get_items / batch_write_items retry the unprocessed keys / items of DynamoDB batch
+#   calls up to batch_max_attempts times and raise when some are left
+#
+
+import os
+import time
+import random
+import logging
+import functools
+import threading
+from collections import deque
+import sh_metrics
+
+LOGGER = logging.getLogger()
+
+max_attempts = int(os.environ.get('retry_max_attempts', '8'))
+base_delay = float(os.environ.get('retry_base_delay', '0.1'))
+max_delay = float(os.environ.get('retry_max_delay', '20'))
+max_concurrency = int(os.environ.get('retry_max_concurrency', os.environ.get('async_max_concurrency', '16')))
+batch_max_attempts = int(os.environ.get('batch_max_attempts', '8'))
+
+# BatchGetItem accepts at most 100 keys and BatchWriteItem 25 items per request
+batch_get_max_keys = 100
+batch_write_max_items = 25
+
+retryable_error_codes = set([
+    'InternalException',
+    'InternalError',
+    'InternalFailure',
+    'InternalServerError',
+    'InternalServerException',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'RequestTimeout',
+    'RequestTimeoutException'
+])
+retryable_exceptions = set([
+    'EndpointConnectionError',
+    'ConnectTimeoutError',
+    'ReadTimeoutError',
+    'ConnectionClosedError',
+    'ConnectionError',
+    'TimeoutError'
+])
+# Paginated operations used by the Lambdas: (input token, output token, page size parameter)
+paginated_operations = {
+    'get_findings': ('NextToken', 'NextToken', 'MaxResults'),
+    'get_insights': ('NextToken', 'NextToken', 'MaxResults'),
+    'list_members': ('NextToken', 'NextToken', 'MaxResults'),
+    'list_identities': ('NextToken', 'NextToken', 'MaxItems')
+}
+
+THROTTLE = 'throttle'
+RETRYABLE = 'retryable'
+FATAL = 'fatal'
+
+_lock = threading.Lock()
+_rate_limiters = {}
+_budgets = {}
+_clients = {}
+
+def classify(exception):
+    response = getattr(exception, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('Error', {}).get('Code')
+        if code in sh_metrics.throttle_error_codes:
+            return THROTTLE
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        if code in retryable_error_codes or status >= 500:
+            return RETRYABLE
+        return FATAL
+    if any([ cls.__name__ in retryable_exceptions for cls in type(exception).__mro__ ]):
+        return RETRYABLE
+    return FATAL
+
+def backoff_delay(attempt):
+    # full jitter: uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+class AdaptiveRateLimiter(object):
+    # Token bucket per API; unlimited until the API is throttled
+    def __init__(self, min_rate=1.0, max_rate=1000.0, beta=0.7, growth=1.1):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.beta = beta
+        self.growth = growth
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.sent = deque()
+        self.lock = threading.Lock()
+
+    def measured_rate(self, now):
+        # calls sent during the last second
+        while self.sent and now - self.sent[0] > 1.0:
+            self.sent.popleft()
+        return float(len(self.sent))
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate is None:
+                    self.sent.append(now)
+                    return
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    self.sent.append(now)
+                    return
+                wait_seconds = (1.0 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def on_throttle(self):
+        with self.lock:
+            now = time.monotonic()
+            current = self.rate if self.rate is not None else max(self.measured_rate(now), self.min_rate)
+            self.rate = max(self.min_rate, current * self.beta)
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = now
+
+    def on_success(self):
+        with self.lock:
+            if self.rate is None:
+                return
+            self.rate = self.rate * self.growth
+            if self.rate >= self.max_rate:
+                self.rate = None
+
+class ConcurrencyBudget(object):
+    # Calls in flight for one service across all threads (AIMD limit)
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = limit
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.limit < self.max_limit and self.successes >= self.limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+def get_rate_limiter(api):
+    with _lock:
+        if api not in _rate_limiters:
+            _rate_limiters[api] = AdaptiveRateLimiter()
+        return _rate_limiters[api]
+
+def get_budget(service_name):
+    with _lock:
+        if service_name not in _budgets:
+            _budgets[service_name] = ConcurrencyBudget(max_concurrency)
+        return _budgets[service_name]
+
+def call(service_name, operation_name, func, *args, **kwargs):
+    # Call func with rate limiting, a concurrency budget and retries
+    api = '{}.{}'.format(service_name, operation_name)
+    rate_limiter = get_rate_limiter(api)
+    budget = get_budget(service_name)
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        budget.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            error_class = classify(e)
+            budget.release(error_class == THROTTLE)
+            if error_class == THROTTLE:
+                rate_limiter.on_throttle()
+            attempt += 1
+            if error_class == FATAL or attempt >= max_attempts:
+                raise
+            sh_metrics.record_client_retry(service_name, operation_name, error_class == THROTTLE)
+            delay = backoff_delay(attempt)
+            LOGGER.info('Retrying {} in {:.2f}s after {} ({}): {}'.format(api, delay, error_class, attempt, e))
+            time.sleep(delay)
+            continue
+        budget.release()
+        rate_limiter.on_success()
+        return result
+
+def get_service_name(client):
+    service_model = getattr(client.meta, 'service_model', None)
+    if service_model is not None:
+        return service_model.service_name
+    return getattr(client, 'service', 'aws')
+
+class RetryingPaginator(object):
+    # Pages are fetched with retried calls; a throttled page is fetched again, not skipped
+    def __init__(self, client, operation_name):
+        self.client = client
+        self.operation_name = operation_name
+
+    def paginate(self, **kwargs):
+        input_token, output_token, limit_key = paginated_operations[self.operation_name]
+        pagination = kwargs.pop('PaginationConfig', {})
+        if 'PageSize' in pagination:
+            kwargs[limit_key] = pagination['PageSize']
+        if 'StartingToken' in pagination:
+            kwargs[input_token] = pagination['StartingToken']
+        method = getattr(self.client, self.operation_name)
+        while True:
+            page = method(**kwargs)
+            yield page
+            token = page.get(output_token)
+            if not token:
+                return
+            kwargs[input_token] = token
+
+class RetryingClient(object):
+    # Proxy of a boto3 client whose operations go through call(..)
+    def __init__(self, client):
+        self._client = client
+        self._service_name = get_service_name(client)
+        self.meta = client.meta
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr) or name in ('can_paginate', 'get_waiter', 'close'):
+            return attr
+        return functools.partial(call, self._service_name, name, attr)
+
+    def get_paginator(self, operation_name):
+        if operation_name in paginated_operations:
+            return RetryingPaginator(self, operation_name)
+        return self._client.get_paginator(operation_name)
+
+def wrap_client(client):
+    if isinstance(client, RetryingClient):
+        return client
+    return RetryingClient(client)
+
+def client_config(config=None):
+    # Client config (botocore.config.Config) with a single botocore attempt per call:
+    # RetryingClient retries, so botocore retries would multiply every retry_max_attempts
+    from botocore.config import Config
+    single_attempt = Config(retries={ 'max_attempts': 1, 'mode': 'standard' })
+    return single_attempt if config is None else config.merge(single_attempt)
+
+def get_client(session, service_name, **kwargs):
+    # One retrying client per (session, service, client arguments), kept across warm invocations
+    key = (id(session), service_name, tuple(sorted(kwargs.items())))
+    with _lock:
+        if key not in _clients:
+            kwargs['config'] = client_config(kwargs.get('config'))
+            _clients[key] = wrap_client(session.client(service_name, **kwargs))
+        return _clients[key]
+
+def batch_get_items(db_client, table_name, keys, key_name='account_id', projection=None):
+    # Items of table_name with the string keys, in chunks of batch_get_max_keys;
+    # projection: attributes to return (ProjectionExpression), all attributes when None
+    items = []
+    for idx in range(0, len(keys), batch_get_max_keys):
+        request_items = {
+            table_name: {
+                'Keys': [ { key_name: { 'S': key } } for key in keys[idx:idx + batch_get_max_keys] ]
+            }
+        }
+        if projection is not None:
+            request_items[table_name].update({ 'ProjectionExpression': projection })
+        attempt = 0
+        while request_items:
+            if attempt > 0:
+                time.sleep(random.uniform(0, min(5.0, 0.05 * (2 ** attempt))))
+            response = db_client.batch_get_item(RequestItems=request_items)
+            items.extend(response['Responses'].get(table_name, []))
+            request_items = response.get('UnprocessedKeys', {})
+            attempt += 1
+            if request_items and attempt >= batch_max_attempts:
+                raise RuntimeError('{} keys of {} unprocessed after {} attempts'.format(len(request_items[table_name]['Keys']), table_name, attempt))
+    return items
+
+def batch_write_items(db_client, table_name, items):
+    # Put items into table_name, in chunks of batch_write_max_items
+    for idx in range(0, len(items), batch_write_max_items):
+        request_items = {
+            table_name: [ { 'PutRequest': { 'Item': item } } for item in items[idx:idx + batch_write_max_items] ]
+        }
+        attempt = 0
+        while request_items:
+            if attempt > 0:
+                time.sleep(random.uniform(0, min(5.0, 0.05 * (2 ** attempt))))
+            response = db_client.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems', {})
+            attempt += 1
+            if request_items and attempt >= batch_max_attempts:
+                raise RuntimeError('{} items of {} unprocessed after {} attempts'.format(len(request_items[table_name]), table_name, attempt))
+
+def reset():
+    with _lock:
+        _rate_limiters.clear()
+        _budgets.clear()
@@ -0,0 +1,165 @@
+#
+# Purpose: Plan balanced shards of Member Accounts from an estimate of each account's work
+# NOTE:
+# - An account's cost is the findings counted by its last summary (cost#<account> items of
+#   cost_table_name, or cost_store_path) or else its count in cost_insight_arn, an insight of the
+#   summary filters grouped by AwsAccountId (one GetInsightResults call for the top 100 accounts)
+# - cost_table_name is the stack owned SHAccountCostTable; its items carry expires_at
+#   (now + cost_ttl_days) for the table's TTL, so accounts no longer reported drop out
+# - Every account also costs account_base_cost (list, summary and email calls of any account)
+# - Shards are packed LPT style: heaviest account first, onto the lightest shard; shards are
+#   returned heaviest first so the Map state starts the longest work first
+# - Shards started heaviest first on the first free worker finish close to total cost / workers
+#   (never below the heaviest single account), instead of waiting on a shard that happened
+#   to collect several heavy accounts
+#
+
+import os
+import json
+import time
+import heapq
+import logging
+import sh_metrics
+import sh_retry
+
+LOGGER = logging.getLogger()
+
+account_base_cost = float(os.environ.get('account_base_cost', '50'))
+cost_insight_arn = os.environ.get('cost_insight_arn')
+cost_ttl_days = int(os.environ.get('cost_ttl_days', '30'))
+# GetInsightResults returns at most 100 group by values
+insight_max_results = 100
+
+_session = None
+
+class LocalCostStore(object):
+    # Costs kept in a local JSON file
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as store_file:
+                self.data = json.load(store_file)
+        except FileNotFoundError:
+            self.data = {}
+
+    def get_costs(self, member_accounts):
+        return { member_account: self.data[member_account] for member_account in member_accounts if member_account in self.data }
+
+    def put_costs(self, costs):
+        if len(costs) == 0:
+            return
+        self.data.update(costs)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as store_file:
+            json.dump(self.data, store_file)
+        os.replace(tmp_path, self.path)
+
+class DynamoDBCostStore(object):
+    # Costs kept as cost#<account> items of a DynamoDB table keyed by account_id
+    def __init__(self, db_client, table_name):
+        self.db_client = db_client
+        self.table_name = table_name
+
+    def get_costs(self, member_accounts):
+        costs = {}
+        keys = [ 'cost#' + member_account for member_account in member_accounts ]
+        for item in sh_retry.batch_get_items(self.db_client, self.table_name, keys):
+            costs[item['account_id']['S'].split('#', 1)[1]] = float(item['findings']['N'])
+        return costs
+
+    def put_costs(self, costs):
+        expires_at = str(int(time.time()) + cost_ttl_days * 86400)
+        items = [
+            {
+                'account_id': { 'S': 'cost#' + member_account },
+                'findings': { 'N': str(cost) },
+                'expires_at': { 'N': expires_at }
+            } for member_account, cost in costs.items()
+        ]
+        sh_retry.batch_write_items(self.db_client, self.table_name, items)
+
+def get_cost_store(session=None):
+    global _session
+    if 'cost_table_name' in os.environ:
+        if session is None:
+            if _session is None:
+                import boto3
+                _session = sh_metrics.instrument(boto3.Session())
+            session = _session
+        return DynamoDBCostStore(sh_retry.get_client(session, 'dynamodb'), os.environ['cost_table_name'])
+    return LocalCostStore(os.environ.get('cost_store_path', '/tmp/sh-account-costs.json'))
+
+def summary_cost(member_summary):
+    # Findings counted in a member summary (severity and type views); a failed summary costs 0
+    count = 0
+    for severity_count in member_summary.get('severity_count') or []:
+        count += sum([ result['Count'] for result in severity_count.get('result') or [] ])
+    count += sum([ result['Count'] for result in member_summary.get('SecurityHub') or [] ])
+    return count
+
+def get_insight_costs(sh_admin_client, insight_arn):
+    # {account: finding count} of the (at most 100) accounts with the most findings, and
+    # whether accounts missing from the results can have findings (results were truncated)
+    response = sh_admin_client.get_insight_results(InsightArn=insight_arn)
+    insight_results = response['InsightResults']
+    if insight_results.get('GroupByAttribute') != 'AwsAccountId':
+        raise ValueError('insight {} is not grouped by AwsAccountId'.format(insight_arn))
+    costs = { result['GroupByAttributeValue']: float(result['Count']) for result in insight_results['ResultValues'] }
+    return costs, len(costs) >= insight_max_results
+
+def estimate_costs(member_accounts, store=None, sh_admin_client=None):
+    # Estimated cost of each account: stored costs, then insight counts, then the smallest
+    # count the insight returned (accounts outside a truncated top 100 have at most that many)
+    costs = {}
+    if store is not None:
+        try:
+            costs.update(store.get_costs(member_accounts))
+        except Exception as e:
+            LOGGER.error(f'failed in get_costs(..): {e}')
+            LOGGER.error(str(e))
+    unknown = [ member_account for member_account in member_accounts if member_account not in costs ]
+    default = 0.0
+    if len(unknown) > 0 and sh_admin_client is not None and cost_insight_arn:
+        try:
+            insight_costs, truncated = get_insight_costs(sh_admin_client, cost_insight_arn)
+            costs.update({ member_account: insight_costs[member_account] for member_account in unknown if member_account in insight_costs })
+            if truncated:
+                default = min(insight_costs.values())
+        except Exception as e:
+            LOGGER.error(f'failed in get_insight_results(..): {e}')
+            LOGGER.error(str(e))
+    LOGGER.info('Costs of {} Members: {} stored or counted'.format(len(member_accounts), len([ member_account for member_account in member_accounts if member_account in costs ])))
+    return { member_account: costs.get(member_account, default) + account_base_cost for member_account in member_accounts }
+
+def plan_shards(members, costs, shard_count):
+    # LPT: assign accounts heaviest first to the shard with the least work so far.
+    # Returns [(shard cost, [member, ..]), ..], heaviest shard first, members heaviest first
+    shard_count = max(1, min(shard_count, len(members)))
+    heap = [ (0.0, idx) for idx in range(shard_count) ]
+    shards = [ [] for idx in range(shard_count) ]
+    loads = [ 0.0 ] * shard_count
+    for member in sorted(members, key=lambda member: -costs[member['account_id']]):
+        load, idx = heapq.heappop(heap)
+        shards[idx].append(member)
+        loads[idx] = load + costs[member['account_id']]
+        heapq.heappush(heap, (loads[idx], idx))
+    planned = [ (loads[idx], shards[idx]) for idx in range(shard_count) if len(shards[idx]) > 0 ]
+    return sorted(planned, key=lambda shard: -shard[0])
+
+def makespan(shard_costs, workers):
+    # Completion time of shards started in order on the first free of workers
+    finish = [ 0.0 ] * max(1, workers)
+    for cost in shard_costs:
+        heapq.heapreplace(finish, finish[0] + cost)
+    return max(finish)
+
+def plan_summary(planned, costs, workers):
+    # Estimated makespan of the plan and its lower bound (no plan finishes earlier)
+    shard_costs = [ cost for cost, shard in planned ]
+    total = sum(shard_costs)
+    return {
+        'total_cost': round(total, 1),
+        'max_shard_cost': round(max(shard_costs), 1) if shard_costs else 0,
+        'estimated_makespan': round(makespan(shard_costs, workers), 1),
+        'lower_bound': round(max([ total / max(1, workers) ] + list(costs.values())), 1)
+    }
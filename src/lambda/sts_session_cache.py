@@ -0,0 +1,115 @@
+#
+# Purpose: Process wide cache of assumed role credentials, sessions and clients
+# NOTE:
+# - Module level state survives across warm Lambda invocations
+# - Credentials are keyed by (account, role) and refreshed when close to expiry
+# - Clients are keyed by (account, role, region, service, client arguments) and retried
+#   through sh_retry
+#
+
+import os
+import boto3
+import logging
+import sh_metrics
+import sh_retry
+import threading
+from datetime import datetime, timezone
+
+LOGGER = logging.getLogger()
+
+# Refresh assumed role credentials this many seconds before they expire
+refresh_window_seconds = int(os.environ.get('credentials_refresh_seconds', '300'))
+
+_lock = threading.RLock()
+_sts_client = None
+_partition = None
+_sessions = {}
+_session_locks = {}
+_clients = {}
+
+def get_sts_client():
+    global _sts_client
+    with _lock:
+        if _sts_client is None:
+            _sts_client = sh_retry.wrap_client(sh_metrics.instrument(boto3.client('sts')))
+        return _sts_client
+
+def get_partition():
+    global _partition
+    with _lock:
+        if _partition is None:
+            _partition = get_sts_client().get_caller_identity()['Arn'].split(":")[1]
+        return _partition
+
+def _is_expiring(expiration):
+    if expiration is None:
+        return False
+    if expiration.tzinfo is None:
+        expiration = expiration.replace(tzinfo=timezone.utc)
+    remaining = (expiration - datetime.now(timezone.utc)).total_seconds()
+    return remaining < refresh_window_seconds
+
+def _assume_role(org_id, aws_account_number, role_name):
+    response = get_sts_client().assume_role(
+        RoleArn='arn:%s:iam::%s:role/%s' % (
+            get_partition(), aws_account_number, role_name
+        ),
+        RoleSessionName=str(aws_account_number+'-'+role_name),
+        ExternalId=org_id
+    )
+    sts_session = sh_metrics.instrument(boto3.Session(
+        aws_access_key_id=response['Credentials']['AccessKeyId'],
+        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
+        aws_session_token=response['Credentials']['SessionToken']
+    ))
+    LOGGER.info("Assumed region_session for Account {}".format(aws_account_number))
+    return sts_session, response['Credentials'].get('Expiration')
+
+def get_session(org_id, aws_account_number, role_name):
+    key = (aws_account_number, role_name)
+    with _lock:
+        cached = _sessions.get(key)
+        if cached is not None and not _is_expiring(cached['expiration']):
+            return cached['session']
+        key_lock = _session_locks.setdefault(key, threading.Lock())
+    # assume_role runs outside the global lock, so different accounts are assumed
+    # concurrently; the per key lock makes concurrent callers of one key wait for one call
+    with key_lock:
+        with _lock:
+            cached = _sessions.get(key)
+            if cached is not None and not _is_expiring(cached['expiration']):
+                return cached['session']
+        sts_session, expiration = _assume_role(org_id, aws_account_number, role_name)
+        with _lock:
+            _sessions[key] = {
+                'session': sts_session,
+                'expiration': expiration
+            }
+            # clients built from the previous credentials are stale
+            for client_key in [ k for k in _clients if k[:2] == key ]:
+                del _clients[client_key]
+        return sts_session
+
+def get_client(org_id, aws_account_number, role_name, service_name, region=None, **client_kwargs):
+    key = (aws_account_number, role_name, region, service_name, tuple(sorted(client_kwargs.items())))
+    # get_session first so that expired credentials evict their clients
+    sts_session = get_session(org_id, aws_account_number, role_name)
+    with _lock:
+        cached = _clients.get(key)
+        # a client of the session returned above (not of credentials refreshed since)
+        if cached is None or cached[0] is not sts_session:
+            if region is not None:
+                client_kwargs['region_name'] = region
+            client_kwargs['config'] = sh_retry.client_config(client_kwargs.get('config'))
+            cached = (sts_session, sh_retry.wrap_client(sts_session.client(service_name, **client_kwargs)))
+            _clients[key] = cached
+        return cached[1]
+
+def clear():
+    global _sts_client, _partition
+    with _lock:
+        _sts_client = None
+        _partition = None
+        _sessions.clear()
+        _session_locks.clear()
+        _clients.clear()
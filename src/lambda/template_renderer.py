@@ -0,0 +1,188 @@
+#
+# Purpose: Local renderer for the handlebars subset used by the SES email templates
+# NOTE:
+# - Supports {{path}}, {{{path}}}, {{#each}}, {{#if}}, {{#unless}}, {{#with}}, {{else}},
+#   this / ../ / @index / @first / @last and paths such as member_summary.SecurityHub[0].Count
+# - {{path}} is HTML escaped in HtmlPart only; {{{path}}} is never escaped
+# - Templates are compiled once; rendered emails are memoized by a hash of the template data
+#
+
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+_TOKEN = re.compile(r'{{{\s*(.*?)\s*}}}|{{\s*(.*?)\s*}}', re.S)
+_PATH_PART = re.compile(r'([^.\[\]]+)|\[(\d+)\]')
+_HTML_ESCAPES = {
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    "'": '&#x27;',
+    '`': '&#x60;',
+    '=': '&#x3D;'
+}
+_HTML_ESCAPE = re.compile('[&<>"\'`=]')
+_BLOCK_HELPERS = ('each', 'if', 'unless', 'with')
+
+class TemplateSyntaxError(Exception):
+    pass
+
+def escape_html(value):
+    return _HTML_ESCAPE.sub(lambda match: _HTML_ESCAPES[match.group(0)], value)
+
+def to_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+def is_truthy(value):
+    # handlebars treats empty lists as falsy, like None, False, '' and 0
+    return bool(value)
+
+def parse_path(path):
+    # 'a.b[0].c' -> ['a', 'b', 0, 'c']; '../' prefixes are counted separately
+    depth = 0
+    while path.startswith('../'):
+        depth += 1
+        path = path[3:]
+    if path in ('this', '.', ''):
+        return depth, []
+    if path.startswith('this.'):
+        path = path[5:]
+    parts = []
+    for name, index in _PATH_PART.findall(path):
+        parts.append(int(index) if index else name)
+    return depth, parts
+
+def lookup(stack, path):
+    depth, parts = path
+    if depth >= len(stack):
+        return None
+    frame = stack[-1 - depth]
+    if len(parts) == 1 and isinstance(parts[0], str) and parts[0].startswith('@'):
+        return frame['data'].get(parts[0])
+    value = frame['context']
+    for part in parts:
+        if isinstance(part, int):
+            value = value[part] if isinstance(value, list) and -len(value) <= part < len(value) else None
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            value = None
+        if value is None:
+            return None
+    return value
+
+def compile_template(source):
+    # Compile template source into a node tree:
+    # ('text', str) | ('var', path, escape) | ('block', helper, path, children, inverse)
+    root = []
+    stack = [ ('root', None, root, None) ]
+    position = 0
+    for match in _TOKEN.finditer(source):
+        if match.start() > position:
+            stack[-1][2].append(('text', source[position:match.start()]))
+        position = match.end()
+        if match.group(1) is not None:
+            stack[-1][2].append(('var', parse_path(match.group(1)), False))
+            continue
+        tag = match.group(2)
+        if tag.startswith('!'):
+            continue
+        if tag.startswith('#'):
+            helper, _, path = tag[1:].partition(' ')
+            if helper not in _BLOCK_HELPERS:
+                raise TemplateSyntaxError('Unsupported block helper: {}'.format(helper))
+            block = (helper, parse_path(path.strip()), [], [])
+            stack[-1][2].append(('block',) + block)
+            stack.append((helper, block, block[2], block[3]))
+        elif tag.startswith('/'):
+            helper = tag[1:].strip()
+            if stack[-1][0] != helper:
+                raise TemplateSyntaxError('Unexpected closing tag: {}'.format(tag))
+            stack.pop()
+        elif tag == 'else':
+            if stack[-1][0] == 'root':
+                raise TemplateSyntaxError('{{else}} outside of a block')
+            helper, block, children, inverse = stack.pop()
+            stack.append((helper, block, inverse, None))
+        else:
+            stack[-1][2].append(('var', parse_path(tag), True))
+    if len(stack) > 1:
+        raise TemplateSyntaxError('Unclosed block: {}'.format(stack[-1][0]))
+    if position < len(source):
+        root.append(('text', source[position:]))
+    return root
+
+def render_nodes(nodes, stack, escape, out):
+    for node in nodes:
+        kind = node[0]
+        if kind == 'text':
+            out.append(node[1])
+        elif kind == 'var':
+            text = to_text(lookup(stack, node[1]))
+            out.append(escape_html(text) if escape and node[2] else text)
+        else:
+            helper, path, children, inverse = node[1:]
+            value = lookup(stack, path)
+            if helper == 'each':
+                items = list(value.items()) if isinstance(value, dict) else list(enumerate(value or []))
+                if len(items) == 0:
+                    render_nodes(inverse, stack, escape, out)
+                for idx, (key, item) in enumerate(items):
+                    data = { '@index': idx, '@key': key, '@first': idx == 0, '@last': idx == len(items) - 1 }
+                    stack.append({ 'context': item, 'data': data })
+                    render_nodes(children, stack, escape, out)
+                    stack.pop()
+            elif helper == 'with':
+                if is_truthy(value):
+                    stack.append({ 'context': value, 'data': stack[-1]['data'] })
+                    render_nodes(children, stack, escape, out)
+                    stack.pop()
+                else:
+                    render_nodes(inverse, stack, escape, out)
+            else:
+                truthy = is_truthy(value) if helper == 'if' else not is_truthy(value)
+                render_nodes(children if truthy else inverse, stack, escape, out)
+
+class EmailTemplate(object):
+    # Compiled SES template (SubjectPart, HtmlPart, TextPart) with a render memo
+    def __init__(self, template, memo_size=256):
+        self.name = template.get('TemplateName')
+        self.parts = {}
+        for part in ('SubjectPart', 'HtmlPart', 'TextPart'):
+            if template.get(part):
+                self.parts[part] = compile_template(template[part])
+        self.memo_size = memo_size
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+
+    def render_part(self, part, data):
+        out = []
+        render_nodes(self.parts[part], [ { 'context': data, 'data': {} } ], part == 'HtmlPart', out)
+        return ''.join(out)
+
+    def render(self, data):
+        # Returns (digest, {'SubjectPart': .., 'HtmlPart': .., 'TextPart': ..})
+        digest = data_digest(data)
+        with self.lock:
+            if digest in self.memo:
+                self.memo.move_to_end(digest)
+                return digest, self.memo[digest]
+        rendered = { part: self.render_part(part, data) for part in self.parts }
+        with self.lock:
+            self.memo[digest] = rendered
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return digest, rendered
+
+def data_digest(data):
+    # Stable content hash of template data
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')).hexdigest()
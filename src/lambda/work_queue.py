@@ -0,0 +1,179 @@
+#
+# Purpose: Queue of resource findings work items and the keyed store of their results
+# NOTE:
+# - A work item is one (member account, region, batch of up to 20 resources) lookup,
+#   identified by item_id (hash of account, region and resources)
+# - Items go to the SQS queue work_queue_url (queue_endpoint_url points the client at an SQS
+#   compatible stand-in such as ElasticMQ) or to work_queue_dir, a local directory queue
+# - The local queue has SQS semantics for tests: received messages are claimed (invisible to
+#   other consumers, also in other processes), failed ones become visible again and move to
+#   dead-letter/ after max_receive_count receives; drain(..) feeds a consumer SQS style events
+# - Results are stored by item key under s3://<result_bucket>/<result_prefix> (result_bucket
+#   defaults to payload_bucket) or result_dir, so retried items overwrite their own result
+#
+
+import os
+import json
+import time
+import uuid
+import random
+import hashlib
+import logging
+import sh_logging
+import sh_metrics
+import sh_retry
+
+LOGGER = logging.getLogger()
+
+work_queue_url = os.environ.get('work_queue_url')
+queue_endpoint_url = os.environ.get('queue_endpoint_url')
+work_queue_dir = os.environ.get('work_queue_dir', '/tmp/sh-work-queue')
+max_receive_count = int(os.environ.get('max_receive_count', '5'))
+result_bucket = os.environ.get('result_bucket', os.environ.get('payload_bucket'))
+result_prefix = os.environ.get('result_prefix', 'resource-findings/')
+result_dir = os.environ.get('result_dir', '/tmp/sh-resource-findings')
+
+# SendMessageBatch accepts at most 10 messages
+send_batch_max_entries = 10
+send_batch_max_attempts = 8
+
+_session = None
+
+def item_id(member_account, region, resource_ids):
+    key = json.dumps([ member_account, region, sorted(resource_ids) ])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def result_key(item):
+    return '{}/{}/{}.json'.format(item['member_account'], item['region'], item['item_id'])
+
+class SQSWorkQueue(object):
+    def __init__(self, sqs_client, queue_url):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+
+    def send(self, items):
+        for idx in range(0, len(items), send_batch_max_entries):
+            entries = [
+                {
+                    'Id': str(entry_idx),
+                    'MessageBody': sh_logging.dumps(item)
+                } for entry_idx, item in enumerate(items[idx:idx + send_batch_max_entries])
+            ]
+            attempt = 0
+            while entries:
+                if attempt > 0:
+                    time.sleep(random.uniform(0, min(5.0, 0.05 * (2 ** attempt))))
+                response = self.sqs_client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+                failed = set([ failure['Id'] for failure in response.get('Failed', []) ])
+                entries = [ entry for entry in entries if entry['Id'] in failed ]
+                attempt += 1
+                if entries and attempt >= send_batch_max_attempts:
+                    raise RuntimeError('{} work items not queued after {} attempts: {}'.format(len(entries), attempt, response.get('Failed')))
+
+class LocalWorkQueue(object):
+    # Directory queue: <id>.json visible, <id>.inflight claimed by a consumer
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, 'dead-letter'), exist_ok=True)
+
+    def send(self, items):
+        for item in items:
+            message_id = str(uuid.uuid4())
+            message = { 'messageId': message_id, 'body': sh_logging.dumps(item), 'receiveCount': 0 }
+            tmp_path = os.path.join(self.path, message_id + '.tmp')
+            with open(tmp_path, 'w') as message_file:
+                json.dump(message, message_file)
+            os.replace(tmp_path, os.path.join(self.path, message_id + '.json'))
+
+    def receive(self, max_messages=10):
+        # Claim up to max_messages visible messages, as records of an SQS event
+        records = []
+        for file_name in sorted(os.listdir(self.path)):
+            if len(records) >= max_messages:
+                break
+            if not file_name.endswith('.json'):
+                continue
+            message_id = file_name[:-len('.json')]
+            inflight_path = os.path.join(self.path, message_id + '.inflight')
+            try:
+                os.rename(os.path.join(self.path, file_name), inflight_path)
+            except FileNotFoundError:
+                # claimed by another consumer
+                continue
+            with open(inflight_path) as message_file:
+                message = json.load(message_file)
+            message['receiveCount'] += 1
+            with open(inflight_path, 'w') as message_file:
+                json.dump(message, message_file)
+            records.append({
+                'messageId': message_id,
+                'receiptHandle': message_id,
+                'body': message['body'],
+                'attributes': { 'ApproximateReceiveCount': str(message['receiveCount']) },
+                'eventSource': 'aws:sqs'
+            })
+        return records
+
+    def delete(self, record):
+        os.remove(os.path.join(self.path, record['receiptHandle'] + '.inflight'))
+
+    def release(self, record):
+        # A failed message is received again, or dead-lettered after max_receive_count receives
+        inflight_path = os.path.join(self.path, record['receiptHandle'] + '.inflight')
+        if int(record['attributes']['ApproximateReceiveCount']) >= max_receive_count:
+            os.replace(inflight_path, os.path.join(self.path, 'dead-letter', record['receiptHandle'] + '.json'))
+        else:
+            os.replace(inflight_path, os.path.join(self.path, record['receiptHandle'] + '.json'))
+
+    def drain(self, consumer, batch_size=10, max_batches=None):
+        # Feed batches to consumer(event, context) like an SQS event source mapping with
+        # ReportBatchItemFailures until the queue is empty; returns (processed, failed) counts
+        processed = 0
+        failed = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            records = self.receive(batch_size)
+            if len(records) == 0:
+                break
+            batches += 1
+            try:
+                response = consumer({ 'Records': records }, None) or {}
+                failed_ids = set([ failure['itemIdentifier'] for failure in response.get('batchItemFailures', []) ])
+            except Exception as e:
+                LOGGER.error(f'failed in consumer(..): {e}')
+                failed_ids = set([ record['messageId'] for record in records ])
+            for record in records:
+                if record['messageId'] in failed_ids:
+                    self.release(record)
+                    failed += 1
+                else:
+                    self.delete(record)
+                    processed += 1
+        return processed, failed
+
+def get_work_queue(session=None):
+    global _session
+    if work_queue_url is not None:
+        if session is None:
+            if _session is None:
+                # boto3 is only needed with an SQS queue
+                import boto3
+                _session = sh_metrics.instrument(boto3.Session())
+            session = _session
+        kwargs = { 'endpoint_url': queue_endpoint_url } if queue_endpoint_url else {}
+        return SQSWorkQueue(sh_retry.get_client(session, 'sqs', **kwargs), work_queue_url)
+    return LocalWorkQueue(work_queue_dir)
+
+def put_result(item, result):
+    key = result_key(item)
+    body = sh_logging.dumps(result)
+    if result_bucket is not None:
+        import payload_store
+        payload_store.get_s3_client().put_object(Bucket=result_bucket, Key=result_prefix + key, Body=body.encode('utf-8'))
+        return { 'bucket': result_bucket, 'key': result_prefix + key }
+    path = os.path.join(result_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as result_file:
+        result_file.write(body)
+    os.replace(path + '.tmp', path)
+    return { 'path': path }
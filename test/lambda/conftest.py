@@ -0,0 +1,80 @@
+#
+# Purpose: pytest fixtures running the Lambda modules offline against bench/fake_aws.py
+# NOTE:
+# - org is a small synthetic organization installed in place of boto3/botocore
+# - events/ holds recorded Security Hub finding events (bench/replay_findings_events.py --record)
+# - lambda_env points every store of the Lambdas (summary, digests, ledger, costs, payloads)
+#   at a temporary directory, as bench/bench_lambdas.py does
+# - load_lambda(name) loads a Lambda source file cold, with freshly imported shared modules
+# - Usage: python -m pytest -q test/lambda
+#
+
+import os
+import sys
+import random
+from datetime import datetime, timedelta, timezone
+import pytest
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+bench_dir = os.path.join(test_dir, '..', '..', 'bench')
+sys.path.insert(0, bench_dir)
+
+import fake_aws
+import bench_lambdas
+
+@pytest.fixture
+def org(request):
+    # SyntheticOrg arguments can be overridden with indirect parametrization
+    org = fake_aws.SyntheticOrg(**dict({ 'accounts': 45, 'findings': 4500, 'regions': 2 }, **getattr(request, 'param', {})))
+    previous = fake_aws.install(org)
+    yield org
+    for name, module in previous.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+
+@pytest.fixture
+def lambda_env(tmp_path, monkeypatch):
+    for key, value in bench_lambdas.get_environment(str(tmp_path), {}).items():
+        monkeypatch.setenv(key, value)
+    return monkeypatch
+
+@pytest.fixture
+def load_lambda(org, lambda_env):
+    return bench_lambdas.load_lambda
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+
+def churn_findings(org, count, seed=1, updated_at=None):
+    # Updated versions of count random findings (escalated, resolved or archived),
+    # held by the organization from now on; returns the new versions
+    rng = random.Random(seed)
+    updated_at = updated_at or datetime.now(timezone.utc) - timedelta(seconds=1)
+    findings = []
+    for idx in range(count):
+        account_idx = rng.randrange(len(org.account_ids))
+        finding = dict(org.finding(account_idx, rng.randrange(org.account_findings(account_idx))))
+        change = rng.random()
+        if change < 0.6:
+            finding.update({
+                'Severity': { 'Label': rng.choice([ 'CRITICAL', 'HIGH' ]) },
+                'Compliance': { 'Status': 'FAILED' },
+                'RecordState': 'ACTIVE',
+                'Workflow': { 'Status': 'NEW' },
+                'Types': [ fake_aws.standard_types[idx % len(fake_aws.standard_types)] ]
+            })
+        elif change < 0.8:
+            finding.update({ 'Workflow': { 'Status': 'RESOLVED' } })
+        else:
+            finding.update({ 'RecordState': 'ARCHIVED' })
+        finding['UpdatedAt'] = (updated_at + timedelta(microseconds=idx)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        findings.append(finding)
+    org.update_findings(findings)
+    return findings
+
+@pytest.fixture
+def churn(org):
+    return lambda count, **kwargs: churn_findings(org, count, **kwargs)
@@ -0,0 +1,39 @@
+#
+# Purpose: Batch mode of add-ses-identity (SESIdentitiesSM passes the whole get-sh-members payload)
+#
+
+import pytest
+import fake_aws
+import bench_lambdas
+
+def test_spilled_member_list_is_verified(org, load_lambda, lambda_env):
+    lambda_env.setenv('max_inline_bytes', '512')
+    payload_store = load_lambda('get-sh-members').payload_store
+    members = bench_lambdas.get_members(org)
+    payload = payload_store.to_payload('member_list', members)
+    assert 'member_list_ref' in payload
+    result = load_lambda('add-ses-identity').lambda_handler(payload, None)
+    email_addresses = set([ member['account_email'] for member in members ] + [ member['tech_owner_email'] for member in members if 'tech_owner_email' in member ])
+    assert sum(result['verification_counts'].values()) == len(email_addresses)
+    assert set(org.identities) >= email_addresses
+
+def fail_calls(org, event_name):
+    def access_denied(**kwargs):
+        raise fake_aws.ClientError({ 'Error': { 'Code': 'AccessDeniedException', 'Message': 'denied' } }, event_name.split('.')[-1])
+    org.events.register('before-call.' + event_name, access_denied)
+
+def test_failed_status_lookup_does_not_verify_again(org, load_lambda, lambda_env):
+    members = bench_lambdas.get_members(org)
+    verified = [ email_address for email_address, status in org.identities.items() if status == 'Success' ]
+    fail_calls(org, 'ses.GetIdentityVerificationAttributes')
+    result = load_lambda('add-ses-identity').lambda_handler({ 'member_list': members }, None)
+    assert result['verification_counts']['LookupFailed'] == len(verified)
+    assert all([ org.identities[email_address] == 'Success' for email_address in verified ])
+    assert org.calls['ses.verify_email_identity'] == result['verification_counts']['NotFound']
+
+def test_failed_identity_listing_fails_the_batch(org, load_lambda, lambda_env):
+    members = bench_lambdas.get_members(org)
+    fail_calls(org, 'ses.ListIdentities')
+    with pytest.raises(fake_aws.ClientError):
+        load_lambda('add-ses-identity').lambda_handler({ 'member_list': members }, None)
+    assert 'ses.verify_email_identity' not in org.calls
@@ -0,0 +1,52 @@
+#
+# Purpose: Resource views of the findings snapshot read by sh-insights-collector and
+#          sh-resource-findings (snapshot_mode=read)
+#
+
+import bench_lambdas
+
+def save_snapshot(load_lambda, monkeypatch, member_accounts):
+    # sh-summary-collector builds and saves a snapshot of member_accounts
+    monkeypatch.setenv('snapshot_mode', 'write')
+    collector = load_lambda('sh-summary-collector')
+    collector.snapshot_aggregate(collector.sh_retry.get_client(collector.session, 'securityhub'), member_accounts)
+
+def finding_ids(member_insight_findings):
+    return [ [ finding['Id'] for finding in result['resource_findings'] ] for result in member_insight_findings ]
+
+def test_resource_findings_from_snapshot_match_queries(org, load_lambda, lambda_env):
+    event = bench_lambdas.scenarios['sh-resource-findings'](org)
+    queried = load_lambda('sh-resource-findings').lambda_handler(event, None)
+    save_snapshot(load_lambda, lambda_env, org.account_ids)
+    lambda_env.setenv('snapshot_mode', 'read')
+    resource_findings = load_lambda('sh-resource-findings')
+    org.reset_counters()
+    from_snapshot = resource_findings.lambda_handler(event, None)
+    assert finding_ids(from_snapshot) == finding_ids(queried)
+    assert any([ len(result['resource_findings']) > 0 for result in from_snapshot ])
+    assert 'securityhub.get_findings' not in org.calls
+
+def test_insight_results_from_snapshot(org, load_lambda, lambda_env):
+    save_snapshot(load_lambda, lambda_env, org.account_ids)
+    lambda_env.setenv('snapshot_mode', 'read')
+    insights_collector = load_lambda('sh-insights-collector')
+    org.reset_counters()
+    members_insights_results = insights_collector.lambda_handler(bench_lambdas.scenarios['sh-insights-collector'](org), None)
+    assert 'securityhub.get_insight_results' not in org.calls
+    # resources with the most ACTIVE FAILED findings in a NEW or NOTIFIED workflow
+    counts = {}
+    for region in org.regions:
+        for finding in org.iter_findings(region, {}):
+            if finding['Compliance']['Status'] == 'FAILED' and finding['RecordState'] == 'ACTIVE' and finding['Workflow']['Status'] in ('NEW', 'NOTIFIED'):
+                resource_id = finding['Resources'][0]['Id']
+                counts[resource_id] = counts.get(resource_id, 0) + 1
+    expected = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:100]
+    resource_ids = [ result['ResourceId'] for member_insights_result in members_insights_results for result in member_insights_result['member_insight_results'] ]
+    assert sorted(resource_ids) == sorted([ resource_id for resource_id, count in expected ])
+
+def test_insight_results_are_queried_without_snapshot(org, load_lambda, lambda_env):
+    lambda_env.setenv('snapshot_mode', 'read')
+    insights_collector = load_lambda('sh-insights-collector')
+    members_insights_results = insights_collector.lambda_handler(bench_lambdas.scenarios['sh-insights-collector'](org), None)
+    assert org.calls['securityhub.get_insight_results'] == 1
+    assert len(members_insights_results) > 0
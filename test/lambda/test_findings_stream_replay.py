@@ -0,0 +1,47 @@
+#
+# Purpose: Replay of recorded finding events through sh-findings-stream
+# NOTE:
+# - events/finding-events.ndjson was recorded with bench/replay_findings_events.py
+#   --accounts 4 --findings 40 --generate 40 --duration-seconds 240 --record (seed 1), so that
+#   findings are updated several times and late deliveries are older versions
+#
+
+import os
+import pytest
+import replay_findings_events
+
+events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events', 'finding-events.ndjson')
+recorded_org = { 'accounts': 4, 'findings': 40, 'regions': 1, 'seed': 1 }
+
+@pytest.fixture
+def stream(org, load_lambda, lambda_env):
+    lambda_env.setenv('incremental', 'true')
+    lambda_env.setenv('summary_table_name', 'sh-summary-state')
+    collector = load_lambda('sh-summary-collector')
+    collector.incremental_aggregate(collector.sh_retry.get_client(collector.session, 'securityhub'), collector.get_summary_store(), org.account_ids)
+    return load_lambda('sh-findings-stream')
+
+@pytest.mark.parametrize('org', [ recorded_org ], indirect=True)
+def test_replayed_batches_are_idempotent(org, stream):
+    collector = stream.sh_summary_collector
+    batches = replay_findings_events.micro_batches(replay_findings_events.read_events(events_path), 60)
+    # every batch also carries earlier events: older versions of findings delivered late
+    batches = replay_findings_events.redeliver(batches, 5, 1)
+    assert len(batches) > 1
+    latest = {}
+    stale_count = 0
+    for batch in batches:
+        findings = [ finding for finding_event in batch for finding in finding_event['detail']['findings'] ]
+        stale_count += len([ finding for finding in findings if finding['UpdatedAt'] < latest.get(finding['Id'], '') ])
+        for finding in findings:
+            latest[finding['Id']] = max(latest.get(finding['Id'], ''), finding['UpdatedAt'])
+        org.update_findings(findings)
+        result = stream.lambda_handler(replay_findings_events.to_sqs_event(batch), None)
+        assert result['event_count'] == len(batch)
+        counts = replay_findings_events.stored_counts(collector, org.account_ids)
+        # the same batch received again (SQS redelivery) changes nothing and raises no alert
+        replayed = stream.lambda_handler(replay_findings_events.to_sqs_event(batch), None)
+        assert replayed['alerts'] == {}
+        assert replay_findings_events.stored_counts(collector, org.account_ids) == counts
+        assert replay_findings_events.recount_mismatches(collector, counts) == []
+    assert stale_count > 0
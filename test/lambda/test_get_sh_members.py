@@ -0,0 +1,23 @@
+#
+# Purpose: Account emails added to members by get-sh-members (BatchGetItem through sh_retry)
+#
+
+import pytest
+import bench_lambdas
+
+def test_members_get_tech_owner_emails(org, load_lambda, lambda_env):
+    get_sh_members = load_lambda('get-sh-members')
+    expected = [ member for member in bench_lambdas.get_members(org) if 'tech_owner_email' in member ]
+    members = [ { key: member[key] for key in ('account_id', 'account_email', 'sh_status') } for member in bench_lambdas.get_members(org) ]
+    db_client = get_sh_members.sh_retry.get_client(get_sh_members.session, 'dynamodb')
+    member_emails = list(get_sh_members.get_member_emails(db_client, 'sh-members', iter(members)))
+    assert [ member['tech_owner_email'] for member in member_emails ] == [ member['tech_owner_email'] for member in expected ]
+    assert org.calls['dynamodb.batch_get_item'] == 1
+
+def test_unprocessed_keys_are_not_dropped(org, load_lambda, lambda_env, no_sleep):
+    get_sh_members = load_lambda('get-sh-members')
+    members = [ { 'account_id': member['account_id'] } for member in bench_lambdas.get_members(org) ]
+    db_client = get_sh_members.sh_retry.get_client(get_sh_members.session, 'dynamodb')
+    org.throttle_rate = 1.0
+    with pytest.raises(RuntimeError, match='unprocessed'):
+        list(get_sh_members.get_member_emails(db_client, 'sh-members', iter(members)))
@@ -0,0 +1,60 @@
+#
+# Purpose: Incremental summary mode (sh-summary-collector) against a full recount
+#
+
+def get_collector(load_lambda, monkeypatch):
+    monkeypatch.setenv('incremental', 'true')
+    collector = load_lambda('sh-summary-collector')
+    return collector, collector.sh_retry.get_client(collector.session, 'securityhub')
+
+def stored_counts(store, member_accounts):
+    return { member_account: account_state['counts'] for member_account, account_state in store.get_account_states(member_accounts).items() }
+
+def full_counts(collector, sh_admin_client, member_accounts):
+    recounts = collector.count_findings(sh_admin_client, member_accounts)
+    return { member_account: recounts.get(member_account, {}) for member_account in member_accounts }
+
+def test_incremental_counts_match_full_recount_after_churn(org, load_lambda, lambda_env, churn):
+    collector, sh_admin_client = get_collector(load_lambda, lambda_env)
+    store = collector.get_summary_store()
+    member_accounts = org.account_ids
+    collector.incremental_aggregate(sh_admin_client, store, member_accounts)
+    for seed in range(3):
+        churn(200, seed=seed)
+        summaries = collector.incremental_aggregate(sh_admin_client, store, member_accounts)
+        expected = full_counts(collector, sh_admin_client, member_accounts)
+        assert stored_counts(store, member_accounts) == expected
+        assert summaries == { member_account: collector.to_member_summary(counts) for member_account, counts in expected.items() }
+
+def test_incremental_run_reads_only_its_accounts_updates(org, load_lambda, lambda_env, churn):
+    # a shard of more than max_filter_values accounts queries its accounts in chunks
+    collector, sh_admin_client = get_collector(load_lambda, lambda_env)
+    store = collector.get_summary_store()
+    shard = org.account_ids[:30]
+    collector.incremental_aggregate(sh_admin_client, store, shard)
+    churn(100)
+    queried = []
+    iter_findings = org.iter_findings
+    def record_query(region, filters):
+        queried.append(filters.get('AwsAccountId'))
+        return iter_findings(region, filters)
+    lambda_env.setattr(org, 'iter_findings', record_query)
+    collector.incremental_aggregate(sh_admin_client, store, shard)
+    # one query per (region, chunk of 20 accounts): the churn of the other accounts is not read
+    assert len(queried) == len(org.regions) * 2
+    for account_filter in queried:
+        assert account_filter is not None and len(account_filter) <= collector.max_filter_values
+        assert set([ condition['Value'] for condition in account_filter ]) <= set(shard)
+    assert stored_counts(store, shard) == full_counts(collector, sh_admin_client, shard)
+
+def test_incremental_run_is_idempotent(org, load_lambda, lambda_env, churn):
+    collector, sh_admin_client = get_collector(load_lambda, lambda_env)
+    store = collector.get_summary_store()
+    member_accounts = org.account_ids
+    collector.incremental_aggregate(sh_admin_client, store, member_accounts)
+    churn(150)
+    collector.incremental_aggregate(sh_admin_client, store, member_accounts)
+    counts = stored_counts(store, member_accounts)
+    # the next run reads the same updates again (watermark overlap)
+    collector.incremental_aggregate(sh_admin_client, store, member_accounts)
+    assert stored_counts(store, member_accounts) == counts
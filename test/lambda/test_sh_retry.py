@@ -0,0 +1,52 @@
+#
+# Purpose: Retries of DynamoDB batch calls (sh_retry.batch_get_items / batch_write_items)
+#
+
+import pytest
+import sh_retry
+
+table_name = 'sh-summary-state'
+
+def put_items(org, count):
+    keys = [ 'summary#{:04d}'.format(idx) for idx in range(count) ]
+    for key in keys:
+        org.put_item(table_name, { 'account_id': { 'S': key }, 'counts': { 'S': '{}' } })
+    return keys
+
+def get_db_client():
+    import boto3
+    return boto3.Session().client('dynamodb')
+
+def test_batch_get_items_chunks_keys(org, no_sleep):
+    keys = put_items(org, 250)
+    items = sh_retry.batch_get_items(get_db_client(), table_name, keys + [ 'summary#missing' ])
+    assert sorted([ item['account_id']['S'] for item in items ]) == keys
+    assert org.calls['dynamodb.batch_get_item'] == 3
+
+def test_batch_get_items_retries_unprocessed_keys(org, no_sleep):
+    keys = put_items(org, 120)
+    org.throttle_rate = 0.5
+    items = sh_retry.batch_get_items(get_db_client(), table_name, keys)
+    assert sorted([ item['account_id']['S'] for item in items ]) == keys
+    assert org.throttled['dynamodb.batch_get_item'] > 0
+
+def test_batch_get_items_raises_when_keys_stay_unprocessed(org, no_sleep):
+    keys = put_items(org, 10)
+    org.throttle_rate = 1.0
+    with pytest.raises(RuntimeError, match='unprocessed after {} attempts'.format(sh_retry.batch_max_attempts)):
+        sh_retry.batch_get_items(get_db_client(), table_name, keys)
+    assert org.calls['dynamodb.batch_get_item'] == sh_retry.batch_max_attempts
+
+def test_batch_write_items_retries_unprocessed_items(org, no_sleep):
+    org.throttle_rate = 0.5
+    items = [ { 'account_id': { 'S': 'cost#{:04d}'.format(idx) }, 'cost': { 'N': str(idx) } } for idx in range(60) ]
+    sh_retry.batch_write_items(get_db_client(), table_name, items)
+    assert sorted(org.tables[table_name]) == sorted([ item['account_id']['S'] for item in items ])
+    assert org.throttled['dynamodb.batch_write_item'] > 0
+
+def test_batch_write_items_raises_when_items_stay_unprocessed(org, no_sleep):
+    org.throttle_rate = 1.0
+    items = [ { 'account_id': { 'S': 'cost#{:04d}'.format(idx) } } for idx in range(30) ]
+    with pytest.raises(RuntimeError, match='unprocessed'):
+        sh_retry.batch_write_items(get_db_client(), table_name, items)
+    assert org.calls['dynamodb.batch_write_item'] == sh_retry.batch_max_attempts
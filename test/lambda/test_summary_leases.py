@@ -0,0 +1,81 @@
+#
+# Purpose: Leases on the stored summary state shared by incremental runs and sh-findings-stream
+#
+
+import threading
+from datetime import datetime, timedelta, timezone
+import pytest
+
+table_name = 'sh-summary-state'
+
+@pytest.fixture
+def collector(load_lambda, lambda_env):
+    lambda_env.setenv('incremental', 'true')
+    lambda_env.setenv('summary_table_name', table_name)
+    return load_lambda('sh-summary-collector')
+
+def stored_counts(store, member_accounts):
+    return { member_account: account_state['counts'] for member_account, account_state in store.get_account_states(member_accounts).items() }
+
+def full_counts(collector, sh_admin_client, member_accounts):
+    recounts = collector.count_findings(sh_admin_client, member_accounts)
+    return { member_account: recounts.get(member_account, {}) for member_account in member_accounts }
+
+def test_stream_batch_waits_for_incremental_run(org, collector, churn):
+    sh_admin_client = collector.sh_retry.get_client(collector.session, 'securityhub')
+    store = collector.get_summary_store()
+    member_accounts = org.account_ids
+    collector.incremental_aggregate(sh_admin_client, store, member_accounts)
+    churn(150, seed=1)
+    # the incremental run stops at its first get_findings page, with its accounts leased
+    paused = threading.Event()
+    resume = threading.Event()
+    def pause_run(**kwargs):
+        if threading.current_thread().name == 'incremental' and not paused.is_set():
+            paused.set()
+            resume.wait(10)
+    org.events.register('before-call.securityhub.GetFindings', pause_run)
+    results = {}
+    run = threading.Thread(name='incremental', target=lambda: results.update(
+        summaries=collector.incremental_aggregate(sh_admin_client, store, member_accounts)))
+    run.start()
+    assert paused.wait(10)
+    # findings updated after the run's window, streamed while it is running (latest versions,
+    # as sh-findings-stream passes them)
+    updated = churn(60, seed=2, updated_at=datetime.now(timezone.utc) + timedelta(seconds=1))
+    streamed = list(dict([ (finding['Id'], finding) for finding in updated ]).values())
+    stream = threading.Thread(name='stream', target=lambda: results.update(
+        changes=collector.stream_aggregate(sh_admin_client, store, streamed)))
+    stream.start()
+    stream.join(0.5)
+    assert stream.is_alive()
+    resume.set()
+    run.join(10)
+    stream.join(30)
+    assert results['summaries'] is not None
+    assert set(results['changes']) == set([ finding['AwsAccountId'] for finding in streamed ])
+    assert stored_counts(store, member_accounts) == full_counts(collector, sh_admin_client, member_accounts)
+    # every lease was released
+    assert not any([ 'lease_owner' in item for item in org.tables[table_name].values() ])
+
+def test_expired_lease_is_taken_over(org, collector):
+    store = collector.get_summary_store()
+    member_account = org.account_ids[0]
+    assert store.acquire_lease(member_account, 'dead-run')
+    collector.lease_wait_seconds = 0
+    with pytest.raises(RuntimeError, match='leased by another run'):
+        store.acquire_leases([ member_account ], 'next-run')
+    collector.lease_seconds = -1
+    assert store.acquire_lease(member_account, 'dead-run')
+    store.acquire_leases([ member_account ], 'next-run')
+    assert org.tables[table_name]['summary#' + member_account]['lease_owner']['S'] == 'next-run'
+
+def test_commit_without_lease_fails(org, collector):
+    store = collector.get_summary_store()
+    member_account = org.account_ids[0]
+    state = { 'watermark': '2022-09-01T00:00:00.000000Z', 'baseline': '2022-09-01T00:00:00.000000Z', 'counts': {} }
+    store.acquire_leases([ member_account ], 'first-run')
+    with pytest.raises(RuntimeError, match='lost before commit'):
+        store.put_account_states({ member_account: state }, 'second-run')
+    store.put_account_states({ member_account: state }, 'first-run')
+    assert stored_counts(store, [ member_account ]) == { member_account: {} }